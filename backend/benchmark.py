@@ -0,0 +1,627 @@
+"""
+AI Remover 后端离线压测工具
+
+启动本地模拟的 302.AI / dewatermark.ai 服务，再以子进程方式启动 main.py（上游地址指向模拟服务），
+按指定的并发和图片尺寸发压，输出机器可读的 JSON 结果：
+吞吐（req/s）、延迟分位数（p50/p95/p99）、后端进程峰值 RSS、事件循环延迟。
+不会产生任何真实的上游调用费用，可用于对比不同改动前后的性能。
+
+用法:
+    # 完整压测（自动启动模拟上游和后端）
+    python benchmark.py run --operation remove-background --concurrency 1,8,32 \\
+        --sizes 512x512,2048x2048 --requests 200 --output result.json
+
+    # 只启动模拟上游（手动把 REMOVEBG_API_URL / DEWATERMARK_API_URL 指向它）
+    python benchmark.py mock --port 18190 --latency lognormal:1.5:0.4 --rate-429 0.05
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import asyncio
+import argparse
+import platform
+import socket
+import subprocess
+from collections import Counter, OrderedDict
+from io import BytesIO
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+import numpy as np
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+from PIL import Image
+from prometheus_client.parser import text_string_to_metric_families
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 每个请求使用不同图片时，先生成的基础图片数（请求之间再通过 unique_variant 区分）
+UNIQUE_BASE_IMAGES = 4
+
+# 各操作对应的后端端点和上传字段名
+ENDPOINTS = {
+    'remove-background': ('/api/remove-background', 'image_file'),
+    'dewatermark': ('/api/dewatermark', 'image'),
+    'pipeline': ('/api/pipeline', 'image'),
+}
+
+# ============================================================================
+# 1. 延迟分布
+# ============================================================================
+
+
+class LatencyDistribution:
+    """
+    模拟上游的响应延迟分布（秒）
+
+    格式:
+        - fixed:0.5              固定 0.5 秒
+        - uniform:0.1:2          0.1 ~ 2 秒均匀分布
+        - normal:1.0:0.2         均值 1.0、标准差 0.2（截断到 >= 0）
+        - lognormal:1.5:0.4      中位数 1.5、对数标准差 0.4（长尾，接近真实上游）
+    """
+
+    def __init__(self, spec: str):
+        kind, _, rest = spec.partition(':')
+        params = [float(value) for value in rest.split(':') if value]
+        expected = {'fixed': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2}
+        if kind not in expected or len(params) != expected[kind]:
+            raise ValueError(f'Invalid latency spec: {spec}')
+        self.spec = spec
+        self.kind = kind
+        self.params = params
+
+    def sample(self) -> float:
+        if self.kind == 'fixed':
+            return self.params[0]
+        if self.kind == 'uniform':
+            return random.uniform(*self.params)
+        if self.kind == 'normal':
+            return max(0.0, random.gauss(*self.params))
+        median, sigma = self.params
+        return random.lognormvariate(np.log(median), sigma) if median > 0 else 0.0
+
+# ============================================================================
+# 2. 模拟上游服务
+# ============================================================================
+
+
+def sniff_media_type(data: bytes) -> str:
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def create_mock_app(args: argparse.Namespace) -> FastAPI:
+    """
+    创建模拟 302.AI 和 dewatermark.ai 的应用
+
+    - POST /302/submit/removebg-v2: 按 --shape 返回 {"output": url} 或 {"image": {"url": url}}
+    - GET /files/{file_id}: 返回上一步上传的图片（供后端下载 / 镜像 / 全分辨率重建）
+    - POST /api/object_removal/v1/erase_watermark: 原样返回上传图片的 Base64
+    - GET /stats: 各端点的请求数和注入的错误数
+    """
+    app = FastAPI(title='AI Remover Mock Upstreams')
+    removebg_latency = LatencyDistribution(args.removebg_latency or args.latency)
+    dewatermark_latency = LatencyDistribution(args.dewatermark_latency or args.latency)
+    stats: Counter = Counter()
+    files: 'OrderedDict[str, bytes]' = OrderedDict()
+    mask = base64.b64encode(make_image(64, 64, 0, 'png')).decode()
+
+    def inject_error(name: str) -> Optional[Response]:
+        """按配置的概率注入 429 / 5xx"""
+        roll = random.random()
+        if roll < args.rate_429:
+            stats[f'{name}.429'] += 1
+            return JSONResponse({'error': 'rate limited'}, status_code=429,
+                                headers={'Retry-After': str(args.retry_after)})
+        if roll < args.rate_429 + args.rate_5xx:
+            status_code = random.choice((500, 502, 503))
+            stats[f'{name}.{status_code}'] += 1
+            return JSONResponse({'error': 'upstream error'}, status_code=status_code)
+        return None
+
+    @app.get('/health')
+    async def health():
+        return {'status': 'ok'}
+
+    @app.get('/stats')
+    async def get_stats():
+        return dict(stats)
+
+    @app.post('/302/submit/removebg-v2')
+    async def removebg(request: Request):
+        stats['removebg.requests'] += 1
+        body = await request.json()
+        await asyncio.sleep(removebg_latency.sample())
+        error = inject_error('removebg')
+        if error is not None:
+            return error
+
+        encoded = body.get('image_url', '').partition(',')[2]
+        data = await asyncio.to_thread(base64.b64decode, encoded)
+        file_id = uuid.uuid4().hex
+        files[file_id] = data
+        while len(files) > args.max_files:
+            files.popitem(last=False)
+
+        url = f'{str(request.base_url).rstrip("/")}/files/{file_id}'
+        shape = args.shape if args.shape != 'mixed' else random.choice(('output', 'image'))
+        stats[f'removebg.shape.{shape}'] += 1
+        if shape == 'output':
+            return {'output': url}
+        return {'image': {'url': url, 'file_size': len(data)}}
+
+    @app.get('/files/{file_id}')
+    async def get_file(file_id: str):
+        data = files.get(file_id)
+        if data is None:
+            raise HTTPException(status_code=404, detail='File expired')
+        stats['files.requests'] += 1
+        return Response(data, media_type=sniff_media_type(data))
+
+    @app.post('/api/object_removal/v1/erase_watermark')
+    async def erase_watermark(request: Request):
+        stats['dewatermark.requests'] += 1
+        form = await request.form()
+        upload = form.get('original_preview_image')
+        if upload is None or isinstance(upload, str):
+            return JSONResponse({'error': 'original_preview_image is required'}, status_code=400)
+        data = await upload.read()
+        await asyncio.sleep(dewatermark_latency.sample())
+        error = inject_error('dewatermark')
+        if error is not None:
+            return error
+
+        encoded = await asyncio.to_thread(lambda: base64.b64encode(data).decode())
+        return {
+            'session_id': uuid.uuid4().hex,
+            'edited_image': {'image': encoded, 'mask': mask, 'watermark_mask': mask},
+        }
+
+    return app
+
+# ============================================================================
+# 3. 进程管理
+# ============================================================================
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_process(command: List[str], env: Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+
+
+def stop_process(process: subprocess.Popen):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+async def wait_until_ready(client: httpx.AsyncClient, url: str, process: subprocess.Popen,
+                           timeout: float = 30.0):
+    """轮询健康检查端点直到服务可用"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Process exited before becoming ready: {url}')
+        try:
+            response = await client.get(url, timeout=1.0)
+            if response.status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f'Timed out waiting for {url}')
+
+# ============================================================================
+# 4. 资源采样（峰值 RSS）
+# ============================================================================
+
+
+def read_rss(pid: int) -> Optional[int]:
+    """读取进程当前 RSS（字节），不支持 /proc 的平台尝试 psutil"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+
+async def sample_peak_rss(pid: int, stop: asyncio.Event, interval: float = 0.05) -> Optional[int]:
+    """在 stop 被设置前持续采样，返回观测到的最大 RSS"""
+    peak = None
+    while True:
+        rss = read_rss(pid)
+        if rss is not None:
+            peak = rss if peak is None else max(peak, rss)
+        if stop.is_set():
+            return peak
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+# ============================================================================
+# 5. 后端指标（事件循环延迟）
+# ============================================================================
+
+
+async def scrape_loop_lag(client: httpx.AsyncClient, base_url: str) -> Dict[str, Any]:
+    """读取后端 /metrics 中事件循环延迟直方图的累计值"""
+    response = await client.get(f'{base_url}/metrics')
+    snapshot: Dict[str, Any] = {'buckets': {}, 'sum': 0.0, 'count': 0.0}
+    for family in text_string_to_metric_families(response.text):
+        if family.name != 'airemover_event_loop_lag_seconds':
+            continue
+        for sample in family.samples:
+            if sample.name.endswith('_bucket'):
+                snapshot['buckets'][float(sample.labels['le'])] = sample.value
+            elif sample.name.endswith('_sum'):
+                snapshot['sum'] = sample.value
+            elif sample.name.endswith('_count'):
+                snapshot['count'] = sample.value
+    return snapshot
+
+
+def summarize_loop_lag(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    计算两次采样之间的事件循环延迟
+
+    p99 取直方图桶的上界（近似值）
+    """
+    count = after['count'] - before['count']
+    if count <= 0:
+        return {'samples': 0, 'mean_ms': None, 'p99_ms_upper_bound': None}
+
+    p99 = None
+    for bound in sorted(after['buckets']):
+        cumulative = after['buckets'][bound] - before['buckets'].get(bound, 0.0)
+        if cumulative >= count * 0.99:
+            p99 = bound
+            break
+    return {
+        'samples': int(count),
+        'mean_ms': round((after['sum'] - before['sum']) / count * 1000, 3),
+        'p99_ms_upper_bound': None if p99 is None or p99 == float('inf') else p99 * 1000,
+    }
+
+# ============================================================================
+# 6. 测试图片
+# ============================================================================
+
+
+def make_image(width: int, height: int, seed: int, image_format: str) -> bytes:
+    """生成随机噪声图片（内容不可压缩，接近照片的最坏情况）"""
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    buffer = BytesIO()
+    if image_format == 'png':
+        Image.fromarray(pixels).save(buffer, format='PNG', compress_level=1)
+    else:
+        Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def unique_variant(image: bytes, index: int) -> bytes:
+    """
+    在图片末尾追加请求序号，得到内容哈希不同、像素相同的图片
+
+    解码器会忽略 JPEG EOI / PNG IEND 之后的数据，这样每个请求都是缓存和请求合并无法命中的新图片，
+    又不必为每个请求生成（并在内存中保留）一张完整的大图
+    """
+    return image + f'bench-{index}'.encode()
+
+
+def parse_size(value: str) -> Tuple[int, int]:
+    width, _, height = value.lower().partition('x')
+    return int(width), int(height or width)
+
+# ============================================================================
+# 7. 发压
+# ============================================================================
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """最近秩法计算分位数"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(np.ceil(q / 100 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def summarize_latencies(latencies: List[float]) -> Dict[str, Optional[float]]:
+    latencies = sorted(latencies)
+    return {
+        'mean': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+        **{
+            name: round(percentile(latencies, q) * 1000, 2) if latencies else None
+            for name, q in (('p50', 50), ('p95', 95), ('p99', 99))
+        },
+        'max': round(latencies[-1] * 1000, 2) if latencies else None,
+    }
+
+
+async def run_scenario(client: httpx.AsyncClient, base_url: str, operation: str, images: List[bytes],
+                       image_format: str, concurrency: int, total: int, unique: bool = True,
+                       offset: int = 0) -> Dict[str, Any]:
+    """
+    以固定并发发送 total 个请求，返回延迟、状态码和缓存状态统计
+
+    unique 为 True 时每个请求使用不同的图片（序号从 offset 开始，跨场景不重复），
+    测的是真实的上游路径；否则循环使用 images，结果中包含缓存命中 / 请求合并
+    """
+    path, field = ENDPOINTS[operation]
+    content_type = 'image/png' if image_format == 'png' else 'image/jpeg'
+    latencies: List[float] = []
+    miss_latencies: List[float] = []
+    statuses: Counter = Counter()
+    cache_statuses: Counter = Counter()
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < total:
+            index = next_index
+            next_index += 1
+            image = images[index % len(images)]
+            if unique:
+                image = unique_variant(image, offset + index)
+            start = time.perf_counter()
+            cache_status = None
+            try:
+                response = await client.post(
+                    f'{base_url}{path}',
+                    files={field: (f'bench_{index}.{image_format}', image, content_type)}
+                )
+                await response.aread()
+                statuses[str(response.status_code)] += 1
+                if response.status_code == 200:
+                    cache_status = response.headers.get('X-Cache', 'MISS')
+                    cache_statuses[cache_status] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+            elapsed = time.perf_counter() - start
+            latencies.append(elapsed)
+            if cache_status == 'MISS':
+                miss_latencies.append(elapsed)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    ok = statuses.get('200', 0)
+    misses = cache_statuses.get('MISS', 0)
+    return {
+        'requests': total,
+        'ok': ok,
+        'errors': total - ok,
+        'status_codes': dict(statuses),
+        'cache_statuses': dict(cache_statuses),
+        'duration_s': round(elapsed, 3),
+        'throughput_rps': round(total / elapsed, 3) if elapsed > 0 else None,
+        'ok_rps': round(ok / elapsed, 3) if elapsed > 0 else None,
+        # 真正经过上游的请求（X-Cache: MISS）的吞吐和延迟，不含缓存命中 / 合并
+        'miss_rps': round(misses / elapsed, 3) if elapsed > 0 else None,
+        'latency_ms': summarize_latencies(latencies),
+        'miss_latency_ms': summarize_latencies(miss_latencies),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """启动模拟上游和后端，依次执行每个（图片尺寸, 并发）组合"""
+    mock_port = free_port()
+    app_port = free_port()
+    mock_url = f'http://127.0.0.1:{mock_port}'
+    app_url = f'http://127.0.0.1:{app_port}'
+
+    mock_command = [
+        sys.executable, os.path.abspath(__file__), 'mock', '--port', str(mock_port),
+        '--latency', args.latency, '--rate-429', str(args.rate_429), '--rate-5xx', str(args.rate_5xx),
+        '--retry-after', str(args.retry_after), '--shape', args.shape,
+    ]
+    if args.removebg_latency:
+        mock_command += ['--removebg-latency', args.removebg_latency]
+    if args.dewatermark_latency:
+        mock_command += ['--dewatermark-latency', args.dewatermark_latency]
+
+    # 显式设置的环境变量优先于 .env（load_dotenv 不覆盖已有变量）
+    app_env = {
+        **os.environ,
+        'AI302_API_KEY': 'benchmark',
+        'DEWATERMARK_API_KEY': 'benchmark',
+        'REMOVEBG_API_URL': f'{mock_url}/302/submit/removebg-v2',
+        'DEWATERMARK_API_URL': f'{mock_url}/api/object_removal/v1/erase_watermark',
+        'CACHE_ENABLED': 'true' if args.cache else 'false',
+        'LOG_LEVEL': 'WARNING',
+    }
+    for item in args.env:
+        key, _, value = item.partition('=')
+        app_env[key] = value
+    app_command = [
+        sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(app_port),
+        '--log-level', 'warning',
+    ]
+
+    mock_process = start_process(mock_command, dict(os.environ))
+    app_process = None
+    scenarios = []
+    try:
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+            await wait_until_ready(client, f'{mock_url}/health', mock_process)
+            app_process = start_process(app_command, app_env)
+            await wait_until_ready(client, f'{app_url}/api/health', app_process)
+            idle_rss = read_rss(app_process.pid)
+
+            # --image-pool 0（默认）: 每个请求一张新图片；> 0: 循环使用固定数量的图片（测缓存 / 请求合并）
+            unique = args.image_pool <= 0
+            offset = 0
+            for size in args.sizes.split(','):
+                width, height = parse_size(size)
+                pool = args.image_pool if args.image_pool > 0 else UNIQUE_BASE_IMAGES
+                images = [make_image(width, height, seed, args.format) for seed in range(pool)]
+                for concurrency in (int(value) for value in args.concurrency.split(',')):
+                    if args.warmup:
+                        await run_scenario(client, app_url, args.operation, images, args.format,
+                                           min(concurrency, args.warmup), args.warmup, unique, offset)
+                        offset += args.warmup
+
+                    lag_before = await scrape_loop_lag(client, app_url)
+                    mock_before = (await client.get(f'{mock_url}/stats')).json()
+                    stop = asyncio.Event()
+                    sampler = asyncio.create_task(sample_peak_rss(app_process.pid, stop))
+                    result = await run_scenario(client, app_url, args.operation, images, args.format,
+                                                concurrency, args.requests, unique, offset)
+                    offset += args.requests
+                    stop.set()
+                    peak_rss = await sampler
+                    lag_after = await scrape_loop_lag(client, app_url)
+                    mock_after = (await client.get(f'{mock_url}/stats')).json()
+
+                    scenario = {
+                        'operation': args.operation,
+                        'image_size': f'{width}x{height}',
+                        'image_bytes_avg': round(sum(len(image) for image in images) / len(images)),
+                        'concurrency': concurrency,
+                        **result,
+                        'peak_rss_bytes': peak_rss,
+                        'event_loop_lag': summarize_loop_lag(lag_before, lag_after),
+                        'upstream': {
+                            key: value - mock_before.get(key, 0)
+                            for key, value in mock_after.items() if value - mock_before.get(key, 0)
+                        },
+                    }
+                    scenarios.append(scenario)
+                    print(
+                        f"[{scenario['image_size']} c={concurrency}] "
+                        f"{scenario['throughput_rps']} req/s, p50={scenario['latency_ms']['p50']}ms, "
+                        f"p99={scenario['latency_ms']['p99']}ms, errors={scenario['errors']}, "
+                        f"cache={scenario['cache_statuses']}",
+                        file=sys.stderr
+                    )
+    finally:
+        if app_process is not None:
+            stop_process(app_process)
+        stop_process(mock_process)
+
+    return {
+        'benchmark': {
+            'operation': args.operation,
+            'requests_per_scenario': args.requests,
+            'image_format': args.format,
+            'image_pool': args.image_pool,
+            'unique_images': args.image_pool <= 0,
+            'cache': args.cache,
+            'latency': args.latency,
+            'removebg_latency': args.removebg_latency,
+            'dewatermark_latency': args.dewatermark_latency,
+            'rate_429': args.rate_429,
+            'rate_5xx': args.rate_5xx,
+            'shape': args.shape,
+            'env': args.env,
+        },
+        'environment': {
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'idle_rss_bytes': idle_rss,
+        },
+        'scenarios': scenarios,
+    }
+
+# ============================================================================
+# 8. 命令行入口
+# ============================================================================
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency', default='lognormal:0.5:0.4',
+                        help='上游延迟分布（fixed:S / uniform:A:B / normal:MEAN:STD / lognormal:MEDIAN:SIGMA）')
+    parser.add_argument('--removebg-latency', default=None, help='单独指定 302.AI 的延迟分布')
+    parser.add_argument('--dewatermark-latency', default=None, help='单独指定 dewatermark.ai 的延迟分布')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='注入 429 的概率')
+    parser.add_argument('--rate-5xx', type=float, default=0.0, help='注入 500/502/503 的概率')
+    parser.add_argument('--retry-after', type=int, default=1, help='429 响应的 Retry-After（秒）')
+    parser.add_argument('--shape', choices=('output', 'image', 'mixed'), default='mixed',
+                        help='302.AI 响应格式：{"output": url} / {"image": {"url": url}} / 随机')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AI Remover 后端离线压测工具')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    mock_parser = subparsers.add_parser('mock', help='只启动模拟上游服务')
+    mock_parser.add_argument('--host', default='127.0.0.1')
+    mock_parser.add_argument('--port', type=int, default=18190)
+    mock_parser.add_argument('--max-files', type=int, default=1024, help='保留的结果图片数')
+    add_mock_arguments(mock_parser)
+
+    run_parser = subparsers.add_parser('run', help='启动模拟上游和后端并执行压测')
+    run_parser.add_argument('--operation', choices=sorted(ENDPOINTS), default='remove-background')
+    run_parser.add_argument('--concurrency', default='1,8,32', help='并发数列表，逗号分隔')
+    run_parser.add_argument('--sizes', default='1024x1024', help='图片尺寸列表，如 512x512,2048x2048')
+    run_parser.add_argument('--format', choices=('jpeg', 'png'), default='jpeg', help='测试图片格式')
+    run_parser.add_argument('--requests', type=int, default=200, help='每个场景的请求数')
+    run_parser.add_argument('--warmup', type=int, default=5, help='每个场景前的预热请求数')
+    run_parser.add_argument('--image-pool', type=int, default=0,
+                            help='每种尺寸循环使用的不同图片数（默认 0 = 每个请求一张新图片，不命中缓存 / 请求合并）')
+    run_parser.add_argument('--cache', action='store_true', help='启用后端结果缓存（默认关闭）')
+    run_parser.add_argument('--timeout', type=float, default=300.0, help='单个请求的超时（秒）')
+    run_parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                            help='传给后端的额外环境变量，可重复（如 REMOVEBG_DOWNSCALE_MAX_EDGE=1024）')
+    run_parser.add_argument('--output', default=None, help='结果 JSON 文件路径（默认输出到标准输出）')
+    add_mock_arguments(run_parser)
+
+    args = parser.parse_args()
+
+    if args.command == 'mock':
+        import uvicorn
+        uvicorn.run(create_mock_app(args), host=args.host, port=args.port, log_level='warning')
+        return
+
+    report = asyncio.run(run_benchmark(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+本地 CPU 去背景引擎（在 ProcessPoolExecutor 的工作进程中运行）
+
+- 经典算法: 纯色背景检测 + 颜色距离抠图，适合白底 / 纯色底的商品图；
+  背景不够均匀或前景比例异常时返回 None，由调用方回退到 302.AI
+- ONNX: 配置了模型文件且安装了 onnxruntime 时使用显著性分割模型（U²-Net 类：
+  输入 NCHW float32、ImageNet 归一化，第一个输出为 [N, 1, H, W] 的前景概率）；
+  预测几乎是平的（没有明显主体）或前景比例异常时同样返回 None
+
+模型在每个工作进程启动时加载一次（init_worker），之后的调用复用同一个推理会话。
+本模块只依赖 NumPy / Pillow（onnxruntime 可选），不导入 main.py，避免工作进程重复初始化整个应用。
+"""
+
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# 工作进程内的全局状态（由 init_worker 设置）
+_settings: Dict[str, Any] = {}
+_session = None
+_input_name = ''
+_input_size = (320, 320)
+_dynamic_batch = False
+
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def init_worker(settings: Dict[str, Any]):
+    """
+    工作进程初始化：保存配置并加载 ONNX 模型（只执行一次）
+
+    onnxruntime 未安装或模型加载失败时退回经典算法
+    """
+    global _settings, _session, _input_name, _input_size, _dynamic_batch
+    _settings = settings
+    model_path = settings.get('model')
+    if not model_path:
+        return
+    try:
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        # 进程池已经按核数扩展，每个进程只用一个线程，避免线程争抢
+        options.intra_op_num_threads = 1
+        options.inter_op_num_threads = 1
+        _session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        model_input = _session.get_inputs()[0]
+        _input_name = model_input.name
+        shape = model_input.shape
+        if len(shape) == 4 and isinstance(shape[2], int) and isinstance(shape[3], int):
+            _input_size = (shape[3], shape[2])
+        _dynamic_batch = not isinstance(shape[0], int)
+    except Exception:
+        _session = None
+
+
+def engine_name() -> str:
+    return 'onnx' if _session is not None else 'classical'
+
+
+def _decode(image_data: bytes, max_edge: int) -> Tuple[Image.Image, np.ndarray]:
+    """解码原图，返回 (全分辨率 RGB 图像, 缩小到 max_edge 的工作副本数组)"""
+    img = Image.open(BytesIO(image_data))
+    original = ImageOps.exif_transpose(img).convert('RGB')
+    work = original.copy()
+    work.thumbnail((max_edge, max_edge), Image.BILINEAR)
+    return original, np.asarray(work, dtype=np.float32)
+
+
+def classical_alpha(work: np.ndarray) -> Optional[np.ndarray]:
+    """
+    纯色背景抠图
+
+    用图片边框像素的中位数估计背景色；边框中足够多的像素接近背景色时，
+    按每个像素到背景色的距离生成 alpha，否则返回 None（不适合本地处理）
+    """
+    height, width, _ = work.shape
+    band = max(2, min(height, width) // 50)
+    border = np.concatenate([
+        work[:band].reshape(-1, 3), work[-band:].reshape(-1, 3),
+        work[:, :band].reshape(-1, 3), work[:, -band:].reshape(-1, 3),
+    ])
+    background = np.median(border, axis=0)
+    tolerance = float(_settings.get('tolerance', 30))
+
+    border_distance = np.linalg.norm(border - background, axis=1)
+    if np.mean(border_distance <= tolerance) < _settings.get('border_ratio', 0.95):
+        return None
+
+    distance = np.linalg.norm(work - background, axis=2)
+    softness = float(_settings.get('softness', 20))
+    alpha = np.clip((distance - tolerance) / softness, 0.0, 1.0)
+    return alpha if foreground_ok(alpha) else None
+
+
+def foreground_ok(alpha: np.ndarray) -> bool:
+    """前景面积占比是否在合理范围内（过小 / 过大通常说明抠图失败）"""
+    foreground = float(np.mean(alpha > 0.5))
+    return _settings.get('min_foreground', 0.01) <= foreground <= _settings.get('max_foreground', 0.9)
+
+
+def _onnx_input(work: np.ndarray) -> np.ndarray:
+    resized = Image.fromarray(work.astype(np.uint8)).resize(_input_size, Image.BILINEAR)
+    array = (np.asarray(resized, dtype=np.float32) / 255.0 - IMAGENET_MEAN) / IMAGENET_STD
+    return array.transpose(2, 0, 1)
+
+
+def _onnx_mask(prediction: np.ndarray, size: Tuple[int, int]) -> Optional[np.ndarray]:
+    """
+    把模型输出归一化到 0-1 并缩放回工作副本尺寸
+
+    预测的最大值与最小值之差低于 min_contrast（模型没有找到明显的主体）、
+    或归一化后的前景比例异常时返回 None
+    """
+    low, high = float(prediction.min()), float(prediction.max())
+    if high - low < _settings.get('min_contrast', 0.3):
+        return None
+    mask = (prediction - low) / (high - low)
+    image = Image.fromarray((mask * 255).astype(np.uint8)).resize(size, Image.BILINEAR)
+    alpha = np.asarray(image, dtype=np.float32) / 255.0
+    return alpha if foreground_ok(alpha) else None
+
+
+def onnx_alpha_batch(works: List[np.ndarray]) -> List[Optional[np.ndarray]]:
+    """批量推理（模型支持动态 batch 时一次前向，否则逐张执行），不可信的结果为 None"""
+    inputs = np.stack([_onnx_input(work) for work in works]).astype(np.float32)
+    if _dynamic_batch:
+        predictions = _session.run(None, {_input_name: inputs})[0]
+    else:
+        predictions = np.concatenate([
+            _session.run(None, {_input_name: inputs[i:i + 1]})[0] for i in range(len(works))
+        ])
+    return [
+        _onnx_mask(predictions[i].reshape(predictions[i].shape[-2:]), (work.shape[1], work.shape[0]))
+        for i, work in enumerate(works)
+    ]
+
+
+def compose(original: Image.Image, alpha: np.ndarray) -> bytes:
+    """把工作尺寸的 alpha 放大到原图尺寸并合成为 RGBA PNG"""
+    mask = Image.fromarray((alpha * 255).round().astype(np.uint8), mode='L')
+    mask = mask.resize(original.size, Image.BILINEAR)
+    result = original.convert('RGBA')
+    result.putalpha(mask)
+    buffer = BytesIO()
+    result.save(buffer, format='PNG', compress_level=_settings.get('compress_level', 3))
+    return buffer.getvalue()
+
+
+def segment_batch(images: List[bytes]) -> List[Optional[Tuple[bytes, str]]]:
+    """
+    处理一批图片
+
+    返回:
+        与输入一一对应的 (PNG 字节, 引擎名) 或 None（无法解码 / 不适合本地处理）
+    """
+    max_edge = int(_settings.get('max_edge', 1024))
+    decoded: List[Optional[Tuple[Image.Image, np.ndarray]]] = []
+    for image_data in images:
+        try:
+            decoded.append(_decode(image_data, max_edge))
+        except Exception:
+            decoded.append(None)
+
+    # alpha 为 None 的图片（无法解码 / 不可信）由调用方回退到 302.AI
+    alphas: List[Optional[np.ndarray]] = [None] * len(images)
+    valid = [i for i, item in enumerate(decoded) if item is not None]
+    if _session is not None and valid:
+        try:
+            for i, alpha in zip(valid, onnx_alpha_batch([decoded[i][1] for i in valid])):
+                alphas[i] = alpha
+        except Exception:
+            pass
+    else:
+        for i in valid:
+            alphas[i] = classical_alpha(decoded[i][1])
+
+    results: List[Optional[Tuple[bytes, str]]] = []
+    for item, alpha in zip(decoded, alphas):
+        if item is None or alpha is None:
+            results.append(None)
+            continue
+        results.append((compose(item[0], alpha), engine_name()))
+    return results
@@ -8,20 +8,49 @@ API文档: https://302.ai/product/detail/302ai-removebg-v2
 - Base64 编码传输图片
 - 成本低：每次仅需0.01 PTC
 - 速度快：平均10-20秒完成处理（V2版本）
+- 全异步上游调用：共享 httpx 连接池，单进程可同时处理大量请求
 """
 
 import os
-from fastapi import FastAPI, File, UploadFile, HTTPException
+import asyncio
+import atexit
+import contextvars
+import copy
+import email.utils
+import hashlib
+import json
+import logging
+import math
+import mimetypes
+import multiprocessing
+import queue
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from fastapi import FastAPI, File, Form, Query, Request, UploadFile, HTTPException
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response, StreamingResponse
 from dotenv import load_dotenv
-import requests
+import httpx
 import uuid
 import base64
 import time
 from io import BytesIO
-from typing import Dict, Any
+import numpy as np
+from PIL import Image, ImageOps
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable
+import local_engine
 
 # ============================================================================
 # 1. 加载环境变量
@@ -29,14 +58,827 @@ from typing import Dict, Any
 load_dotenv()
 
 # ============================================================================
-# 2. FastAPI 应用初始化
+# 2. 配置
+# ============================================================================
+# 302.AI API 密钥（去背景）
+# 获取地址: https://302.ai
+AI302_API_KEY = os.getenv('AI302_API_KEY')
+
+# dewatermark.ai API 密钥（去水印）
+# 获取地址: https://platform.dewatermark.ai
+DEWATERMARK_API_KEY = os.getenv('DEWATERMARK_API_KEY')
+
+# 上传文件大小上限
+REMOVEBG_MAX_SIZE = 16 * 1024 * 1024      # 去背景: 16MB
+DEWATERMARK_MAX_SIZE = 10 * 1024 * 1024   # 去水印: 10MB
+
+# 分块去水印（大图切成重叠的图块并发处理，再羽化拼接）
+# - DEWATERMARK_TILING_ENABLED: 是否启用；启用后去水印的上传上限提高到 DEWATERMARK_TILED_MAX_SIZE
+# - DEWATERMARK_TILE_TRIGGER_EDGE: 长边超过该像素数（或文件超过 10MB）时分块
+# - DEWATERMARK_TILE_SIZE / DEWATERMARK_TILE_OVERLAP: 图块边长和相邻图块的最小重叠（像素）
+# - DEWATERMARK_TILE_CONCURRENCY: 单张图片同时发往上游的图块数
+DEWATERMARK_TILING_ENABLED = os.getenv('DEWATERMARK_TILING_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+DEWATERMARK_TILED_MAX_SIZE = int(os.getenv('DEWATERMARK_TILED_MAX_SIZE', str(50 * 1024 * 1024)))
+DEWATERMARK_TILE_TRIGGER_EDGE = int(os.getenv('DEWATERMARK_TILE_TRIGGER_EDGE', '4096'))
+DEWATERMARK_TILE_SIZE = int(os.getenv('DEWATERMARK_TILE_SIZE', '2048'))
+DEWATERMARK_TILE_OVERLAP = int(os.getenv('DEWATERMARK_TILE_OVERLAP', '128'))
+DEWATERMARK_TILE_CONCURRENCY = int(os.getenv('DEWATERMARK_TILE_CONCURRENCY', '4'))
+DEWATERMARK_UPLOAD_MAX_SIZE = DEWATERMARK_TILED_MAX_SIZE if DEWATERMARK_TILING_ENABLED else DEWATERMARK_MAX_SIZE
+
+# 去背景预处理: 长边超过该值时只上传缩小后的副本，再在本地重建全分辨率结果（0 = 关闭）
+REMOVEBG_DOWNSCALE_MAX_EDGE = int(os.getenv('REMOVEBG_DOWNSCALE_MAX_EDGE', '0'))
+REMOVEBG_DOWNSCALE_QUALITY = int(os.getenv('REMOVEBG_DOWNSCALE_QUALITY', '92'))
+# alpha 细化区间: 低于下限视为全透明，高于上限视为不透明
+REMOVEBG_ALPHA_REFINE_RANGE = (
+    float(os.getenv('REMOVEBG_ALPHA_REFINE_LOW', '0.04')),
+    float(os.getenv('REMOVEBG_ALPHA_REFINE_HIGH', '0.96')),
+)
+REMOVEBG_PNG_COMPRESS_LEVEL = int(os.getenv('REMOVEBG_PNG_COMPRESS_LEVEL', '3'))
+
+# 去背景结果后处理（可选）: 按 alpha 包围盒裁掉透明边缘，生成多尺寸、多格式的结果文件
+# - POSTPROCESS_RENDITIONS: 尺寸名=长边上限（0 = 保持裁剪后的原尺寸），客户端用 ?rendition= 选择
+# - POSTPROCESS_FORMATS: 输出格式（webp / avif / png），客户端用 ?format= 选择，默认第一个
+# - POSTPROCESS_TRIM_PADDING: 裁剪时在包围盒外保留的像素；POSTPROCESS_ALPHA_THRESHOLD: alpha 大于该值才算内容
+POSTPROCESS_ENABLED = os.getenv('POSTPROCESS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+POSTPROCESS_TRIM = os.getenv('POSTPROCESS_TRIM', 'true').lower() in ('1', 'true', 'yes')
+POSTPROCESS_TRIM_PADDING = int(os.getenv('POSTPROCESS_TRIM_PADDING', '4'))
+POSTPROCESS_ALPHA_THRESHOLD = int(os.getenv('POSTPROCESS_ALPHA_THRESHOLD', '8'))
+POSTPROCESS_DEFAULT_RENDITIONS = 'thumbnail=256,preview=1024,full=0'
+POSTPROCESS_DEFAULT_FORMATS = 'webp,png'
+
+
+def parse_renditions(spec: str) -> Dict[str, int]:
+    return {
+        name.strip(): int(edge)
+        for name, _, edge in (item.partition('=') for item in spec.split(',') if '=' in item)
+        if name.strip()
+    }
+
+
+def parse_formats(spec: str) -> List[str]:
+    return [fmt.strip().lower() for fmt in spec.split(',') if fmt.strip()]
+
+
+POSTPROCESS_RENDITIONS = parse_renditions(os.getenv('POSTPROCESS_RENDITIONS', POSTPROCESS_DEFAULT_RENDITIONS))
+POSTPROCESS_FORMATS = parse_formats(os.getenv('POSTPROCESS_FORMATS', POSTPROCESS_DEFAULT_FORMATS))
+POSTPROCESS_WEBP_QUALITY = int(os.getenv('POSTPROCESS_WEBP_QUALITY', '85'))
+POSTPROCESS_AVIF_QUALITY = int(os.getenv('POSTPROCESS_AVIF_QUALITY', '60'))
+POSTPROCESS_WORKERS = int(os.getenv('POSTPROCESS_WORKERS', str(min(8, os.cpu_count() or 1))))
+
+# 上传读取分块大小，以及 multipart 请求体相对文件大小允许的额外开销（边界、表单字段）
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_MULTIPART_OVERHEAD = 64 * 1024
+# 批量端点的整个请求体上限
+BATCH_MAX_BODY_BYTES = int(os.getenv('BATCH_MAX_BODY_BYTES', str(1024 * 1024 * 1024)))
+
+# 上游保护（每个服务商独立）
+# - UPSTREAM_*_CONCURRENCY: AIMD 自适应并发上限的初始值 / 下限 / 上限
+# - UPSTREAM_QUEUE_TIMEOUT: 等待并发槽位的最长时间（秒），超时返回 503
+# - UPSTREAM_BACKOFF_BASE / UPSTREAM_BACKOFF_MAX: 抖动指数退避的基数和上限（秒）
+# - UPSTREAM_RETRY_AFTER_MAX: Retry-After 超过该值时不再等待重试，直接返回错误
+# - BREAKER_FAILURE_THRESHOLD: 连续失败多少次后熔断
+# - BREAKER_RESET_TIMEOUT: 熔断后多久进入半开状态（秒）
+UPSTREAM_INITIAL_CONCURRENCY = int(os.getenv('UPSTREAM_INITIAL_CONCURRENCY', '8'))
+UPSTREAM_MIN_CONCURRENCY = int(os.getenv('UPSTREAM_MIN_CONCURRENCY', '1'))
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv('UPSTREAM_MAX_CONCURRENCY', '64'))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', '30'))
+UPSTREAM_BACKOFF_BASE = float(os.getenv('UPSTREAM_BACKOFF_BASE', '1'))
+UPSTREAM_BACKOFF_MAX = float(os.getenv('UPSTREAM_BACKOFF_MAX', '20'))
+UPSTREAM_RETRY_AFTER_MAX = float(os.getenv('UPSTREAM_RETRY_AFTER_MAX', '30'))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+# 每次请求最多尝试次数（去背景按次计费，且超时不重试）
+REMOVEBG_MAX_ATTEMPTS = int(os.getenv('REMOVEBG_MAX_ATTEMPTS', '2'))
+DEWATERMARK_MAX_ATTEMPTS = int(os.getenv('DEWATERMARK_MAX_ATTEMPTS', '3'))
+
+# 请求截止时间（秒）
+# - REQUEST_DEADLINE_SECONDS: 同步端点 / 批量条目的默认处理时限
+# - JOB_DEADLINE_SECONDS: 异步任务的默认处理时限（0 = 不限制）
+# - REQUEST_DEADLINE_MAX: 客户端通过 X-Request-Timeout 头指定时限的上限
+# - DEADLINE_MIN_ATTEMPT_SECONDS: 剩余时间少于该值时不再发起新的上游请求 / 重试
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', '120'))
+JOB_DEADLINE_SECONDS = float(os.getenv('JOB_DEADLINE_SECONDS', '600'))
+REQUEST_DEADLINE_MAX = float(os.getenv('REQUEST_DEADLINE_MAX', '600'))
+DEADLINE_MIN_ATTEMPT_SECONDS = float(os.getenv('DEADLINE_MIN_ATTEMPT_SECONDS', '2'))
+DEADLINE_HEADER = 'X-Request-Timeout'
+
+# 准入控制（多 worker 进程共享同一个 SQLite 文件中的令牌桶和排队状态）
+# - ADMISSION_IP_RATE / ADMISSION_IP_BURST: 每个客户端 IP 每分钟的处理请求数 / 突发上限
+# - ADMISSION_API_KEYS: 允许使用密钥配额的 X-API-Key 列表（逗号分隔）；不在列表中的密钥被忽略，按 IP 计算配额
+# - ADMISSION_KEY_RATE / ADMISSION_KEY_BURST: 持有上述密钥的客户端按密钥计算配额（代替 IP 配额）
+# - ADMISSION_PROVIDER_RATES: 各上游服务商的全局请求预算（每秒），如 "302.ai=10,dewatermark.ai=5"
+# - ADMISSION_QUEUE_SLO: 预计排队时间超过该值（秒）时直接返回 429 + Retry-After
+# - ADMISSION_TRUST_FORWARDED: 部署在反向代理后时，从 X-Forwarded-For 读取客户端 IP
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+ADMISSION_DB_PATH = os.getenv('ADMISSION_DB_PATH', os.path.join(tempfile.gettempdir(), 'airemover_admission.sqlite3'))
+ADMISSION_IP_RATE = float(os.getenv('ADMISSION_IP_RATE', '30'))
+ADMISSION_IP_BURST = float(os.getenv('ADMISSION_IP_BURST', '10'))
+ADMISSION_KEY_RATE = float(os.getenv('ADMISSION_KEY_RATE', '120'))
+ADMISSION_KEY_BURST = float(os.getenv('ADMISSION_KEY_BURST', '30'))
+ADMISSION_API_KEYS = {key.strip() for key in os.getenv('ADMISSION_API_KEYS', '').split(',') if key.strip()}
+ADMISSION_PROVIDER_RATES = {
+    name.strip(): float(rate)
+    for name, _, rate in (
+        item.partition('=') for item in os.getenv('ADMISSION_PROVIDER_RATES', '').split(',') if '=' in item
+    )
+}
+ADMISSION_QUEUE_SLO = float(os.getenv('ADMISSION_QUEUE_SLO', '10'))
+ADMISSION_TRUST_FORWARDED = os.getenv('ADMISSION_TRUST_FORWARDED', 'false').lower() in ('1', 'true', 'yes')
+ADMISSION_POLL_INTERVAL = 0.05  # 排队时轮询共享队列的间隔（秒）
+ADMISSION_TICKET_TTL = 5.0      # 排队票据的心跳有效期（秒），进程崩溃留下的票据过期后自动清除
+ADMISSION_PRUNE_INTERVAL = 60.0  # 清理闲置客户端令牌桶的间隔（秒）
+
+# 上游 API 端点（可通过环境变量指向本地模拟服务，用于 benchmark.py 压测）
+REMOVEBG_API_URL = os.getenv('REMOVEBG_API_URL', 'https://api.302.ai/302/submit/removebg-v2')
+DEWATERMARK_API_URL = os.getenv(
+    'DEWATERMARK_API_URL', 'https://platform.dewatermark.ai/api/object_removal/v1/erase_watermark'
+)
+
+# 提供方路由（同一操作可配置多个后端，按滚动延迟 / 错误率选择）
+# - REMOVEBG_ALT_API_URL / REMOVEBG_ALT_NAME: 备用的 302.AI 去背景模型接口（留空 = 不启用）
+# - HEDGE_ENABLED: 主请求超过该提供方的 p95 仍未返回时，向备用提供方发送对冲请求（先返回者胜出，另一个取消）
+#   注意对冲请求同样计费，只在配置了多个提供方时生效
+# - HEDGE_MIN_DELAY: 对冲前最少等待的秒数
+# - PROVIDER_WINDOW_SECONDS / PROVIDER_WINDOW_SIZE: 滚动统计的时间窗口和最大样本数
+# - PROVIDER_MIN_SAMPLES: 样本少于该值时不计算 p95（不对冲），并优先试用该提供方
+REMOVEBG_ALT_API_URL = os.getenv('REMOVEBG_ALT_API_URL', '')
+REMOVEBG_ALT_NAME = os.getenv('REMOVEBG_ALT_NAME', '302.ai-removebg-alt')
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '2'))
+PROVIDER_WINDOW_SECONDS = float(os.getenv('PROVIDER_WINDOW_SECONDS', '300'))
+PROVIDER_WINDOW_SIZE = int(os.getenv('PROVIDER_WINDOW_SIZE', '200'))
+PROVIDER_MIN_SAMPLES = int(os.getenv('PROVIDER_MIN_SAMPLES', '20'))
+
+# 本地 CPU 去背景引擎（在进程池中运行，处理不了的图片回退到 302.AI）
+# - LOCAL_ENGINE_ENABLED: 是否启用
+# - LOCAL_ENGINE_WORKERS: 工作进程数（默认等于 CPU 核数）
+# - LOCAL_ENGINE_MODEL: ONNX 分割模型路径（需安装 onnxruntime；留空 = 使用纯色背景的经典算法）
+# - LOCAL_ENGINE_MAX_EDGE: 分割时的工作分辨率（长边像素），alpha 再放大回原图尺寸
+# - LOCAL_ENGINE_MAX_BATCH: 排队的请求合并为一批推理的最大数量
+# - LOCAL_ENGINE_TOLERANCE: 经典算法中视为背景色的颜色距离（0-441）
+# - LOCAL_ENGINE_SOFTNESS: 经典算法中超出容差后 alpha 从 0 过渡到 1 的颜色距离（边缘柔和度）
+# - LOCAL_ENGINE_BORDER_RATIO: 经典算法要求图片边框中接近背景色的像素比例，低于该值时交给 302.AI
+# - LOCAL_ENGINE_MIN_FOREGROUND / LOCAL_ENGINE_MAX_FOREGROUND: 前景面积占比的合理范围，超出时交给 302.AI（两种算法都检查）
+# - LOCAL_ENGINE_MIN_CONTRAST: ONNX 模型输出的最大值与最小值之差低于该值（预测几乎是平的）时交给 302.AI
+LOCAL_ENGINE_ENABLED = os.getenv('LOCAL_ENGINE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+LOCAL_ENGINE_WORKERS = int(os.getenv('LOCAL_ENGINE_WORKERS', str(os.cpu_count() or 1)))
+LOCAL_ENGINE_MODEL = os.getenv('LOCAL_ENGINE_MODEL', '')
+LOCAL_ENGINE_MAX_EDGE = int(os.getenv('LOCAL_ENGINE_MAX_EDGE', '1024'))
+LOCAL_ENGINE_MAX_BATCH = int(os.getenv('LOCAL_ENGINE_MAX_BATCH', '8'))
+LOCAL_ENGINE_TOLERANCE = float(os.getenv('LOCAL_ENGINE_TOLERANCE', '30'))
+LOCAL_ENGINE_SOFTNESS = float(os.getenv('LOCAL_ENGINE_SOFTNESS', '20'))
+LOCAL_ENGINE_BORDER_RATIO = float(os.getenv('LOCAL_ENGINE_BORDER_RATIO', '0.95'))
+LOCAL_ENGINE_MIN_FOREGROUND = float(os.getenv('LOCAL_ENGINE_MIN_FOREGROUND', '0.01'))
+LOCAL_ENGINE_MAX_FOREGROUND = float(os.getenv('LOCAL_ENGINE_MAX_FOREGROUND', '0.9'))
+LOCAL_ENGINE_MIN_CONTRAST = float(os.getenv('LOCAL_ENGINE_MIN_CONTRAST', '0.3'))
+
+# 日志配置
+# - LOG_LEVEL: DEBUG / INFO / WARNING / ERROR
+# - LOG_FORMAT: json（结构化 JSON 行）或 text（key=value）
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+# 事件循环延迟采样间隔（秒，0 = 关闭）
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv('EVENT_LOOP_LAG_INTERVAL', '0.25'))
+
+# 上游 HTTP 连接池配置（整个应用生命周期共享一个 AsyncClient）
+# - HTTP_MAX_CONNECTIONS: 同时打开的最大连接数
+# - HTTP_MAX_KEEPALIVE_CONNECTIONS: 空闲时保留的 keep-alive 连接数
+# - HTTP_KEEPALIVE_EXPIRY: 空闲连接保留时长（秒）
+# - HTTP_POOL_TIMEOUT: 连接池耗尽时等待空闲连接的最长时间（秒）
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS', '20'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '30'))
+HTTP_POOL_TIMEOUT = float(os.getenv('HTTP_POOL_TIMEOUT', '30'))
+
+# 启动预热与就绪检查
+# - UPSTREAM_PREWARM_ENABLED: 启动时（接收请求之前）向每个已配置的上游建立连接（DNS + TCP + TLS）
+# - UPSTREAM_PREWARM_CONNECTIONS: 每个上游预先建立的连接数
+# - UPSTREAM_PREWARM_TIMEOUT: 启动预热最多等待的秒数（超时不阻止启动，只在 /api/ready 中报告）
+# - UPSTREAM_KEEPWARM_INTERVAL: 保温间隔（秒），需小于 HTTP_KEEPALIVE_EXPIRY，否则空闲连接会先被关闭（0 = 不保温）
+# - READINESS_MAX_P95: 任一提供方滚动 p95 超过该值（秒）时在 /api/ready 的 degraded 中列出（0 = 不检查）
+# - READINESS_MAX_ERROR_RATE: 任一提供方错误率超过该值时在 /api/ready 的 degraded 中列出（样本不少于 PROVIDER_MIN_SAMPLES 时才检查）
+#   两者只报告不摘除实例：摘除后没有流量，滚动统计无法恢复；路由本身会绕开表现差的提供方
+UPSTREAM_PREWARM_ENABLED = os.getenv('UPSTREAM_PREWARM_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+UPSTREAM_PREWARM_CONNECTIONS = int(os.getenv('UPSTREAM_PREWARM_CONNECTIONS', '2'))
+UPSTREAM_PREWARM_TIMEOUT = float(os.getenv('UPSTREAM_PREWARM_TIMEOUT', '10'))
+UPSTREAM_KEEPWARM_INTERVAL = float(os.getenv('UPSTREAM_KEEPWARM_INTERVAL', str(HTTP_KEEPALIVE_EXPIRY * 0.8)))
+READINESS_MAX_P95 = float(os.getenv('READINESS_MAX_P95', '0'))
+READINESS_MAX_ERROR_RATE = float(os.getenv('READINESS_MAX_ERROR_RATE', '0.5'))
+
+# 结果缓存配置（按图片内容哈希 + 操作 + 参数缓存处理结果）
+# - CACHE_ENABLED: 是否启用缓存
+# - CACHE_TTL_SECONDS: 缓存有效期（秒），302.AI 返回的图片 URL 会过期，不宜过长
+# - CACHE_MEMORY_MAX_ENTRIES / CACHE_MEMORY_MAX_BYTES: 内存 LRU 层的条目数 / 字节上限
+# - CACHE_DISK_MAX_BYTES: 磁盘层（static/results/cache）的字节上限
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+CACHE_TTL_SECONDS = float(os.getenv('CACHE_TTL_SECONDS', '3600'))
+CACHE_MEMORY_MAX_ENTRIES = int(os.getenv('CACHE_MEMORY_MAX_ENTRIES', '256'))
+CACHE_MEMORY_MAX_BYTES = int(os.getenv('CACHE_MEMORY_MAX_BYTES', str(64 * 1024 * 1024)))
+CACHE_DISK_MAX_BYTES = int(os.getenv('CACHE_DISK_MAX_BYTES', str(512 * 1024 * 1024)))
+
+# 去水印蒙版暂存（默认不随结果返回，可按 session_id 按需获取）
+# - DEWATERMARK_MASK_STORE_BYTES: 内存中保留的蒙版总字节上限，超出后淘汰最久未使用的会话
+DEWATERMARK_MASK_STORE_BYTES = int(os.getenv('DEWATERMARK_MASK_STORE_BYTES', str(64 * 1024 * 1024)))
+BASE64_DECODE_CHUNK_CHARS = 4 * 256 * 1024  # 二进制响应每次解码 1MB Base64（约 768KB 图片数据）
+
+# 异步任务引擎配置
+# - JOB_WORKERS: 同时执行的任务数（worker 协程数）
+# - JOB_QUEUE_SIZE: 排队任务上限，超过后返回 503
+# - JOB_TTL_SECONDS: 任务结束后状态和结果的保留时长（秒）
+# - JOB_SSE_HEARTBEAT: SSE 心跳间隔（秒）
+# - JOB_RESULTS_MAX_BYTES: 已完成的异步任务保留结果的总字节上限，超出后提前清理最早完成的任务
+#   （同步请求的任务不保留，结束后立即释放）
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '32'))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '256'))
+JOB_TTL_SECONDS = float(os.getenv('JOB_TTL_SECONDS', '600'))
+JOB_SSE_HEARTBEAT = float(os.getenv('JOB_SSE_HEARTBEAT', '15'))
+JOB_RESULTS_MAX_BYTES = int(os.getenv('JOB_RESULTS_MAX_BYTES', str(128 * 1024 * 1024)))
+
+# 批量处理配置
+# - BATCH_CONCURRENCY: 单个批次默认的上游并发数
+# - BATCH_MAX_CONCURRENCY: 客户端可指定的并发上限
+# - BATCH_MAX_ITEMS: 单个批次最多图片数
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '16'))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '500'))
+BATCH_SPOOL_MEMORY_BYTES = 1024 * 1024  # 批量上传的临时文件超过 1MB 后落盘
+
+# 结果本地镜像
+# - RESULT_MIRROR_ENABLED: 是否在后台把 302.AI 的结果流式下载到 static/results，并返回本地 URL
+#   （下载完成前访问本地 URL 会临时重定向到 302.AI）
+# - RESULTS_MAX_BYTES: static/results 下结果文件的总字节上限，超出后按最久未访问顺序删除（0 = 不限制）
+# - RESULTS_JANITOR_INTERVAL: 清理任务的执行间隔（秒）
+RESULT_MIRROR_ENABLED = os.getenv('RESULT_MIRROR_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+RESULTS_MAX_BYTES = int(os.getenv('RESULTS_MAX_BYTES', str(1024 * 1024 * 1024)))
+RESULTS_JANITOR_INTERVAL = float(os.getenv('RESULTS_JANITOR_INTERVAL', '300'))
+RESULT_STREAM_CHUNK_SIZE = 256 * 1024  # 下载 / 返回结果文件时的分块大小
+
+# ============================================================================
+# 3. 日志与指标
+# ============================================================================
+# - 日志: 结构化（JSON 或 key=value）输出，经 QueueHandler 交给后台线程写出，
+#   请求处理协程不会因为写 stdout 而阻塞
+# - 指标: Prometheus 格式，GET /metrics 暴露
+
+# LogRecord 自带的属性，其余属性（通过 extra 传入）作为结构化字段输出
+_LOG_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class StructuredFormatter(logging.Formatter):
+    """把日志记录格式化为 JSON 行（LOG_FORMAT=json）或 key=value 文本（LOG_FORMAT=text）"""
+
+    def __init__(self, fmt: str):
+        super().__init__()
+        self.fmt = fmt
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {
+            key: value for key, value in vars(record).items()
+            if key not in _LOG_RECORD_ATTRS and not key.startswith('_')
+        }
+        if self.fmt == 'json':
+            data = {
+                'ts': round(record.created, 3),
+                'level': record.levelname,
+                'logger': record.name,
+                'msg': record.getMessage(),
+                **fields,
+            }
+            return json.dumps(data, ensure_ascii=False, default=str)
+
+        text = f"{self.formatTime(record)} {record.levelname} {record.getMessage()}"
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return text
+
+
+# 当前正在执行的任务（用于在上游调用中上报进度，以及在日志中附加任务 ID）
+current_job: 'contextvars.ContextVar[Optional[Job]]' = contextvars.ContextVar('current_job', default=None)
+
+
+class JobContextFilter(logging.Filter):
+    """在日志中附加当前任务 ID（在发出日志的协程上下文中执行）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        job = current_job.get()
+        if job is not None and not hasattr(record, 'job_id'):
+            record.job_id = job.id
+        return True
+
+
+class _StructuredQueueHandler(QueueHandler):
+    """保留 extra 字段原样入队（默认实现会把消息预先格式化并丢弃参数）"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging() -> QueueListener:
+    """配置应用日志: 队列 + 后台监听线程"""
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter(LOG_FORMAT))
+
+    log_queue: 'queue.SimpleQueue' = queue.SimpleQueue()
+    queue_handler = _StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(JobContextFilter())
+
+    app_logger = logging.getLogger('airemover')
+    app_logger.setLevel(LOG_LEVEL)
+    app_logger.handlers = [queue_handler]
+    app_logger.propagate = False
+
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+logger = logging.getLogger('airemover')
+log_listener = setup_logging()
+
+# 各处理阶段耗时: upload_read / base64_encode / json_parse
+STAGE_SECONDS = Histogram(
+    'airemover_stage_seconds', '各处理阶段耗时（秒）', ['operation', 'stage'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+# 上游请求耗时: connect（TCP+TLS）/ ttfb（收到响应头）/ total（完整响应）
+UPSTREAM_SECONDS = Histogram(
+    'airemover_upstream_seconds', '上游请求各阶段耗时（秒）', ['provider', 'phase'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+)
+UPSTREAM_RETRIES = Histogram(
+    'airemover_upstream_retries', '每次上游调用的重试次数', ['provider'],
+    buckets=(0, 1, 2, 3, 5, 10)
+)
+UPSTREAM_RESPONSES = Counter(
+    'airemover_upstream_responses_total', '上游响应数（按状态码或错误类型）', ['provider', 'status']
+)
+UPSTREAM_INFLIGHT = Gauge('airemover_upstream_inflight', '在途上游请求数', ['provider'])
+UPSTREAM_CONCURRENCY_LIMIT = Gauge('airemover_upstream_concurrency_limit', '上游自适应并发上限', ['provider'])
+UPSTREAM_BREAKER_STATE = Gauge('airemover_upstream_breaker_state', '熔断器状态（0=关闭 1=半开 2=打开）', ['provider'])
+CACHE_LOOKUPS = Counter('airemover_cache_lookups_total', '缓存查询结果（hit / miss / coalesced）', ['operation', 'result'])
+ERRORS = Counter('airemover_errors_total', '处理失败次数（按操作和状态码）', ['operation', 'status'])
+HTTP_REQUESTS = Counter('airemover_http_requests_total', 'HTTP 请求数', ['endpoint', 'method', 'status'])
+HTTP_REQUEST_SECONDS = Histogram(
+    'airemover_http_request_seconds', 'HTTP 请求耗时（秒，到响应头发出为止）', ['endpoint'],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+)
+HTTP_INFLIGHT = Gauge('airemover_http_inflight_requests', '正在处理的 HTTP 请求数')
+JOBS_QUEUED = Gauge('airemover_jobs_queued', '排队中的任务数')
+JOBS_RUNNING = Gauge('airemover_jobs_running', '执行中的任务数')
+RESULT_MIRRORS = Counter('airemover_result_mirrors_total', '结果镜像下载次数（fetched / failed）', ['outcome'])
+RESULT_MIRROR_BYTES = Counter('airemover_result_mirror_bytes_total', '结果镜像下载的字节数')
+RESULTS_EVICTED = Counter('airemover_results_evicted_total', '清理任务删除的结果文件数')
+PROVIDER_CALLS = Counter(
+    'airemover_provider_calls_total', '提供方调用次数（success / error / declined / cancelled）', ['operation', 'provider', 'outcome']
+)
+PROVIDER_HEDGES = Counter('airemover_provider_hedges_total', '对冲请求（sent / won / lost）', ['operation', 'outcome'])
+LOCAL_ENGINE_BATCH_SIZE = Histogram(
+    'airemover_local_engine_batch_size', '本地引擎每批推理的图片数', buckets=(1, 2, 4, 8, 16, 32)
+)
+ABANDONED_WORK = Counter(
+    'airemover_abandoned_work_total', '被放弃的处理（client_disconnected / deadline_exceeded，按放弃时所处阶段）',
+    ['operation', 'reason', 'stage']
+)
+ABANDONED_SECONDS = Histogram(
+    'airemover_abandoned_work_seconds', '被放弃的处理在放弃前已耗费的时间（秒）', ['operation', 'reason'],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120, 300)
+)
+UPSTREAM_ABANDONED_SECONDS = Counter(
+    'airemover_upstream_abandoned_seconds_total', '被取消的在途上游请求已耗费的时间（秒）', ['provider']
+)
+ADMISSION_DECISIONS = Counter(
+    'airemover_admission_decisions_total', '准入控制决策（scope: client / provider，outcome: admitted / rejected）',
+    ['scope', 'outcome']
+)
+ADMISSION_QUEUE_SECONDS = Histogram(
+    'airemover_admission_queue_seconds', '等待上游全局预算的排队时间（秒）', ['provider'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+)
+EVENT_LOOP_LAG = Histogram(
+    'airemover_event_loop_lag_seconds', '事件循环延迟（定时器实际唤醒时间与预期的差值）',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+
+
+async def monitor_event_loop_lag(interval: float):
+    """定期测量事件循环的调度延迟（阻塞调用会让这个值明显升高）"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
+
+
+@contextmanager
+def observe_stage(operation: str, stage: str):
+    """记录一个处理阶段的耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(operation, stage).observe(time.perf_counter() - start)
+
+
+def upstream_provider(url: httpx.URL) -> str:
+    """按主机名归类上游服务商（用作指标标签）"""
+    host = url.host
+    if host.endswith('302.ai'):
+        return '302.ai'
+    if host.endswith('dewatermark.ai'):
+        return 'dewatermark.ai'
+    return host
+
+
+async def _on_upstream_request(request: httpx.Request):
+    """httpx 请求钩子: 记录开始时间，并挂上 trace 回调统计建连耗时"""
+    provider = upstream_provider(request.url)
+    timings: Dict[str, float] = {'start': time.perf_counter()}
+    request.extensions['timings'] = timings
+
+    async def trace(event: str, info: Dict[str, Any]):
+        if event in ('connection.connect_tcp.started',):
+            timings['connect_start'] = time.perf_counter()
+        elif event in ('connection.start_tls.complete', 'connection.connect_tcp.complete'):
+            if 'connect_start' in timings:
+                timings['connect_end'] = time.perf_counter()
+                if event == 'connection.start_tls.complete' or request.url.scheme == 'http':
+                    UPSTREAM_SECONDS.labels(provider, 'connect').observe(timings['connect_end'] - timings['connect_start'])
+
+    request.extensions['trace'] = trace
+
+
+async def _on_upstream_response(response: httpx.Response):
+    """httpx 响应钩子: 收到响应头时记录 TTFB"""
+    timings = response.request.extensions.get('timings')
+    # 预热 / 保温的 HEAD 请求不计入 TTFB，避免拉低真实调用的延迟分布
+    if timings and response.request.method != 'HEAD':
+        UPSTREAM_SECONDS.labels(upstream_provider(response.request.url), 'ttfb').observe(
+            time.perf_counter() - timings['start']
+        )
+
+
+class RequestMetricsMiddleware:
+    """统计每个端点的请求数、状态码、耗时和在途请求数"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                HTTP_REQUEST_SECONDS.labels(_endpoint_label(scope)).observe(time.perf_counter() - start)
+            await send(message)
+
+        HTTP_INFLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_INFLIGHT.dec()
+            HTTP_REQUESTS.labels(_endpoint_label(scope), scope['method'], str(status)).inc()
+
+
+def _endpoint_label(scope) -> str:
+    # 路由匹配后 scope 中会有 endpoint，用函数名作为标签，避免路径参数导致标签爆炸
+    endpoint = scope.get('endpoint')
+    if endpoint is not None:
+        return getattr(endpoint, '__name__', 'unknown')
+    return 'static' if scope['path'].startswith('/static/') else 'unmatched'
+
+# ============================================================================
+# 4. 共享异步 HTTP 客户端
+# ============================================================================
+# 所有上游调用都通过同一个 httpx.AsyncClient 发出，复用 TCP/TLS 连接，
+# 并且不会阻塞事件循环（原先的 requests.post / time.sleep 会卡住整个 worker）
+http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """返回应用生命周期内共享的 AsyncClient"""
+    if http_client is None:
+        raise RuntimeError('HTTP client is not initialized (application not started?)')
+    return http_client
+
+
+class ConnectionWarmer:
+    """
+    上游连接预热与保温
+
+    - 启动时向每个已配置的上游并发发送 HEAD 请求，提前完成 DNS / TCP / TLS 握手，
+      第一个真实请求直接复用池中的连接（任何 HTTP 状态码都说明连接可用）
+    - 之后每隔 UPSTREAM_KEEPWARM_INTERVAL 秒再发一次，防止空闲连接因 keep-alive 过期被关闭
+    - 记录每个上游最近一次探测的结果和耗时，供 /api/ready 判断
+    """
+
+    def __init__(self, connections: int, interval: float):
+        self.connections = max(1, connections)
+        self.interval = interval
+        self.status: Dict[str, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def origins() -> Dict[str, str]:
+        """已配置密钥的上游 API 地址，按 scheme://host:port 去重"""
+        urls = []
+        if AI302_API_KEY and AI302_API_KEY != 'YOUR_302_AI_API_KEY_HERE':
+            urls.append(REMOVEBG_API_URL)
+            if REMOVEBG_ALT_API_URL:
+                urls.append(REMOVEBG_ALT_API_URL)
+        if DEWATERMARK_API_KEY:
+            urls.append(DEWATERMARK_API_URL)
+        origins: Dict[str, str] = {}
+        for url in urls:
+            parsed = httpx.URL(url)
+            origins.setdefault(f'{parsed.scheme}://{parsed.netloc.decode()}', upstream_provider(parsed))
+        return origins
+
+    async def _ping(self, origin: str, provider: str):
+        client = get_http_client()
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(client.head(origin + '/', timeout=httpx.Timeout(UPSTREAM_PREWARM_TIMEOUT))
+              for _ in range(self.connections)),
+            return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        self.status[origin] = {
+            'provider': provider,
+            'ok': len(errors) < len(results),
+            'warm_connections': len(results) - len(errors),
+            'latency_seconds': round(time.perf_counter() - start, 3),
+            'error': f'{type(errors[0]).__name__}: {errors[0]}' if errors else None,
+            'checked_at': time.time(),
+        }
+        if errors:
+            logger.warning('上游连接预热失败', extra={
+                'origin': origin, 'failed': len(errors), 'error': self.status[origin]['error']
+            })
+
+    async def warm(self):
+        origins = self.origins()
+        await asyncio.gather(*(self._ping(origin, provider) for origin, provider in origins.items()))
+
+    async def _keep_warm(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.warm()
+            except Exception as e:
+                logger.warning('上游连接保温失败', extra={'error': str(e)})
+
+    async def start(self):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.warm(), timeout=UPSTREAM_PREWARM_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning('上游连接预热超时', extra={'timeout': UPSTREAM_PREWARM_TIMEOUT})
+        logger.info('上游连接预热完成', extra={
+            'origins': len(self.status), 'seconds': round(time.perf_counter() - start, 3)
+        })
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._keep_warm())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stale(self, status: Dict[str, Any]) -> bool:
+        """保温开启时，超过两个周期没有成功探测视为过期"""
+        return self.interval > 0 and time.time() - status['checked_at'] > 2 * self.interval + UPSTREAM_PREWARM_TIMEOUT
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            origin: {**status, 'stale': self.stale(status)}
+            for origin, status in self.status.items()
+        }
+
+
+def connection_pool_stats() -> Dict[str, Any]:
+    """
+    共享连接池中各上游的连接数
+
+    httpx 没有公开连接池状态，这里按属性逐层探测 httpcore 的内部结构；
+    升级后结构变化时 introspection 为 False，只返回配置（预热结果见 ConnectionWarmer.snapshot）
+    """
+    stats: Dict[str, Any] = {
+        'max_connections': HTTP_MAX_CONNECTIONS,
+        'max_keepalive_connections': HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        'keepalive_expiry': HTTP_KEEPALIVE_EXPIRY,
+        'introspection': False,
+    }
+    pool = getattr(getattr(http_client, '_transport', None), '_pool', None)
+    connections = getattr(pool, 'connections', None)
+    if not isinstance(connections, list):
+        return stats
+    origins: Dict[str, Dict[str, int]] = {}
+    try:
+        for connection in connections:
+            origin = getattr(connection, '_origin', None)
+            key = f'{origin.scheme.decode()}://{origin.host.decode()}:{origin.port}' if origin else 'unknown'
+            counts = origins.setdefault(key, {'total': 0, 'idle': 0})
+            counts['total'] += 1
+            counts['idle'] += int(connection.is_idle())
+    except (AttributeError, TypeError, UnicodeDecodeError):
+        return stats
+    stats['introspection'] = True
+    stats['origins'] = origins
+    return stats
+
+
+connection_warmer = ConnectionWarmer(UPSTREAM_PREWARM_CONNECTIONS, UPSTREAM_KEEPWARM_INTERVAL)
+
+
+def warm_imports():
+    """提前加载 Pillow 编解码插件和 MIME 类型表，避免第一个请求承担懒加载开销"""
+    Image.init()
+    mimetypes.init()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    应用生命周期钩子
+    启动时创建共享连接池并预热上游连接（完成前不接收请求），关闭时释放所有连接
+    """
+    global http_client
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(60.0, connect=10.0, pool=HTTP_POOL_TIMEOUT),
+        event_hooks={'request': [_on_upstream_request], 'response': [_on_upstream_response]},
+    )
+    await result_cache.load()
+    await job_manager.start()
+    await result_mirror.start()
+    if LOCAL_ENGINE_ENABLED:
+        await local_engine_pool.start()
+    await asyncio.to_thread(warm_imports)
+    if UPSTREAM_PREWARM_ENABLED:
+        await connection_warmer.start()
+    lag_monitor = None
+    if EVENT_LOOP_LAG_INTERVAL > 0:
+        lag_monitor = asyncio.create_task(monitor_event_loop_lag(EVENT_LOOP_LAG_INTERVAL))
+    try:
+        yield
+    finally:
+        if lag_monitor is not None:
+            lag_monitor.cancel()
+        await connection_warmer.stop()
+        await result_mirror.stop()
+        await local_engine_pool.stop()
+        await job_manager.stop()
+        admission.store.close()
+        await http_client.aclose()
+        http_client = None
+
+# ============================================================================
+# 5. FastAPI 应用初始化
 # ============================================================================
 app = FastAPI(
     title="AI Background Remover API",
     description="使用 302.AI 的 Removebg-V2 服务去除图片背景",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+class RequestTooLarge(HTTPException):
+    """请求体在接收过程中超过上限"""
+
+    def __init__(self, limit: int):
+        super().__init__(status_code=413, detail=f'Request body too large. Max size is {limit // (1024 * 1024)}MB')
+
+
+def upload_body_limit(path: str) -> Optional[int]:
+    """返回上传端点的请求体上限（字节），非上传端点返回 None"""
+    if path in ('/api/remove-background', '/api/jobs/remove-background'):
+        return REMOVEBG_MAX_SIZE + UPLOAD_MULTIPART_OVERHEAD
+    if path in ('/api/dewatermark', '/api/jobs/dewatermark'):
+        return DEWATERMARK_UPLOAD_MAX_SIZE + UPLOAD_MULTIPART_OVERHEAD
+    if path in ('/api/pipeline', '/api/jobs/pipeline'):
+        return DEWATERMARK_MAX_SIZE + UPLOAD_MULTIPART_OVERHEAD
+    if path.startswith('/api/batch/'):
+        return BATCH_MAX_BODY_BYTES
+    return None
+
+
+class UploadSizeLimitMiddleware:
+    """
+    上传大小限制中间件（纯 ASGI）
+
+    - Content-Length 超限: 不读取请求体，直接返回 413
+    - 分块传输（无 Content-Length）: 边接收边计数，超限时立即中止解析并返回 413
+    这样超大上传不会先被完整写入临时文件再被拒绝。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST':
+            await self.app(scope, receive, send)
+            return
+
+        limit = upload_body_limit(scope['path'])
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope['headers']:
+            if name == b'content-length':
+                try:
+                    too_large = int(value) > limit
+                except ValueError:
+                    too_large = False
+                if too_large:
+                    response = JSONResponse(
+                        {'detail': RequestTooLarge(limit).detail},
+                        status_code=413,
+                        headers={'Connection': 'close'}
+                    )
+                    await response(scope, receive, send)
+                    return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    # HTTPException 子类: FastAPI 解析表单时会原样抛出，最终返回 413
+                    raise RequestTooLarge(limit)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def client_ip(scope) -> str:
+    """客户端 IP（ADMISSION_TRUST_FORWARDED 时取 X-Forwarded-For 的第一个地址）"""
+    if ADMISSION_TRUST_FORWARDED:
+        for name, value in scope['headers']:
+            if name == b'x-forwarded-for':
+                return value.decode('latin-1').split(',')[0].strip()
+    client = scope.get('client')
+    return client[0] if client else 'unknown'
+
+
+class AdmissionMiddleware:
+    """
+    客户端配额中间件（纯 ASGI）
+
+    只检查处理类端点（上传图片的 POST 请求），配额用尽时不读取请求体，直接返回 429
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (not ADMISSION_ENABLED or scope['type'] != 'http' or scope['method'] != 'POST'
+                or upload_body_limit(scope['path']) is None):
+            await self.app(scope, receive, send)
+            return
+
+        api_key = None
+        for name, value in scope['headers']:
+            if name == b'x-api-key':
+                api_key = value.decode('latin-1')
+        retry_after = await admission.check_client(client_ip(scope), api_key)
+        if retry_after is not None:
+            response = JSONResponse(
+                {'detail': 'Too many requests, please try again later'},
+                status_code=429,
+                headers={'Retry-After': str(max(1, math.ceil(retry_after)))}
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+# 先添加的中间件在内层: CORS 包在外面，413 / 429 响应也带 CORS 头；指标中间件在最外层
+app.add_middleware(UploadSizeLimitMiddleware)
+app.add_middleware(AdmissionMiddleware)
+
 # CORS 配置 - 允许跨域请求
 app.add_middleware(
     CORSMiddleware,
@@ -50,30 +892,3560 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Cache", "X-Job-Id", "X-Session-Id", "X-Masks-Url", "Retry-After"],
 )
+app.add_middleware(RequestMetricsMiddleware)
 
 # ============================================================================
-# 3. 配置
+# 6. 初始化：确保静态目录存在
 # ============================================================================
-# 302.AI API 密钥（去背景）
-# 获取地址: https://302.ai
-AI302_API_KEY = os.getenv('AI302_API_KEY')
+RESULTS_DIR = os.path.join('static', 'results')
+os.makedirs(RESULTS_DIR, exist_ok=True)
 
-# dewatermark.ai API 密钥（去水印）
-# 获取地址: https://platform.dewatermark.ai
-DEWATERMARK_API_KEY = os.getenv('DEWATERMARK_API_KEY')
+# 静态文件目录在 API 路由之后挂载（/static/results/{name} 由带缓存头的路由处理）
 
 # ============================================================================
-# 4. 初始化：确保静态目录存在
+# 7. 结果缓存（内存 LRU + 磁盘两级）
 # ============================================================================
-RESULTS_DIR = os.path.join('static', 'results')
-os.makedirs(RESULTS_DIR, exist_ok=True)
+CACHE_DIR = os.path.join(RESULTS_DIR, 'cache')
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+
+def make_cache_key(operation: str, image_data: bytes, params: Optional[Dict[str, Any]] = None) -> str:
+    """
+    生成内容寻址的缓存键
+    由操作名、参数（排序后的 JSON）和图片字节共同决定
+    """
+    digest = hashlib.sha256()
+    digest.update(operation.encode('utf-8'))
+    digest.update(b'\n')
+    digest.update(json.dumps(params or {}, sort_keys=True).encode('utf-8'))
+    digest.update(b'\n')
+    digest.update(image_data)
+    return digest.hexdigest()
+
+
+def payload_bytes(value: Any) -> int:
+    """
+    估算结果占用的内存（只统计字符串 / 字节内容，Base64 图片占绝大部分）
+
+    只读取长度、不做序列化，在事件循环中调用也是 O(字段数)
+    """
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(payload_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_bytes(item) for item in value)
+    return 0
+
+
+class ResultCache:
+    """
+    两级结果缓存
+
+    - 内存层: OrderedDict 实现的 LRU，按条目数和字节数双重限制
+    - 磁盘层: 每个结果一个 JSON 文件，总大小超限时按最近使用时间淘汰
+    - 两层都带 TTL，过期条目在访问或淘汰时删除
+    - 磁盘读写通过 asyncio.to_thread 执行，不阻塞事件循环
+    """
+
+    def __init__(self, directory: str, ttl: float, max_entries: int,
+                 max_memory_bytes: int, max_disk_bytes: int):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        # key -> (过期时间, 字节数, 结果)
+        self._memory: 'OrderedDict[str, Tuple[float, int, Dict[str, Any]]]' = OrderedDict()
+        self._memory_bytes = 0
+        # key -> 文件字节数（按最近使用排序）
+        self._disk: 'OrderedDict[str, int]' = OrderedDict()
+        self._disk_bytes = 0
+        self.counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'sets': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+        }
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+    async def load(self):
+        """启动时扫描磁盘层，重建索引并清理过期文件"""
+        entries = await asyncio.to_thread(self._scan_disk)
+        self._disk.clear()
+        self._disk_bytes = 0
+        for key, size in entries:
+            self._disk[key] = size
+            self._disk_bytes += size
+        await self._evict_disk()
+
+    def _scan_disk(self):
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                self._remove_file(path)
+                continue
+            entries.append((stat.st_mtime, name[:-len('.json')], stat.st_size))
+        entries.sort()
+        return [(key, size) for _, key, size in entries]
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """查询缓存，依次检查内存层和磁盘层"""
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, size, value = entry
+            if expires_at > now:
+                self._memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return value
+            self._drop_memory(key)
+            self.counters['expirations'] += 1
+
+        if key in self._disk:
+            record = await asyncio.to_thread(self._read_disk, key)
+            if record is not None and record['expires_at'] > now:
+                self._disk.move_to_end(key)
+                self._put_memory(key, record['value'], record['expires_at'])
+                self.counters['disk_hits'] += 1
+                return record['value']
+            self._drop_disk_index(key)
+            await asyncio.to_thread(self._remove_file, self._path(key))
+            self.counters['expirations'] += 1
+
+        self.counters['misses'] += 1
+        return None
+
+    async def set(self, key: str, value: Dict[str, Any]):
+        """写入缓存（内存层 + 磁盘层）"""
+        expires_at = time.time() + self.ttl
+        self._put_memory(key, value, expires_at)
+        size = await asyncio.to_thread(self._write_disk, key, value, expires_at)
+        if size is not None:
+            self._drop_disk_index(key)
+            self._disk[key] = size
+            self._disk_bytes += size
+            await self._evict_disk()
+        self.counters['sets'] += 1
+
+    async def delete(self, key: str):
+        """作废一个条目（例如它引用的结果文件已被清理）"""
+        self._drop_memory(key)
+        if key in self._disk:
+            self._drop_disk_index(key)
+            await asyncio.to_thread(self._remove_file, self._path(key))
+        self.counters['invalidations'] += 1
+
+    def _put_memory(self, key: str, value: Dict[str, Any], expires_at: float):
+        size = payload_bytes(value)
+        if size > self.max_memory_bytes:
+            return
+        self._drop_memory(key)
+        self._memory[key] = (expires_at, size, value)
+        self._memory_bytes += size
+        while self._memory and (len(self._memory) > self.max_entries
+                                or self._memory_bytes > self.max_memory_bytes):
+            oldest = next(iter(self._memory))
+            self._drop_memory(oldest)
+            self.counters['evictions'] += 1
+
+    def _drop_memory(self, key: str):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= entry[1]
+
+    def _drop_disk_index(self, key: str):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            os.utime(path)
+            return record
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key: str, value: Dict[str, Any], expires_at: float) -> Optional[int]:
+        path = self._path(key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'expires_at': expires_at, 'value': value}, f)
+            os.replace(tmp_path, path)
+            return os.path.getsize(path)
+        except OSError as e:
+            logger.warning('缓存写入磁盘失败', extra={'cache_key': key, 'error': str(e)})
+            self._remove_file(tmp_path)
+            return None
+
+    async def _evict_disk(self):
+        # 索引在事件循环中更新，只把删除文件交给线程池
+        victims = []
+        while self._disk and self._disk_bytes > self.max_disk_bytes:
+            oldest, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            victims.append(self._path(oldest))
+            self.counters['evictions'] += 1
+        for path in victims:
+            await asyncio.to_thread(self._remove_file, path)
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.counters['memory_hits'] + self.counters['disk_hits']
+        lookups = hits + self.counters['misses']
+        return {
+            **self.counters,
+            'hit_ratio': round(hits / lookups, 4) if lookups else 0.0,
+            'memory_entries': len(self._memory),
+            'memory_bytes': self._memory_bytes,
+            'disk_entries': len(self._disk),
+            'disk_bytes': self._disk_bytes,
+        }
+
+
+result_cache = ResultCache(
+    CACHE_DIR,
+    ttl=CACHE_TTL_SECONDS,
+    max_entries=CACHE_MEMORY_MAX_ENTRIES,
+    max_memory_bytes=CACHE_MEMORY_MAX_BYTES,
+    max_disk_bytes=CACHE_DISK_MAX_BYTES,
+)
+
+
+# ============================================================================
+# 8. 请求合并（single-flight）
+# ============================================================================
+
+class _InflightCall:
+    """
+    一次正在进行的共享上游调用
+
+    共享任务在独立的上下文中运行：不继承发起者的任务（进度发给所有等待中的任务），
+    截止时间取所有等待者中最晚的一个，优先级取最高的一个（有等待者加入时更新）
+    """
+
+    def __init__(self, deadline: Optional[float], priority: int):
+        # 上游请求的超时按共享截止时间计算，发出后无法再延长；发起者的截止时间很短时，
+        # 后加入的等待者会被连带超时，所以至少给出默认的请求时限（所有等待者离开时共享调用会被取消）
+        if deadline is not None:
+            deadline = max(deadline, time.monotonic() + REQUEST_DEADLINE_SECONDS)
+        self.deadline = deadline
+        self.priority = priority
+        self.waiters = 0
+        self.jobs: set = set()
+        self.context = contextvars.copy_context()
+        self.context.run(self._isolate)
+        self.task: Optional[asyncio.Task] = None
+
+    def _isolate(self):
+        current_job.set(None)
+        current_call.set(self)
+
+    def join(self, deadline: Optional[float], priority: int):
+        """新等待者加入：截止时间延长到最晚的等待者（None = 不限），优先级取较高者"""
+        if self.deadline is not None and (deadline is None or deadline > self.deadline):
+            self.deadline = deadline
+        self.priority = min(self.priority, priority)
+
+
+# 当前协程所在的共享调用（只在 single-flight 的共享任务及其子任务中有值）
+# 子任务会复制上下文，所以截止时间 / 优先级从调用对象上实时读取（见 current_deadline / current_priority）
+current_call: 'contextvars.ContextVar[Optional[_InflightCall]]' = contextvars.ContextVar('current_call', default=None)
+
+
+class SingleFlight:
+    """
+    相同请求合并器
+
+    同一个 key 同时只运行一个上游调用，其余请求等待并共享结果或异常。
+    每个等待者按自己的截止时间等待（超时返回 504，不影响其他等待者）；
+    单个等待者被取消时不会影响共享调用；只有最后一个等待者离开时才取消它。
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _InflightCall] = {}
+        self.counters = {
+            'leaders': 0,
+            'coalesced': 0,
+            'abandoned': 0,
+        }
+
+    def inflight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        执行（或加入）key 对应的调用
+
+        返回:
+            (结果, 是否加入了他人发起的调用)
+        """
+        deadline = current_deadline()
+        priority = current_priority()
+        job = current_job.get()
+        call = self._calls.get(key)
+        shared = call is not None
+        if call is None:
+            call = _InflightCall(deadline, priority)
+            call.task = asyncio.create_task(fn(), context=call.context)
+            self._calls[key] = call
+            call.task.add_done_callback(lambda task: self._finish(key, call))
+            self.counters['leaders'] += 1
+        else:
+            call.join(deadline, priority)
+            self.counters['coalesced'] += 1
+
+        call.waiters += 1
+        if job is not None:
+            call.jobs.add(job)
+        try:
+            # shield: 当前等待者超时 / 被取消不会连带取消共享任务
+            timeout = None if deadline is None else deadline - time.monotonic()
+            try:
+                return await asyncio.wait_for(asyncio.shield(call.task), timeout=timeout), shared
+            except asyncio.TimeoutError:
+                if call.task.done():
+                    raise
+                raise deadline_exceeded()
+        finally:
+            call.waiters -= 1
+            call.jobs.discard(job)
+            if call.waiters == 0 and not call.task.done():
+                # 已经没有人等待结果，放弃上游调用
+                self._calls.pop(key, None)
+                call.task.cancel()
+                self.counters['abandoned'] += 1
+
+    def _finish(self, key: str, call: _InflightCall):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # 读取异常，避免所有等待者都已离开时出现 "exception was never retrieved"
+        if not call.task.cancelled():
+            call.task.exception()
+
+
+singleflight = SingleFlight()
+
+
+async def cached_call(operation: str, image_data: bytes, params: Dict[str, Any],
+                      compute: Callable[[], Awaitable[Dict[str, Any]]]) -> Tuple[Dict[str, Any], str]:
+    """
+    带缓存和请求合并地执行一次上游处理
+
+    返回:
+        (结果, 缓存状态)；缓存状态为 HIT / MISS / COALESCED，
+        只有成功的结果会被缓存
+    """
+    # 大图的哈希计算放到线程中（hashlib 会释放 GIL）
+    if len(image_data) > 1024 * 1024:
+        cache_key = await asyncio.to_thread(make_cache_key, operation, image_data, params)
+    else:
+        cache_key = make_cache_key(operation, image_data, params)
+
+    if CACHE_ENABLED:
+        cached = await result_cache.get(cache_key)
+        if cached is not None and not await result_mirror.retain(cached):
+            # 引用的结果文件已被清理，缓存的 URL 会 404，作废后重新计算
+            await result_cache.delete(cache_key)
+            cached = None
+        if cached is not None:
+            CACHE_LOOKUPS.labels(operation, 'hit').inc()
+            logger.info('命中缓存', extra={'operation': operation, 'cache_key': cache_key[:12]})
+            return cached, 'HIT'
+
+    async def compute_and_store() -> Dict[str, Any]:
+        result = await compute()
+        if CACHE_ENABLED:
+            await result_cache.set(cache_key, result)
+        return result
+
+    result, shared = await singleflight.do(cache_key, compute_and_store)
+    CACHE_LOOKUPS.labels(operation, 'coalesced' if shared else 'miss').inc()
+    if shared:
+        logger.info('合并到进行中的请求', extra={'operation': operation, 'cache_key': cache_key[:12]})
+    return result, 'COALESCED' if shared else 'MISS'
+
+# ============================================================================
+# 9. 图像预处理与后处理（缩小上传 + 全分辨率 alpha 重建 + 裁剪 / 多尺寸输出）
+# ============================================================================
+# 开启 REMOVEBG_DOWNSCALE_MAX_EDGE 后:
+# 1. 原图长边超过阈值时，只把缩小后的副本发给 302.AI（传输量大幅减少）
+# 2. 取回抠图结果的 alpha 通道，放大到原图尺寸并做边缘细化
+# 3. 用 NumPy 把 alpha 合成到原图的全分辨率像素上，结果保存到 static/results
+
+class DownscaledImage:
+    """缩小后用于上传的图片副本"""
+
+    def __init__(self, data: bytes, content_type: str,
+                 original_size: Tuple[int, int], sent_size: Tuple[int, int]):
+        self.data = data
+        self.content_type = content_type
+        self.original_size = original_size
+        self.sent_size = sent_size
+
+
+# EXIF 方向值为 5-8 时图片需要旋转 90°，宽高互换
+_EXIF_ORIENTATION_TAG = 0x0112
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def downscale_for_upload(image_data: bytes, max_edge: int) -> Optional[DownscaledImage]:
+    """
+    把图片缩小到长边不超过 max_edge
+
+    返回:
+        DownscaledImage；图片本身不超过阈值时返回 None（直接上传原图）
+    """
+    with Image.open(BytesIO(image_data)) as img:
+        raw_width, raw_height = img.size
+        if max(raw_width, raw_height) <= max_edge:
+            return None
+
+        scale = max_edge / max(raw_width, raw_height)
+        # JPEG 可以在解码阶段直接按 1/2、1/4、1/8 缩小，省去大部分解码开销
+        img.draft('RGB', (math.ceil(raw_width * scale), math.ceil(raw_height * scale)))
+
+        orientation = img.getexif().get(_EXIF_ORIENTATION_TAG, 1)
+        oriented = ImageOps.exif_transpose(img)
+        if orientation in _TRANSPOSED_ORIENTATIONS:
+            original_size = (raw_height, raw_width)
+        else:
+            original_size = (raw_width, raw_height)
+
+        sent_size = (max(1, round(original_size[0] * scale)), max(1, round(original_size[1] * scale)))
+        has_alpha = oriented.mode in ('RGBA', 'LA', 'PA') or 'transparency' in oriented.info
+        small = oriented.convert('RGBA' if has_alpha else 'RGB').resize(sent_size, Image.LANCZOS)
+
+    buffer = BytesIO()
+    if has_alpha:
+        small.save(buffer, 'PNG')
+        content_type = 'image/png'
+    else:
+        small.save(buffer, 'JPEG', quality=REMOVEBG_DOWNSCALE_QUALITY)
+        content_type = 'image/jpeg'
+    return DownscaledImage(buffer.getvalue(), content_type, original_size, sent_size)
+
+
+def refine_alpha(alpha: 'np.ndarray') -> 'np.ndarray':
+    """
+    细化放大后的 alpha 通道
+
+    放大会让边缘变宽变虚：把接近 0/1 的值吸附到纯透明/纯不透明，
+    中间过渡区用 smoothstep 收紧，保留发丝等半透明细节。
+    """
+    low, high = REMOVEBG_ALPHA_REFINE_RANGE
+    a = alpha.astype(np.float32)
+    a *= 1.0 / 255.0
+    a -= low
+    a *= 1.0 / (high - low)
+    np.clip(a, 0.0, 1.0, out=a)
+    # smoothstep: 3a² - 2a³
+    a *= a * (3.0 - 2.0 * a)
+    a *= 255.0
+    a += 0.5
+    return a.astype(np.uint8)
+
+
+def reconstruct_full_resolution(image_data: bytes, cutout_data: bytes) -> bytes:
+    """
+    把低分辨率抠图结果的 alpha 应用到原图全分辨率像素上
+
+    返回:
+        RGBA PNG 字节
+    """
+    with Image.open(BytesIO(image_data)) as img:
+        original = ImageOps.exif_transpose(img).convert('RGB')
+
+    with Image.open(BytesIO(cutout_data)) as cutout:
+        if 'A' not in cutout.getbands():
+            raise ValueError('Cutout has no alpha channel')
+        alpha = cutout.getchannel('A')
+
+    alpha = alpha.resize(original.size, Image.BICUBIC)
+    rgba = np.empty((original.height, original.width, 4), dtype=np.uint8)
+    rgba[..., :3] = np.asarray(original)
+    rgba[..., 3] = refine_alpha(np.asarray(alpha))
+
+    buffer = BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buffer, 'PNG', compress_level=REMOVEBG_PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+
+def result_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def result_file_name(data: bytes, suffix: str = 'removebg', ext: str = 'png') -> str:
+    """
+    按结果内容哈希生成文件名
+
+    同名文件的内容必然相同（重新计算出不同结果时写入新文件，不覆盖旧文件），
+    因此 /static/results 可以返回 immutable 缓存头
+    """
+    return f'{result_digest(data)}_{suffix}.{ext}'
+
+
+def save_result_file(data: bytes, name: str) -> str:
+    """把结果写入 static/results（先写临时文件再原子替换），返回可访问的 URL 路径"""
+    path = os.path.join(RESULTS_DIR, name)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return f'/static/results/{name}'
+
+
+async def restore_full_resolution(image_data: bytes, downscaled: DownscaledImage,
+                                  cutout_url: str) -> Optional[str]:
+    """
+    下载 302.AI 返回的低分辨率抠图，重建全分辨率结果并保存
+
+    返回:
+        本地结果 URL；任何一步失败时返回 None（调用方退回使用 302.AI 的 URL）
+    """
+    report_progress('reconstructing', original_size=list(downscaled.original_size))
+    try:
+        response = await get_http_client().get(cutout_url, timeout=upstream_timeout(60.0))
+        response.raise_for_status()
+        png_data = await asyncio.to_thread(reconstruct_full_resolution, image_data, response.content)
+        name = await asyncio.to_thread(result_file_name, png_data)
+        url = await asyncio.to_thread(save_result_file, png_data, name)
+        logger.info('全分辨率结果已重建', extra={
+            'original_size': list(downscaled.original_size), 'bytes': len(png_data)
+        })
+        return url
+    except Exception as e:
+        logger.warning('全分辨率重建失败，返回低分辨率结果', extra={'error': str(e)})
+        return None
+
+
+# 输出后处理（POSTPROCESS_ENABLED）:
+# 1. 取回去背景结果，按 alpha 包围盒裁掉透明边缘（NumPy 向量化）
+# 2. 按 POSTPROCESS_RENDITIONS 缩放出多个尺寸，每个尺寸编码为 POSTPROCESS_FORMATS 中的每种格式
+# 3. 缩放和编码在专用线程池中并行执行（Pillow 在缩放 / 编码时释放 GIL），文件保存到 static/results
+# 结果中附带 renditions，客户端用 ?rendition=&format= 选择 processed_url 指向的文件
+
+POSTPROCESS_ENCODERS = {
+    'webp': ('WEBP', {'quality': POSTPROCESS_WEBP_QUALITY, 'method': 4}),
+    'avif': ('AVIF', {'quality': POSTPROCESS_AVIF_QUALITY, 'speed': 6}),
+    'png': ('PNG', {'optimize': True}),
+}
+
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+if POSTPROCESS_ENABLED and 'avif' in POSTPROCESS_FORMATS:
+    # Pillow 11.3 起内置 AVIF；更早的版本需要安装 pillow-avif-plugin
+    try:
+        import pillow_avif  # noqa: F401
+    except ImportError:
+        pass
+    Image.init()
+    if 'AVIF' not in Image.SAVE:
+        logger.warning('当前 Pillow 不支持 AVIF 编码，已忽略 avif 输出格式')
+        POSTPROCESS_FORMATS = [fmt for fmt in POSTPROCESS_FORMATS if fmt != 'avif']
+# 配置为空或全部无效时使用默认值（否则 ?rendition= / ?format= 的默认选择无从取值）
+if not POSTPROCESS_RENDITIONS:
+    if POSTPROCESS_ENABLED:
+        logger.warning('POSTPROCESS_RENDITIONS 为空或无效，使用默认尺寸', extra={
+            'renditions': POSTPROCESS_DEFAULT_RENDITIONS
+        })
+    POSTPROCESS_RENDITIONS = parse_renditions(POSTPROCESS_DEFAULT_RENDITIONS)
+unsupported_formats = [fmt for fmt in POSTPROCESS_FORMATS if fmt not in POSTPROCESS_ENCODERS]
+POSTPROCESS_FORMATS = [fmt for fmt in POSTPROCESS_FORMATS if fmt in POSTPROCESS_ENCODERS]
+if not POSTPROCESS_FORMATS:
+    POSTPROCESS_FORMATS = [fmt for fmt in parse_formats(POSTPROCESS_DEFAULT_FORMATS) if fmt in POSTPROCESS_ENCODERS]
+    if POSTPROCESS_ENABLED:
+        logger.warning('POSTPROCESS_FORMATS 为空或无效，使用默认格式', extra={
+            'ignored': unsupported_formats, 'formats': POSTPROCESS_FORMATS
+        })
+elif unsupported_formats and POSTPROCESS_ENABLED:
+    logger.warning('忽略不支持的输出格式', extra={'ignored': unsupported_formats})
+
+postprocess_executor = ThreadPoolExecutor(max_workers=max(1, POSTPROCESS_WORKERS), thread_name_prefix='postprocess')
+
+
+def alpha_bbox(alpha: np.ndarray, threshold: int, padding: int) -> Optional[Tuple[int, int, int, int]]:
+    """alpha 通道中内容区域的包围盒 (x0, y0, x1, y1)，全透明时返回 None"""
+    content = alpha > threshold
+    rows = np.flatnonzero(content.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(content.any(axis=0))
+    height, width = alpha.shape
+    return (
+        max(0, int(cols[0]) - padding), max(0, int(rows[0]) - padding),
+        min(width, int(cols[-1]) + 1 + padding), min(height, int(rows[-1]) + 1 + padding),
+    )
+
+
+def trim_cutout(png_data: bytes) -> Tuple[Image.Image, Tuple[int, int, int, int], Tuple[int, int]]:
+    """解码抠图结果并裁掉透明边缘，返回 (裁剪后的 RGBA 图像, 裁剪框, 原尺寸)"""
+    with Image.open(BytesIO(png_data)) as img:
+        image = img.convert('RGBA')
+    width, height = image.size
+    box = (0, 0, width, height)
+    if POSTPROCESS_TRIM:
+        box = alpha_bbox(np.asarray(image.getchannel('A')), POSTPROCESS_ALPHA_THRESHOLD, POSTPROCESS_TRIM_PADDING) or box
+    if box != (0, 0, width, height):
+        image = image.crop(box)
+    return image, box, (width, height)
+
+
+def resize_rendition(image: Image.Image, max_edge: int) -> Image.Image:
+    if max_edge <= 0 or max(image.size) <= max_edge:
+        return image
+    scaled = image.copy()
+    scaled.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    return scaled
+
+
+def encode_rendition(image: Image.Image, fmt: str, rendition: str) -> Tuple[str, int]:
+    """编码并保存一个结果文件（按编码后的内容命名），返回 (URL, 字节数)"""
+    pil_format, options = POSTPROCESS_ENCODERS[fmt]
+    buffer = BytesIO()
+    image.save(buffer, pil_format, **options)
+    data = buffer.getvalue()
+    return save_result_file(data, result_file_name(data, f'removebg-{rendition}', fmt)), len(data)
+
+
+async def load_cutout(result: Dict[str, Any]) -> bytes:
+    """读取去背景结果图片：本地文件直接读取，否则从上游下载"""
+    url = result['processed_url']
+    if url.startswith('/static/results/'):
+        path = await asyncio.to_thread(result_mirror.local_path, url)
+        if path:
+            with observe_stage('remove-background', 'postprocess_read'):
+                return await asyncio.to_thread(_read_file, path)
+        # 镜像下载尚未完成，直接从上游读取
+        url = result.get('upstream_url') or ''
+    if not url.startswith(('http://', 'https://')):
+        raise ValueError(f'Unsupported result url: {url}')
+    response = await get_http_client().get(url, timeout=upstream_timeout(60.0))
+    response.raise_for_status()
+    return response.content
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def postprocess_cutout(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    裁剪去背景结果并生成多尺寸 / 多格式文件
+
+    返回:
+        附带 trim_box / source_size / renditions 的结果；任何一步失败时原样返回（不影响主流程）
+    """
+    if not result.get('processed_url'):
+        return result
+    report_progress('postprocessing', renditions=list(POSTPROCESS_RENDITIONS), formats=POSTPROCESS_FORMATS)
+    loop = asyncio.get_running_loop()
+    try:
+        png_data = await load_cutout(result)
+        with observe_stage('remove-background', 'postprocess'):
+            image, box, source_size = await loop.run_in_executor(postprocess_executor, trim_cutout, png_data)
+            del png_data
+
+            names = list(POSTPROCESS_RENDITIONS)
+            scaled = await asyncio.gather(*[
+                loop.run_in_executor(postprocess_executor, resize_rendition, image, POSTPROCESS_RENDITIONS[name])
+                for name in names
+            ])
+            # 裁剪后的图片已小于长边上限时多个尺寸是同一张图，只编码一次
+            first_index = {}
+            sources = [first_index.setdefault(id(item), index) for index, item in enumerate(scaled)]
+            jobs = [(index, fmt) for index in sorted(set(sources)) for fmt in POSTPROCESS_FORMATS]
+            encoded = await asyncio.gather(*[
+                loop.run_in_executor(
+                    postprocess_executor, encode_rendition, scaled[index], fmt, names[index]
+                )
+                for index, fmt in jobs
+            ])
+    except Exception as e:
+        logger.warning('结果后处理失败，返回原结果', extra={'error': str(e)})
+        return result
+
+    renditions: Dict[str, Any] = {
+        name: {'width': scaled[index].width, 'height': scaled[index].height, 'formats': {}}
+        for index, name in enumerate(names)
+    }
+    files = {job: {'url': url, 'bytes': size} for job, (url, size) in zip(jobs, encoded)}
+    for index, name in enumerate(names):
+        for fmt in POSTPROCESS_FORMATS:
+            renditions[name]['formats'][fmt] = files[(sources[index], fmt)]
+    logger.info('结果后处理完成', extra={
+        'source_size': list(source_size), 'trim_box': list(box),
+        'bytes': {name: {fmt: item['bytes'] for fmt, item in entry['formats'].items()} for name, entry in renditions.items()}
+    })
+    return {**result, 'trim_box': list(box), 'source_size': list(source_size), 'renditions': renditions}
+
+
+def parse_rendition_query(rendition: Optional[str], output_format: Optional[str]) -> Dict[str, str]:
+    """校验 ?rendition= / ?format= 参数，返回放入任务 params 的选择"""
+    if rendition is None and output_format is None:
+        return {}
+    if not POSTPROCESS_ENABLED:
+        raise HTTPException(status_code=400, detail='Renditions are not enabled on this server')
+    # 只指定格式时使用最后一个（通常是 full）尺寸
+    rendition = rendition or list(POSTPROCESS_RENDITIONS)[-1]
+    output_format = (output_format or POSTPROCESS_FORMATS[0]).lower()
+    if rendition not in POSTPROCESS_RENDITIONS:
+        raise HTTPException(status_code=400, detail=f'Unknown rendition: {rendition}. '
+                                                    f'Available: {", ".join(POSTPROCESS_RENDITIONS)}')
+    if output_format not in POSTPROCESS_FORMATS:
+        raise HTTPException(status_code=400, detail=f'Unsupported format: {output_format}. '
+                                                    f'Available: {", ".join(POSTPROCESS_FORMATS)}')
+    return {'rendition': rendition, 'format': output_format}
+
+
+def select_rendition(result: Dict[str, Any], params: Dict[str, Any]) -> Dict[str, Any]:
+    """按请求选择的尺寸 / 格式改写 processed_url（后处理失败时保留原结果）"""
+    rendition = params.get('rendition')
+    entry = (result.get('renditions') or {}).get(rendition, {}).get('formats', {}).get(params.get('format'))
+    if entry is None:
+        return result
+    return {**result, 'processed_url': entry['url'], 'rendition': rendition, 'format': params['format']}
+
+# ============================================================================
+# 10. 结果本地镜像（后台流式下载 + 容量受限的清理任务）
+# ============================================================================
+# 302.AI 返回的结果 URL 没有缓存头且会过期。开启 RESULT_MIRROR_ENABLED 后：
+# 1. 立即返回本地镜像 URL（/static/results/mirror/<上游 URL 哈希>.png），同时在后台流式下载结果
+# 2. 镜像记录（上游 URL -> 内容文件名）保存在 static/results/mirror/ 下，所有 worker 共享：
+#    下载完成前（或文件已被清理、下载失败）访问镜像 URL 会 307 重定向到 302.AI，完成后由本服务（或 CDN）直接返回
+# 3. 下载的文件按内容哈希命名，同一结果经不同上游 URL 返回时只保存一份
+# 4. 清理任务定期把 static/results 控制在 RESULTS_MAX_BYTES 以内；
+#    缓存命中时会刷新结果文件的访问时间，文件已被清理的缓存条目作废后重新计算（见 cached_call）
+MIRROR_DIR = os.path.join(RESULTS_DIR, 'mirror')
+os.makedirs(MIRROR_DIR, exist_ok=True)
+
+
+class ResultMirror:
+    """
+    结果镜像与清理
+
+    - pending: 本进程正在下载的镜像 key -> 上游 URL（只用于避免重复下载，跨 worker 的状态以镜像记录为准）
+    - last_access: 文件名 -> 最近访问时间（清理时优先删除最久未访问的文件）
+    """
+
+    STALE_TMP_SECONDS = 3600
+    # 镜像记录很小，保留时间远长于缓存有效期，客户端手里的镜像 URL 在此期间都能访问或重定向
+    RECORD_TTL_SECONDS = 7 * 86400
+
+    def __init__(self, directory: str, records_directory: str, max_bytes: int, interval: float):
+        self.directory = directory
+        self.records_directory = records_directory
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.pending: Dict[str, str] = {}
+        self.last_access: Dict[str, float] = {}
+        self.counters = {
+            'scheduled': 0, 'fetched': 0, 'deduplicated': 0, 'failed': 0, 'evicted': 0, 'evicted_bytes': 0
+        }
+        self._fetches: set = set()
+        self._janitor: Optional[asyncio.Task] = None
+
+    def path_for(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def touch(self, name: str):
+        self.last_access[name] = time.time()
+
+    @staticmethod
+    def mirror_key(upstream_url: str) -> str:
+        return result_digest(upstream_url.encode())
+
+    def read_record(self, key: str) -> Optional[Dict[str, Any]]:
+        """读取镜像记录 {'source': 上游 URL, 'name': 内容文件名或 None}，不存在时返回 None"""
+        try:
+            with open(os.path.join(self.records_directory, f'{key}.json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_record(self, key: str, record: Dict[str, Any]):
+        path = os.path.join(self.records_directory, f'{key}.json')
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    def local_path(self, url: str) -> Optional[str]:
+        """本地结果 URL 对应的已落盘文件路径（镜像未下载完成或文件已被清理时返回 None）"""
+        if url.startswith('/static/results/mirror/'):
+            record = self.read_record(os.path.splitext(os.path.basename(url))[0])
+            name = record.get('name') if record else None
+        elif url.startswith('/static/results/'):
+            name = os.path.basename(url)
+        else:
+            name = None
+        if name and os.path.exists(self.path_for(name)):
+            return self.path_for(name)
+        return None
+
+    @classmethod
+    def local_urls(cls, value: Any) -> List[str]:
+        """结果中引用的本地结果 URL（processed_url / renditions 中的 /static/results/...）"""
+        if isinstance(value, str):
+            return [value] if value.startswith('/static/results/') else []
+        if isinstance(value, dict):
+            return [url for item in value.values() for url in cls.local_urls(item)]
+        if isinstance(value, list):
+            return [url for item in value for url in cls.local_urls(item)]
+        return []
+
+    def _resolve_names(self, urls: List[str]) -> Optional[List[str]]:
+        """
+        返回 URL 引用的、已落盘的文件名；有文件已被清理时返回 None
+
+        镜像尚未下载完成（或下载失败）的 URL 会重定向到上游，仍视为可用
+        """
+        names = []
+        for url in urls:
+            if url.startswith('/static/results/mirror/'):
+                record = self.read_record(os.path.splitext(os.path.basename(url))[0])
+                if record is None:
+                    return None
+                name = record.get('name')
+                if not name:
+                    continue
+            else:
+                name = os.path.basename(url)
+            if not os.path.exists(self.path_for(name)):
+                return None
+            names.append(name)
+        return names
+
+    async def retain(self, result: Dict[str, Any]) -> bool:
+        """
+        缓存命中时检查结果引用的本地文件是否仍然存在（或正在下载），并刷新访问时间，
+        避免清理任务删除刚返回给客户端的文件
+
+        返回:
+            False 表示有文件已被清理，该缓存结果不能再使用
+        """
+        urls = self.local_urls(result)
+        if not urls:
+            return True
+        names = await asyncio.to_thread(self._resolve_names, urls)
+        if names is None:
+            return False
+        for name in names:
+            self.touch(name)
+        return True
+
+    async def schedule(self, upstream_url: str) -> str:
+        """写入镜像记录并在后台开始下载，立即返回本地镜像 URL"""
+        key = self.mirror_key(upstream_url)
+        record = await asyncio.to_thread(self.read_record, key)
+        if record is None:
+            await asyncio.to_thread(self._write_record, key, {'source': upstream_url, 'name': None})
+
+        downloaded = bool(record and record.get('name')) and await asyncio.to_thread(
+            os.path.exists, self.path_for(record['name'])
+        )
+        if not downloaded and key not in self.pending:
+            self.pending[key] = upstream_url
+            self.counters['scheduled'] += 1
+            task = asyncio.create_task(self._fetch(key, upstream_url))
+            self._fetches.add(task)
+            task.add_done_callback(self._fetches.discard)
+        return f'/static/results/mirror/{key}.png'
+
+    async def _fetch(self, key: str, url: str):
+        """流式下载到临时文件并计算内容哈希，完成后原子替换为按内容命名的文件，再更新镜像记录"""
+        tmp_path = self.path_for(f'{key}.{uuid.uuid4().hex}.tmp')
+        hasher = hashlib.sha256()
+        total = 0
+        start_time = time.time()
+        try:
+            async with get_http_client().stream('GET', url, timeout=60) as response:
+                response.raise_for_status()
+                f = await asyncio.to_thread(open, tmp_path, 'wb')
+                try:
+                    async for chunk in response.aiter_bytes(RESULT_STREAM_CHUNK_SIZE):
+                        total += len(chunk)
+                        hasher.update(chunk)
+                        await asyncio.to_thread(f.write, chunk)
+                finally:
+                    await asyncio.to_thread(f.close)
+
+            # 与 result_file_name 相同的命名规则：同名即同内容
+            name = f'{hasher.hexdigest()[:32]}_removebg.png'
+            path = self.path_for(name)
+            if await asyncio.to_thread(os.path.exists, path):
+                await asyncio.to_thread(self._remove, tmp_path)
+                self.counters['deduplicated'] += 1
+            else:
+                await asyncio.to_thread(os.replace, tmp_path, path)
+            await asyncio.to_thread(self._write_record, key, {'source': url, 'name': name})
+            self.touch(name)
+            self.counters['fetched'] += 1
+            RESULT_MIRRORS.labels('fetched').inc()
+            RESULT_MIRROR_BYTES.inc(total)
+            logger.info('结果已镜像到本地', extra={
+                'result_name': name, 'bytes': total, 'elapsed': round(time.time() - start_time, 2)
+            })
+        except asyncio.CancelledError:
+            await asyncio.to_thread(self._remove, tmp_path)
+            raise
+        except Exception as e:
+            await asyncio.to_thread(self._remove, tmp_path)
+            self.counters['failed'] += 1
+            RESULT_MIRRORS.labels('failed').inc()
+            logger.warning('结果镜像下载失败，继续重定向到上游', extra={'mirror_key': key, 'error': str(e)})
+        finally:
+            self.pending.pop(key, None)
+
+    @staticmethod
+    def _remove(path: str) -> int:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except OSError:
+            return 0
+
+    def _prune_records(self):
+        """删除过期的镜像记录（以及残留的临时文件）"""
+        now = time.time()
+        with os.scandir(self.records_directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                ttl = self.STALE_TMP_SECONDS if entry.name.endswith('.tmp') else self.RECORD_TTL_SECONDS
+                if now - entry.stat().st_mtime > ttl:
+                    self._remove(entry.path)
+
+    def _scan(self) -> List[Tuple[str, int, float]]:
+        """列出结果目录下的文件 (文件名, 大小, 最近使用时间)，顺带删除残留的临时文件和过期的镜像记录"""
+        self._prune_records()
+        now = time.time()
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if entry.name.endswith('.tmp'):
+                    if now - stat.st_mtime > self.STALE_TMP_SECONDS:
+                        self._remove(entry.path)
+                    continue
+                used_at = max(stat.st_mtime, self.last_access.get(entry.name, 0))
+                files.append((entry.name, stat.st_size, used_at))
+        return files
+
+    async def sweep(self):
+        """删除最久未访问的结果文件，直到总大小不超过上限"""
+        files = await asyncio.to_thread(self._scan)
+        total = sum(size for _, size, _ in files)
+        if self.max_bytes <= 0 or total <= self.max_bytes:
+            return
+
+        files.sort(key=lambda item: item[2])
+        removed = 0
+        freed = 0
+        for name, size, _ in files:
+            if total <= self.max_bytes:
+                break
+            freed_now = await asyncio.to_thread(self._remove, self.path_for(name))
+            self.last_access.pop(name, None)
+            total -= size
+            freed += freed_now
+            removed += 1
+
+        self.counters['evicted'] += removed
+        self.counters['evicted_bytes'] += freed
+        RESULTS_EVICTED.inc(removed)
+        logger.info('清理结果文件', extra={'count': removed, 'freed_bytes': freed, 'total_bytes': total})
+
+    async def _janitor_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception('结果清理任务异常')
+
+    async def start(self):
+        if self.max_bytes > 0 or RESULT_MIRROR_ENABLED:
+            self._janitor = asyncio.create_task(self._janitor_loop())
+
+    async def stop(self):
+        tasks = list(self._fetches)
+        if self._janitor is not None:
+            tasks.append(self._janitor)
+            self._janitor = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': RESULT_MIRROR_ENABLED,
+            'max_bytes': self.max_bytes,
+            'pending': len(self.pending),
+            **self.counters,
+        }
+
+
+result_mirror = ResultMirror(RESULTS_DIR, MIRROR_DIR, RESULTS_MAX_BYTES, RESULTS_JANITOR_INTERVAL)
+
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单段 Range 请求头（bytes=start-end / bytes=start- / bytes=-suffix）
+
+    返回:
+        (start, end) 闭区间；格式不支持（如多段）时返回 None，按完整文件响应
+
+    异常:
+        ValueError: 范围无法满足（调用方返回 416）
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+
+    if not first:
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError('unsatisfiable range')
+        return max(0, size - length), size - 1
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('unsatisfiable range')
+    return start, end
+
+
+async def iter_file_range(f, start: int, length: int):
+    """在线程中分块读取文件的指定区间，读完后关闭文件"""
+    try:
+        await asyncio.to_thread(f.seek, start)
+        remaining = length
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(RESULT_STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(f.close)
+
+# ============================================================================
+# 11. 上游保护（自适应并发限制 + 熔断器 + 退避重试）
+# ============================================================================
+# 每个上游服务商一个 UpstreamGuard，两个端点共享同一份健康状态:
+# - AIMD 并发限制: 成功时并发上限缓慢增加，429/503/超时时减半
+# - Retry-After: 上游要求等待时，该服务商的所有请求都暂停到指定时间
+# - 熔断器: 连续失败达到阈值后打开，直接返回 503；冷却后半开，放行一个探测请求
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 头（秒数或 HTTP 日期），返回需要等待的秒数"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+# 当前请求的截止时间（time.monotonic() 时间点），由任务引擎 / 批量处理设置
+request_deadline: 'contextvars.ContextVar[Optional[float]]' = contextvars.ContextVar('request_deadline', default=None)
+
+
+def current_deadline() -> Optional[float]:
+    """当前请求的截止时间；在合并后的共享调用中取所有等待者中最晚的一个"""
+    call = current_call.get()
+    return call.deadline if call is not None else request_deadline.get()
+
+
+def deadline_remaining() -> Optional[float]:
+    """当前请求剩余的处理时间（秒），没有截止时间时返回 None"""
+    deadline = current_deadline()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def deadline_exceeded() -> HTTPException:
+    return HTTPException(status_code=504, detail='Request deadline exceeded')
+
+
+class UpstreamNotAccepted(HTTPException):
+    """
+    上游没有受理的请求（连接失败 / 限流 / 熔断或排队拒绝），不会产生费用
+
+    只有这类错误可以安全地切换到另一个计费提供方（见 ProviderRouter.call）
+    """
+
+
+def upstream_timeout(read: float, connect: float = 10.0) -> httpx.Timeout:
+    """上游请求超时：不超过当前请求的剩余时间"""
+    pool = HTTP_POOL_TIMEOUT
+    remaining = deadline_remaining()
+    if remaining is not None:
+        remaining = max(0.001, remaining)
+        read, connect, pool = min(read, remaining), min(connect, remaining), min(pool, remaining)
+    return httpx.Timeout(read, connect=connect, pool=pool)
+
+
+def backoff_delay(attempt: int) -> float:
+    """带完全抖动的指数退避: [0, min(上限, 基数 * 2^attempt)] 内的随机值"""
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** attempt)))
+
+
+class UpstreamGuard:
+    """单个上游服务商的并发限制器与熔断器"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.limit = float(UPSTREAM_INITIAL_CONCURRENCY)
+        self.inflight = 0
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_inflight = False
+        self.blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+        self.counters = {
+            'requests': 0,
+            'successes': 0,
+            'failures': 0,
+            'throttled': 0,
+            'retries': 0,
+            'rejected': 0,
+            'breaker_opens': 0,
+        }
+        UPSTREAM_INFLIGHT.labels(name).set_function(lambda: self.inflight)
+        UPSTREAM_CONCURRENCY_LIMIT.labels(name).set_function(lambda: self.limit)
+        UPSTREAM_BREAKER_STATE.labels(name).set_function(
+            lambda: {'closed': 0, 'half_open': 1, 'open': 2}[self.effective_state()]
+        )
+
+    def effective_state(self) -> str:
+        """
+        按时钟推算的熔断状态：打开后冷却时间已到即视为半开
+
+        state 只在下一次请求获取槽位时才切换到 half_open，没有流量时不能只看 state
+        """
+        if self.state == 'open' and time.monotonic() >= self.opened_at + BREAKER_RESET_TIMEOUT:
+            return 'half_open'
+        return self.state
+
+    def _reject(self, detail: str, retry_after: float):
+        self.counters['rejected'] += 1
+        raise UpstreamNotAccepted(
+            status_code=503,
+            detail=detail,
+            headers={'Retry-After': str(max(1, math.ceil(retry_after)))}
+        )
+
+    def _check_breaker(self):
+        if self.state == 'open':
+            remaining = self.opened_at + BREAKER_RESET_TIMEOUT - time.monotonic()
+            if remaining > 0:
+                self._reject(f'{self.name} is temporarily unavailable, please try again later', remaining)
+            # 冷却结束，进入半开状态，允许一个探测请求
+            self.state = 'half_open'
+            logger.warning('熔断器半开', extra={'provider': self.name})
+        if self.state == 'half_open' and self.probe_inflight:
+            self._reject(f'{self.name} is recovering, please try again later', BREAKER_RESET_TIMEOUT)
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        获取一个上游并发槽位
+
+        熔断打开时立即返回 503；并发已满或处于 Retry-After 等待期时排队，
+        超过 UPSTREAM_QUEUE_TIMEOUT 仍未获得槽位则返回 503。
+        """
+        self._check_breaker()
+        queue_timeout = UPSTREAM_QUEUE_TIMEOUT
+        budget = deadline_remaining()
+        if budget is not None and budget < queue_timeout:
+            queue_timeout = budget
+        deadline = time.monotonic() + queue_timeout
+        async with self._cond:
+            while True:
+                now = time.monotonic()
+                blocked = self.blocked_until - now
+                if blocked <= 0 and self.inflight < max(1, int(self.limit)):
+                    break
+                remaining = deadline - now
+                if blocked > remaining:
+                    self._reject(f'{self.name} is rate limiting requests, please try again later', blocked)
+                if remaining <= 0:
+                    if queue_timeout != UPSTREAM_QUEUE_TIMEOUT:
+                        raise deadline_exceeded()
+                    self._reject(f'{self.name} is busy, please try again later', 1)
+                try:
+                    await asyncio.wait_for(self._cond.wait(), timeout=blocked if blocked > 0 else remaining)
+                except asyncio.TimeoutError:
+                    pass
+            self._check_breaker()
+            probe = self.state == 'half_open'
+            if probe:
+                self.probe_inflight = True
+            self.inflight += 1
+            self.counters['requests'] += 1
+
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.inflight -= 1
+                if probe:
+                    self.probe_inflight = False
+                self._cond.notify_all()
+
+    def record_success(self):
+        self.counters['successes'] += 1
+        self.consecutive_failures = 0
+        if self.state != 'closed':
+            logger.warning('熔断器关闭，上游已恢复', extra={'provider': self.name})
+            self.state = 'closed'
+        # 加性增: 大约每完成一个并发窗口的请求，上限 +1
+        self.limit = min(float(UPSTREAM_MAX_CONCURRENCY), self.limit + 1.0 / self.limit)
+
+    def record_failure(self, overloaded: bool, retry_after: Optional[float] = None):
+        now = time.monotonic()
+        self.counters['failures'] += 1
+        self.consecutive_failures += 1
+
+        if overloaded and now - self._last_decrease > 1.0:
+            # 乘性减: 同一秒内的多次过载只减一次，避免瞬间降到最低
+            self.limit = max(float(UPSTREAM_MIN_CONCURRENCY), self.limit / 2)
+            self._last_decrease = now
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+
+        if self.state == 'half_open' or (
+                self.state == 'closed' and self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD):
+            self.state = 'open'
+            self.opened_at = now
+            self.counters['breaker_opens'] += 1
+            logger.error('熔断器打开', extra={'provider': self.name, 'consecutive_failures': self.consecutive_failures})
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            'state': self.effective_state(),
+            'concurrency_limit': round(self.limit, 2),
+            'inflight': self.inflight,
+            'consecutive_failures': self.consecutive_failures,
+            'blocked_for_seconds': round(max(0.0, self.blocked_until - now), 2),
+            'reopen_in_seconds': round(max(0.0, self.opened_at + BREAKER_RESET_TIMEOUT - now), 2)
+            if self.state == 'open' else 0.0,
+            **self.counters,
+        }
+
+
+UPSTREAMS: Dict[str, UpstreamGuard] = {
+    '302.ai': UpstreamGuard('302.ai'),
+    'dewatermark.ai': UpstreamGuard('dewatermark.ai'),
+}
+
+
+async def send_with_retries(guard: UpstreamGuard, send: Callable[[], Awaitable[httpx.Response]],
+                            max_attempts: int, retry_on_timeout: bool = True) -> httpx.Response:
+    """
+    通过 guard 发送上游请求，429 / 5xx / 网络错误按抖动指数退避重试
+
+    有截止时间时（见 request_deadline），send 应使用 upstream_timeout() 生成超时；
+    剩余时间不足以再等待一次退避并发起请求时不再重试。请求被取消（客户端断开）时立即释放并发槽位。
+
+    返回:
+        最后一次的响应（可能仍是 429 / 5xx，由调用方转换为错误）
+    异常:
+        最后一次仍超时 / 无法连接时抛出 httpx 异常；熔断或排队超时时抛出 503；超过截止时间时抛出 504
+    """
+    for attempt in range(max_attempts):
+        remaining = deadline_remaining()
+        if remaining is not None and remaining < DEADLINE_MIN_ATTEMPT_SECONDS:
+            raise deadline_exceeded()
+        last_attempt = attempt == max_attempts - 1
+        if ADMISSION_ENABLED:
+            # 每次尝试（包括重试）都消耗该服务商的一个全局预算
+            await admission.acquire_upstream(guard.name)
+        start = time.perf_counter()
+        try:
+            async with guard.slot():
+                report_progress('uploading', provider=guard.name, attempt=attempt + 1, max_attempts=max_attempts)
+                start = time.perf_counter()
+                response = await send()
+                UPSTREAM_SECONDS.labels(guard.name, 'total').observe(time.perf_counter() - start)
+        except asyncio.CancelledError:
+            UPSTREAM_RESPONSES.labels(guard.name, 'cancelled').inc()
+            UPSTREAM_ABANDONED_SECONDS.labels(guard.name).inc(time.perf_counter() - start)
+            raise
+        except (httpx.TimeoutException, httpx.NetworkError) as e:
+            timed_out = isinstance(e, httpx.TimeoutException)
+            UPSTREAM_RESPONSES.labels(guard.name, 'timeout' if timed_out else 'network_error').inc()
+            remaining = deadline_remaining()
+            if timed_out and remaining is not None and remaining < DEADLINE_MIN_ATTEMPT_SECONDS:
+                # 超时是被截止时间截断的，不代表上游过载
+                UPSTREAM_RETRIES.labels(guard.name).observe(attempt)
+                raise deadline_exceeded()
+            guard.record_failure(overloaded=timed_out)
+            delay = backoff_delay(attempt)
+            out_of_time = remaining is not None and remaining - delay < DEADLINE_MIN_ATTEMPT_SECONDS
+            if last_attempt or (timed_out and not retry_on_timeout) or out_of_time:
+                UPSTREAM_RETRIES.labels(guard.name).observe(attempt)
+                raise
+            logger.warning('上游请求超时，稍后重试' if timed_out else '上游网络错误，稍后重试', extra={
+                'provider': guard.name, 'attempt': attempt + 1, 'delay': round(delay, 2)
+            })
+        else:
+            UPSTREAM_RESPONSES.labels(guard.name, str(response.status_code)).inc()
+            if response.status_code != 429 and response.status_code < 500:
+                guard.record_success()
+                UPSTREAM_RETRIES.labels(guard.name).observe(attempt)
+                return response
+
+            if response.status_code == 429:
+                guard.counters['throttled'] += 1
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            guard.record_failure(overloaded=response.status_code in (429, 503), retry_after=retry_after)
+            if last_attempt or (retry_after or 0) > UPSTREAM_RETRY_AFTER_MAX:
+                UPSTREAM_RETRIES.labels(guard.name).observe(attempt)
+                return response
+            delay = max(backoff_delay(attempt), retry_after or 0)
+            remaining = deadline_remaining()
+            if remaining is not None and remaining - delay < DEADLINE_MIN_ATTEMPT_SECONDS:
+                logger.warning('剩余时间不足，放弃重试', extra={
+                    'provider': guard.name, 'status': response.status_code, 'remaining': round(remaining, 2)
+                })
+                UPSTREAM_RETRIES.labels(guard.name).observe(attempt)
+                return response
+            logger.warning('上游返回错误状态，稍后重试', extra={
+                'provider': guard.name, 'status': response.status_code, 'attempt': attempt + 1, 'delay': round(delay, 2)
+            })
+
+        guard.counters['retries'] += 1
+        await asyncio.sleep(delay)
+
+    raise RuntimeError('unreachable')
+
+# ============================================================================
+# 12. 准入控制（跨进程共享的令牌桶 + 优先级队列）
+# ============================================================================
+# 多个 uvicorn / gunicorn worker 之间没有共享内存，配额和上游预算保存在同一主机的 SQLite 文件中（WAL 模式）:
+# - 客户端配额: 每个 IP（或 ADMISSION_API_KEYS 中的 X-API-Key）一个令牌桶，用尽时在读取请求体之前直接返回 429；
+#   闲置到已经补满的客户端令牌桶会被定期删除（删除后再次访问时同样按满桶计算），表不会无限增长
+# - 上游预算: 每个服务商一个全局令牌桶；令牌不足时按优先级排队（交互请求 > 异步任务 > 批量），
+#   同优先级先到先得；预计排队时间超过 ADMISSION_QUEUE_SLO 时立即返回 429 + Retry-After
+# SQLite 调用都在线程中执行，不阻塞事件循环；数据库不可用时放行请求（fail open）
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_JOB = 1
+PRIORITY_BATCH = 2
+
+# 当前请求的优先级，由任务引擎 / 批量处理设置
+request_priority: 'contextvars.ContextVar[int]' = contextvars.ContextVar('request_priority', default=PRIORITY_JOB)
+
+
+def current_priority() -> int:
+    """当前请求的上游预算优先级；在合并后的共享调用中取所有等待者中最高的一个"""
+    call = current_call.get()
+    return call.priority if call is not None else request_priority.get()
+
+
+class AdmissionStore:
+    """SQLite 中的令牌桶和排队票据（每个进程一个连接，所有修改都在 BEGIN IMMEDIATE 事务中完成）"""
+
+    def __init__(self, path: str, idle_seconds: float):
+        self.path = path
+        # 客户端令牌桶闲置超过该时长时必然已经补满，可以删除
+        self.idle_seconds = idle_seconds
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS tickets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, bucket TEXT NOT NULL,
+                priority INTEGER NOT NULL, expires REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS tickets_order ON tickets (bucket, priority, id);
+        """)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @staticmethod
+    def _refill(conn: sqlite3.Connection, key: str, rate: float, burst: float, now: float) -> float:
+        row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return burst
+        return min(burst, row[0] + max(0.0, now - row[1]) * rate)
+
+    @staticmethod
+    def _store(conn: sqlite3.Connection, key: str, tokens: float, now: float):
+        conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        """
+        从令牌桶取一个令牌（rate 为每秒补充的令牌数）
+
+        返回:
+            0 表示成功，否则为需要等待的秒数
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            if now - self._pruned_at > ADMISSION_PRUNE_INTERVAL:
+                self._pruned_at = now
+                conn.execute(
+                    "DELETE FROM buckets WHERE key NOT LIKE 'provider:%' AND updated < ?", (now - self.idle_seconds,)
+                )
+            tokens = self._refill(conn, key, rate, burst, now)
+            if tokens >= 1:
+                self._store(conn, key, tokens - 1, now)
+                return 0.0
+            self._store(conn, key, tokens, now)
+            return (1 - tokens) / rate
+
+    def enqueue(self, bucket: str, priority: int) -> int:
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                'INSERT INTO tickets (bucket, priority, expires) VALUES (?, ?, ?)',
+                (bucket, priority, time.time() + ADMISSION_TICKET_TTL)
+            )
+            return cursor.lastrowid
+
+    def poll(self, ticket: int, bucket: str, priority: int, rate: float, burst: float,
+             slo: Optional[float]) -> Tuple[str, float]:
+        """
+        检查排队票据
+
+        返回:
+            ('granted', 0) 已取得令牌（票据已删除）
+            ('wait', 秒)   继续等待
+            ('rejected', 预计等待秒数) 预计排队时间超过 slo（票据已删除）
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM tickets WHERE expires < ?', (now,))
+            # 刷新心跳；票据因事件循环长时间阻塞而过期时，按原编号重新插入（保持排队位置）
+            conn.execute(
+                'INSERT OR REPLACE INTO tickets (id, bucket, priority, expires) VALUES (?, ?, ?, ?)',
+                (ticket, bucket, priority, now + ADMISSION_TICKET_TTL)
+            )
+            ahead = conn.execute(
+                'SELECT COUNT(*) FROM tickets WHERE bucket = ? AND (priority < ? OR (priority = ? AND id < ?))',
+                (bucket, priority, priority, ticket)
+            ).fetchone()[0]
+
+            tokens = self._refill(conn, bucket, rate, burst, now)
+            if ahead == 0 and tokens >= 1:
+                self._store(conn, bucket, tokens - 1, now)
+                conn.execute('DELETE FROM tickets WHERE id = ?', (ticket,))
+                return 'granted', 0.0
+            self._store(conn, bucket, tokens, now)
+
+            estimate = (ahead + 1 - tokens) / rate
+            if slo is not None and estimate > slo:
+                conn.execute('DELETE FROM tickets WHERE id = ?', (ticket,))
+                return 'rejected', estimate
+            if ahead == 0:
+                return 'wait', max(ADMISSION_POLL_INTERVAL / 5, (1 - tokens) / rate)
+            return 'wait', ADMISSION_POLL_INTERVAL
+
+    def cancel(self, ticket: int):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM tickets WHERE id = ?', (ticket,))
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._transaction() as conn:
+            buckets = conn.execute("SELECT key, tokens, updated FROM buckets WHERE key LIKE 'provider:%'").fetchall()
+            queued = conn.execute(
+                'SELECT bucket, COUNT(*) FROM tickets WHERE expires >= ? GROUP BY bucket', (now,)
+            ).fetchall()
+        waiting = dict(queued)
+        return {
+            key.partition(':')[2]: {'tokens': round(tokens, 2), 'queued': waiting.get(key, 0)}
+            for key, tokens, _ in buckets
+        }
+
+
+def rate_limited(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={'Retry-After': str(max(1, math.ceil(retry_after)))}
+    )
+
+
+class AdmissionController:
+    """客户端配额检查和上游全局预算排队"""
+
+    def __init__(self, store: AdmissionStore, provider_rates: Dict[str, float], api_keys: set):
+        self.store = store
+        self.provider_rates = provider_rates
+        self.api_keys = {self.key_digest(key) for key in api_keys}
+
+    @staticmethod
+    def key_digest(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:32]
+
+    async def check_client(self, ip: str, api_key: Optional[str]) -> Optional[float]:
+        """
+        扣减客户端配额
+
+        返回:
+            None 表示放行，否则为建议的 Retry-After 秒数
+        """
+        # 只有已配置的密钥才能使用密钥配额，否则随机生成的密钥就能绕过 IP 配额
+        digest = self.key_digest(api_key) if api_key else None
+        if digest in self.api_keys:
+            key = f'key:{digest}'
+            rate, burst = ADMISSION_KEY_RATE / 60, ADMISSION_KEY_BURST
+        else:
+            key, rate, burst = f'ip:{ip}', ADMISSION_IP_RATE / 60, ADMISSION_IP_BURST
+        if rate <= 0:
+            return None
+        try:
+            wait = await asyncio.to_thread(self.store.take, key, rate, burst)
+        except sqlite3.Error as e:
+            logger.warning('准入控制存储不可用，放行请求', extra={'error': str(e)})
+            return None
+        ADMISSION_DECISIONS.labels('client', 'rejected' if wait else 'admitted').inc()
+        return wait or None
+
+    async def acquire_upstream(self, provider: str):
+        """
+        等待服务商的全局预算（未配置该服务商的预算时直接返回）
+
+        异常:
+            429: 预计排队时间超过 ADMISSION_QUEUE_SLO；504: 排队超过请求截止时间
+        """
+        rate = self.provider_rates.get(provider)
+        if not rate:
+            return
+        bucket = f'provider:{provider}'
+        priority = current_priority()
+        start = time.perf_counter()
+        try:
+            ticket = await asyncio.to_thread(self.store.enqueue, bucket, priority)
+        except sqlite3.Error as e:
+            logger.warning('准入控制存储不可用，放行请求', extra={'error': str(e)})
+            return
+
+        settled = False  # 票据已由 poll 删除
+        try:
+            slo: Optional[float] = ADMISSION_QUEUE_SLO
+            while True:
+                state, wait = await asyncio.to_thread(
+                    self.store.poll, ticket, bucket, priority, rate, max(1.0, rate), slo
+                )
+                # 只在入队时按 SLO 判断是否拒绝，入队后一直等到轮到自己或超过截止时间
+                slo = None
+                if state == 'granted':
+                    settled = True
+                    ADMISSION_DECISIONS.labels('provider', 'admitted').inc()
+                    ADMISSION_QUEUE_SECONDS.labels(provider).observe(time.perf_counter() - start)
+                    return
+                if state == 'rejected':
+                    settled = True
+                    ADMISSION_DECISIONS.labels('provider', 'rejected').inc()
+                    logger.warning('上游预算排队超过 SLO，拒绝请求', extra={
+                        'provider': provider, 'estimated_wait': round(wait, 2)
+                    })
+                    raise rate_limited(f'{provider} request budget exhausted, please try again later', wait)
+                remaining = deadline_remaining()
+                if remaining is not None and remaining < wait:
+                    raise deadline_exceeded()
+                report_progress('queued', provider=provider)
+                await asyncio.sleep(wait)
+        except sqlite3.Error as e:
+            logger.warning('准入控制存储不可用，放行请求', extra={'error': str(e)})
+        finally:
+            if not settled:
+                # 取消 / 超时 / 出错时删除票据（不等待结果，取消过程中不能再 await；失败时由回调记录日志）
+                future = asyncio.get_running_loop().run_in_executor(None, self.store.cancel, ticket)
+                future.add_done_callback(self._cancel_done)
+
+    @staticmethod
+    def _cancel_done(future: asyncio.Future):
+        """删除票据失败时记录日志（残留的票据到过期时间后不再占用队列）"""
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.warning('删除上游预算排队票据失败', extra={'error': str(error)})
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'enabled': ADMISSION_ENABLED,
+            'provider_rates': self.provider_rates,
+            'queue_slo_seconds': ADMISSION_QUEUE_SLO,
+            'providers': self.store.snapshot() if ADMISSION_ENABLED else {},
+        }
+
+
+admission = AdmissionController(
+    # 客户端令牌桶从空到满所需时间的两倍
+    AdmissionStore(ADMISSION_DB_PATH, idle_seconds=2 * max((
+        burst / (rate / 60)
+        for rate, burst in ((ADMISSION_IP_RATE, ADMISSION_IP_BURST), (ADMISSION_KEY_RATE, ADMISSION_KEY_BURST))
+        if rate > 0
+    ), default=0.0)),
+    ADMISSION_PROVIDER_RATES, ADMISSION_API_KEYS
+)
+
+# ============================================================================
+# 13. 上游服务调用
+# ============================================================================
+
+class DataURIJSONBody:
+    """
+    流式生成 {"<field>": "data:<type>;base64,<...>"} 形式的 JSON 请求体
+
+    原图只保留一份字节，按 3 字节对齐的分块边编码边发送，
+    不会同时在内存中存在 base64 字符串、data URI 和序列化后的 JSON。
+    长度可以预先算出，因此仍然以 Content-Length 方式发送。
+    """
+
+    # 每块原始字节数（必须是 3 的倍数，保证分块编码结果可以直接拼接）
+    CHUNK_SIZE = 3 * 256 * 1024
+
+    def __init__(self, field: str, data: bytes, content_type: str):
+        self.data = data
+        self.prefix = ('{' + json.dumps(field) + ': "data:' + json.dumps(content_type)[1:-1] + ';base64,').encode('utf-8')
+        self.suffix = b'"}'
+
+    def __len__(self) -> int:
+        return len(self.prefix) + 4 * math.ceil(len(self.data) / 3) + len(self.suffix)
+
+    async def stream(self):
+        """每次调用返回新的异步迭代器，重试时可以重新发送"""
+        yield self.prefix
+        view = memoryview(self.data)
+        encode_seconds = 0.0
+        for offset in range(0, len(view), self.CHUNK_SIZE):
+            start = time.perf_counter()
+            chunk = base64.b64encode(view[offset:offset + self.CHUNK_SIZE])
+            encode_seconds += time.perf_counter() - start
+            yield chunk
+        STAGE_SECONDS.labels('remove-background', 'base64_encode').observe(encode_seconds)
+        yield self.suffix
+
+
+async def call_removebg(image_data: bytes, content_type: str, api_url: str = REMOVEBG_API_URL,
+                        api_name: str = '302.ai-removebg-v2') -> Dict[str, Any]:
+    """
+    调用 302.AI Removebg-V2 API 去除背景
+
+    参数:
+        image_data: 原始图片字节
+        content_type: 图片 MIME 类型
+        api_url / api_name: 接口地址和结果中的 api 标识（用于接入其他模型版本）
+
+    返回:
+        API 响应字典（processed_url / api / cost / direct_url）
+    """
+    # ========================================
+    # 1. 预处理：大图缩小后再上传（可选）
+    # ========================================
+    downscaled = None
+    if REMOVEBG_DOWNSCALE_MAX_EDGE > 0:
+        try:
+            downscaled = await asyncio.to_thread(downscale_for_upload, image_data, REMOVEBG_DOWNSCALE_MAX_EDGE)
+        except Exception as e:
+            logger.warning('图片解码失败，直接上传原图', extra={'error': str(e)})
+    if downscaled is not None:
+        logger.info('缩小上传', extra={
+            'original_size': list(downscaled.original_size), 'sent_size': list(downscaled.sent_size),
+            'original_bytes': len(image_data), 'sent_bytes': len(downscaled.data)
+        })
+        upload_data, upload_type = downscaled.data, downscaled.content_type
+    else:
+        upload_data, upload_type = image_data, content_type
+
+    # ========================================
+    # 2. 准备流式 Base64 请求体
+    # ========================================
+    # 不再一次性生成 base64 字符串和 data URI，发送时边编码边传输
+    report_progress('encoding', bytes=len(upload_data))
+    body = DataURIJSONBody('image_url', upload_data, upload_type)
+
+    # ========================================
+    # 3. 调用 302.AI Removebg-V2 API
+    # ========================================
+    logger.info('调用 302.AI Removebg-V2 API', extra={'body_bytes': len(body), 'url': api_url})
+
+    try:
+        headers = {
+            'Authorization': f'Bearer {AI302_API_KEY}',
+            'Content-Type': 'application/json',
+            'Content-Length': str(len(body))
+        }
+
+        start_time = time.time()
+
+        # 经过 302.ai 的并发限制 / 熔断器发送；超时不重试（避免重复计费）
+        response = await send_with_retries(
+            UPSTREAMS['302.ai'],
+            lambda: get_http_client().post(
+                api_url,
+                headers=headers,
+                content=body.stream(),
+                timeout=upstream_timeout(90.0, connect=10.0)  # (连接超时10秒, 读取超时90秒，不超过请求剩余时间)
+            ),
+            max_attempts=REMOVEBG_MAX_ATTEMPTS,
+            retry_on_timeout=False
+        )
+
+        elapsed_time = time.time() - start_time
+        logger.info('302.AI 响应', extra={'status': response.status_code, 'elapsed': round(elapsed_time, 2)})
+
+        if response.is_success:
+            try:
+                with observe_stage('remove-background', 'json_parse'):
+                    result = response.json()
+                logger.debug('302.AI 响应数据', extra={'result': result})
+
+                # 检查响应格式 - V2 API 可能返回不同格式
+                # 格式1: {"output": "https://..."}
+                # 格式2: {"image": {"url": "https://..."}}
+                image_url_response = None
+                file_size = 'unknown'
+
+                if 'output' in result and result['output']:
+                    # V2 格式：直接在 output 字段
+                    image_url_response = result['output']
+                elif 'image' in result and 'url' in result['image']:
+                    # V3 格式：在 image.url 字段
+                    image_url_response = result['image']['url']
+                    file_size = result['image'].get('file_size', 'unknown')
+
+                if image_url_response:
+                    logger.info('去背景处理成功', extra={'processed_url': image_url_response, 'file_size': file_size})
+
+                    # 缩小上传时，在本地重建全分辨率结果
+                    if downscaled is not None:
+                        local_url = await restore_full_resolution(image_data, downscaled, image_url_response)
+                        if local_url:
+                            return {
+                                'processed_url': local_url,
+                                'api': api_name,
+                                'cost': '0.01 PTC',
+                                'direct_url': False,
+                                'upstream_url': image_url_response,
+                                'original_size': list(downscaled.original_size),
+                                'upload_size': list(downscaled.sent_size)
+                            }
+
+                    # 镜像模式：后台流式下载结果，立即返回本地 URL
+                    if RESULT_MIRROR_ENABLED:
+                        return {
+                            'processed_url': await result_mirror.schedule(image_url_response),
+                            'api': api_name,
+                            'cost': '0.01 PTC',
+                            'direct_url': False,
+                            'upstream_url': image_url_response
+                        }
+
+                    # 直接返回302.AI的图片URL，不下载保存（避免超时）
+                    return {
+                        'processed_url': image_url_response,
+                        'api': api_name,
+                        'cost': '0.01 PTC',
+                        'direct_url': True
+                    }
+
+                elif 'error' in result:
+                    # 处理错误响应
+                    error_msg = result.get('error')
+                    logger.error('302.AI 返回错误', extra={'error': error_msg})
+                    raise HTTPException(status_code=500, detail=error_msg)
+
+                else:
+                    # 未知的响应格式
+                    logger.error('302.AI 响应格式未知', extra={'result': result})
+                    raise HTTPException(status_code=500, detail='Unexpected response format')
+
+            except ValueError as json_error:
+                logger.error('302.AI 响应 JSON 解析失败', extra={'error': str(json_error), 'body': response.text[:500]})
+                raise HTTPException(status_code=500, detail='Invalid JSON response from API')
+        else:
+            logger.error('302.AI 请求失败', extra={'status': response.status_code, 'body': response.text[:500]})
+            retry_after = response.headers.get('Retry-After')
+            if response.status_code == 429 or (response.status_code == 503 and retry_after):
+                # 上游明确拒绝受理（限流 / 过载），不会计费
+                raise UpstreamNotAccepted(
+                    status_code=503,
+                    detail=f'302.AI API failed with status {response.status_code}',
+                    headers={'Retry-After': retry_after} if retry_after else None
+                )
+            raise HTTPException(
+                status_code=500,
+                detail=f'302.AI API failed with status {response.status_code}'
+            )
+
+    except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as conn_err:
+        # 请求还没有发出，不会计费
+        logger.error('无法连接到 302.AI 服务器', extra={'error': str(conn_err)})
+        raise UpstreamNotAccepted(
+            status_code=503,
+            detail='Cannot connect to 302.AI service. Please check your network or try again later.'
+        )
+
+    except httpx.NetworkError as conn_err:
+        logger.error('无法连接到 302.AI 服务器', extra={'error': str(conn_err)})
+        raise HTTPException(
+            status_code=503,
+            detail='Cannot connect to 302.AI service. Please check your network or try again later.'
+        )
+
+    except httpx.TimeoutException:
+        logger.error('302.AI 请求超时 (90秒)', extra={'image_bytes': len(upload_data), 'body_bytes': len(body)})
+        raise HTTPException(
+            status_code=504,
+            detail='Request timed out after 90 seconds. The 302.AI service might be busy or the image is too complex.'
+        )
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.exception('302.AI 调用异常', extra={'error_type': type(e).__name__})
+        raise HTTPException(status_code=500, detail=f'API error: {str(e)}')
+
+
+async def call_dewatermark(image_data: bytes, filename: str, content_type: str,
+                           remove_text: bool = True) -> Dict[str, Any]:
+    """
+    调用 dewatermark.ai API 去除水印（带重试）
+
+    参数:
+        image_data: 原始图片字节
+        filename: 上传文件名
+        content_type: 图片 MIME 类型
+        remove_text: 是否同时去除文字水印
+
+    返回:
+        API 响应字典（success / imageBase64 / session_id / mask / watermark_mask）
+    """
+
+    # 准备 API 请求
+    clean_api_key = DEWATERMARK_API_KEY.strip()
+
+    headers = {
+        "X-API-KEY": clean_api_key
+    }
+
+    logger.info('调用 dewatermark.ai API', extra={'url': DEWATERMARK_API_URL, 'image_bytes': len(image_data)})
+
+    # 准备 multipart/form-data
+    files = {
+        'original_preview_image': (
+            filename,
+            image_data,
+            content_type or 'image/jpeg'
+        )
+    }
+    data = {
+        'remove_text': 'true' if remove_text else 'false'
+    }
+
+    try:
+        # 经过 dewatermark.ai 的并发限制 / 熔断器发送，429 / 5xx / 超时自动退避重试
+        response = await send_with_retries(
+            UPSTREAMS['dewatermark.ai'],
+            lambda: get_http_client().post(
+                DEWATERMARK_API_URL,
+                headers=headers,
+                files=files,
+                data=data,
+                timeout=upstream_timeout(60.0)
+            ),
+            max_attempts=DEWATERMARK_MAX_ATTEMPTS
+        )
+
+        logger.info('dewatermark.ai 响应', extra={'status': response.status_code})
+
+        if response.status_code == 200:
+            with observe_stage('dewatermark', 'json_parse'):
+                result = response.json()
+
+            # 解析响应
+            if 'edited_image' in result and result['edited_image'].get('image'):
+                logger.info('去水印处理成功', extra={'session_id': result.get('session_id', '')})
+
+                return {
+                    'success': True,
+                    'imageBase64': result['edited_image']['image'],
+                    'session_id': result.get('session_id', ''),
+                    'mask': result['edited_image'].get('mask', ''),
+                    'watermark_mask': result['edited_image'].get('watermark_mask', '')
+                }
+            else:
+                logger.error('dewatermark.ai 返回数据格式错误')
+                raise HTTPException(status_code=500, detail='API 返回数据格式错误')
+
+        elif response.status_code == 401:
+            error_msg = "API 密钥认证失败"
+            try:
+                error_detail = response.json()
+                logger.error('dewatermark.ai 认证失败', extra={'detail': error_detail})
+                error_msg = f"API 密钥认证失败: {error_detail}"
+            except ValueError:
+                logger.error('dewatermark.ai 认证失败', extra={'body': response.text[:200]})
+
+            raise HTTPException(status_code=500, detail=error_msg)
+
+        elif response.status_code == 403:
+            error_msg = "API 访问被拒绝，请检查您的 API 密钥"
+            logger.error('dewatermark.ai 拒绝访问 (403)')
+            raise HTTPException(status_code=500, detail=error_msg)
+
+        elif response.status_code == 429:
+            # 重试后仍被限流
+            raise HTTPException(status_code=429, detail='API 请求过于频繁，请稍后重试')
+
+        elif response.status_code >= 500:
+            # 重试后仍是服务器错误
+            raise HTTPException(
+                status_code=500,
+                detail=f'API 服务器错误 ({response.status_code})，请稍后重试'
+            )
+
+        else:
+            # 其他错误
+            try:
+                error_data = response.json()
+                error_msg = error_data.get('error', f'API 错误: {response.status_code}')
+            except ValueError:
+                error_msg = f'API 错误: {response.status_code}'
+
+            logger.error('dewatermark.ai 请求失败', extra={'status': response.status_code, 'error': error_msg})
+            raise HTTPException(status_code=500, detail=error_msg)
+
+    except httpx.TimeoutException:
+        logger.error('dewatermark.ai 请求超时')
+        raise HTTPException(status_code=504, detail='请求超时，请重试')
+
+    except httpx.NetworkError:
+        logger.error('无法连接到 dewatermark.ai 服务')
+        raise HTTPException(status_code=503, detail='无法连接到 API 服务')
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.exception('dewatermark.ai 调用异常')
+        raise HTTPException(status_code=500, detail=f'处理失败: {str(e)}')
+
+# 分块去水印: 大图按重叠网格切块，并发调用 dewatermark.ai，再用羽化权重拼接
+# - 每个图块以 JPEG 上传，保证在上游 10MB 限制以内
+# - 按行优先顺序把图块贴回画布，与已贴图块重叠的部分用线性渐变权重混合，消除接缝
+
+class TilePlan:
+    """分块计划：图块起点网格、各图块的编码数据和原图的 alpha 通道（没有透明度时为 None）"""
+
+    def __init__(self, size: Tuple[int, int], xs: List[int], ys: List[int], tile_size: int,
+                 tiles: List[bytes], output_format: str, alpha: Optional[Image.Image] = None):
+        self.size = size
+        self.xs = xs
+        self.ys = ys
+        self.tile_size = tile_size
+        self.tiles = tiles
+        self.output_format = output_format
+        self.alpha = alpha
+
+    def boxes(self) -> List[Tuple[int, int, int, int]]:
+        """按行优先顺序返回每个图块的 (x0, y0, x1, y1)"""
+        width, height = self.size
+        return [
+            (x, y, min(x + self.tile_size, width), min(y + self.tile_size, height))
+            for y in self.ys for x in self.xs
+        ]
+
+
+def tile_starts(length: int, tile: int, overlap: int) -> List[int]:
+    """沿一个方向均匀排布图块起点，保证相邻图块至少重叠 overlap 像素"""
+    if length <= tile:
+        return [0]
+    count = math.ceil((length - overlap) / (tile - overlap))
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def oriented_size(image_data: bytes) -> Tuple[int, int]:
+    """只读取文件头，返回按 EXIF 方向修正后的尺寸"""
+    with Image.open(BytesIO(image_data)) as img:
+        width, height = img.size
+        if img.getexif().get(_EXIF_ORIENTATION_TAG, 1) in _TRANSPOSED_ORIENTATIONS:
+            return height, width
+        return width, height
+
+
+def needs_tiling(image_data: bytes) -> bool:
+    """分块模式下，文件超过上游限制或长边超过阈值的图片需要分块"""
+    if not DEWATERMARK_TILING_ENABLED:
+        return False
+    if len(image_data) > DEWATERMARK_MAX_SIZE:
+        return True
+    try:
+        return max(oriented_size(image_data)) > DEWATERMARK_TILE_TRIGGER_EDGE
+    except Exception:
+        return False
+
+
+def split_into_tiles(image_data: bytes) -> TilePlan:
+    """
+    解码原图并切成重叠图块（JPEG 编码）
+
+    上游只处理 RGB，带透明度的原图先拆出 alpha 通道，拼接后再原样贴回
+    """
+    with Image.open(BytesIO(image_data)) as img:
+        output_format = 'JPEG' if img.format == 'JPEG' else 'PNG'
+        image = ImageOps.exif_transpose(img)
+        alpha = None
+        if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+            image = image.convert('RGBA')
+            alpha = image.getchannel('A')
+            output_format = 'PNG'
+        image = image.convert('RGB')
+
+    width, height = image.size
+    tile_size = DEWATERMARK_TILE_SIZE
+    overlap = min(DEWATERMARK_TILE_OVERLAP, tile_size // 2)
+    xs = tile_starts(width, tile_size, overlap)
+    ys = tile_starts(height, tile_size, overlap)
+
+    plan = TilePlan((width, height), xs, ys, tile_size, [], output_format, alpha)
+    for box in plan.boxes():
+        buffer = BytesIO()
+        image.crop(box).save(buffer, 'JPEG', quality=95)
+        plan.tiles.append(buffer.getvalue())
+    return plan
+
+
+def feather_ramp(length: int, overlap: int) -> np.ndarray:
+    """一维羽化权重：前 overlap 个像素从 0 线性升到 1，其余为 1"""
+    ramp = np.ones(length, dtype=np.float32)
+    if overlap > 0:
+        ramp[:overlap] = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+    return ramp
+
+
+def stitch_tiles(plan: TilePlan, images: List[Image.Image], mode: str) -> np.ndarray:
+    """
+    把处理后的图块拼回原图尺寸
+
+    行优先贴图；每个图块只在与左侧 / 上方已贴图块重叠的区域内羽化混合，
+    权重为两个方向一维渐变的外积，四块交汇的角落也能平滑过渡
+    """
+    width, height = plan.size
+    channels = 3 if mode == 'RGB' else 1
+    canvas = np.zeros((height, width, channels), dtype=np.uint8)
+
+    for index, (x0, y0, x1, y1) in enumerate(plan.boxes()):
+        row, col = divmod(index, len(plan.xs))
+        tile = images[index].convert(mode)
+        if tile.size != (x1 - x0, y1 - y0):
+            tile = tile.resize((x1 - x0, y1 - y0), Image.LANCZOS)
+        pixels = np.asarray(tile, dtype=np.float32).reshape(y1 - y0, x1 - x0, channels)
+
+        overlap_x = min(plan.xs[col - 1] + plan.tile_size, width) - x0 if col > 0 else 0
+        overlap_y = min(plan.ys[row - 1] + plan.tile_size, height) - y0 if row > 0 else 0
+        weight = np.outer(feather_ramp(y1 - y0, overlap_y), feather_ramp(x1 - x0, overlap_x))[..., None]
+
+        region = canvas[y0:y1, x0:x1].astype(np.float32)
+        canvas[y0:y1, x0:x1] = np.clip(region + (pixels - region) * weight + 0.5, 0, 255).astype(np.uint8)
+
+    return canvas if channels == 3 else canvas[..., 0]
+
+
+def merge_tile_results(plan: TilePlan, results: List[Dict[str, Any]]) -> Dict[str, str]:
+    """解码各图块结果并拼接图片和蒙版（蒙版缺失时返回空字符串），原图带透明度时贴回 alpha 通道"""
+    merged = {}
+    for field, mode in (('imageBase64', 'RGB'), ('mask', 'L'), ('watermark_mask', 'L')):
+        encoded = [result.get(field) for result in results]
+        if not all(encoded):
+            merged[field] = ''
+            continue
+        images = [Image.open(BytesIO(decode_base64_image(value))) for value in encoded]
+        try:
+            canvas = stitch_tiles(plan, images, mode)
+        finally:
+            for image in images:
+                image.close()
+
+        merged_image = Image.fromarray(canvas)
+        if field == 'imageBase64' and plan.alpha is not None:
+            merged_image.putalpha(plan.alpha)
+        buffer = BytesIO()
+        if field == 'imageBase64' and plan.output_format == 'JPEG':
+            merged_image.save(buffer, 'JPEG', quality=95)
+        else:
+            merged_image.save(buffer, 'PNG', compress_level=REMOVEBG_PNG_COMPRESS_LEVEL)
+        merged[field] = base64.b64encode(buffer.getvalue()).decode('ascii')
+    return merged
+
+
+async def call_dewatermark_tiled(image_data: bytes, filename: str, remove_text: bool = True) -> Dict[str, Any]:
+    """
+    分块去水印
+
+    图块通过 dewatermark.ai 的并发限制 / 熔断器并发发送（单张图片最多 DEWATERMARK_TILE_CONCURRENCY 个），
+    任一图块失败时取消其余图块并返回该错误
+    """
+    with observe_stage('dewatermark', 'tile_split'):
+        plan = await asyncio.to_thread(split_into_tiles, image_data)
+    total = len(plan.tiles)
+    logger.info('分块去水印', extra={
+        'size': list(plan.size), 'tiles': total, 'tile_size': plan.tile_size, 'image_bytes': len(image_data)
+    })
+    report_progress('tiling', tiles=total, size=list(plan.size))
+
+    stem = os.path.splitext(os.path.basename(filename or 'image'))[0]
+    semaphore = asyncio.Semaphore(max(1, DEWATERMARK_TILE_CONCURRENCY))
+    completed = 0
+
+    async def process_tile(index: int, tile: bytes) -> Dict[str, Any]:
+        nonlocal completed
+        async with semaphore:
+            result = await call_dewatermark(tile, f'{stem}_tile{index}.jpg', 'image/jpeg', remove_text)
+        completed += 1
+        report_progress('tile_done', completed=completed, tiles=total)
+        return result
+
+    tasks = [asyncio.create_task(process_tile(index, tile)) for index, tile in enumerate(plan.tiles)]
+    plan.tiles = []
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    with observe_stage('dewatermark', 'tile_stitch'):
+        merged = await asyncio.to_thread(merge_tile_results, plan, results)
+    return {
+        'success': True,
+        'imageBase64': merged['imageBase64'],
+        'session_id': f'tiled-{uuid.uuid4().hex}',
+        'mask': merged['mask'],
+        'watermark_mask': merged['watermark_mask'],
+        'tiles': total
+    }
+
+
+async def dewatermark_image(image_data: bytes, filename: str, content_type: str,
+                            params: Dict[str, Any]) -> Dict[str, Any]:
+    """dewatermark.ai 提供方入口：大图走分块模式，其余直接调用"""
+    remove_text = params.get('remove_text', True)
+    if await asyncio.to_thread(needs_tiling, image_data):
+        return await call_dewatermark_tiled(image_data, filename, remove_text)
+    return await call_dewatermark(image_data, filename, content_type, remove_text)
+
+
+class MaskStore:
+    """
+    去水印蒙版暂存（session_id -> {mask, watermark_mask}，按字节数 LRU 淘汰）
+
+    蒙版默认不随结果返回，客户端需要时再通过 /api/dewatermark/{session_id}/masks 获取
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: 'OrderedDict[str, Dict[str, str]]' = OrderedDict()
+
+    def put(self, session_id: str, masks: Dict[str, str]):
+        if not session_id or not any(masks.values()):
+            return
+        size = sum(len(value) for value in masks.values())
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(session_id, None)
+        if old is not None:
+            self.total_bytes -= sum(len(value) for value in old.values())
+        self._entries[session_id] = masks
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= sum(len(value) for value in evicted.values())
+
+    def get(self, session_id: str) -> Optional[Dict[str, str]]:
+        masks = self._entries.get(session_id)
+        if masks is not None:
+            self._entries.move_to_end(session_id)
+        return masks
+
+
+mask_store = MaskStore(DEWATERMARK_MASK_STORE_BYTES)
+
+MASK_KINDS = ('mask', 'watermark_mask')
+
+
+def split_dewatermark_masks(result: Dict[str, Any], include_masks: bool) -> Dict[str, Any]:
+    """
+    把蒙版存入 mask_store，并按需从结果中去掉（不修改缓存中的原始结果）
+
+    未请求蒙版时返回 masks_url，客户端可稍后按 session_id 获取
+    """
+    session_id = result.get('session_id', '')
+    mask_store.put(session_id, {kind: result.get(kind, '') for kind in MASK_KINDS})
+    if include_masks:
+        return result
+    stripped = {key: value for key, value in result.items() if key not in MASK_KINDS}
+    if session_id and mask_store.get(session_id) is not None:
+        stripped['masks_url'] = f'/api/dewatermark/{session_id}/masks'
+    return stripped
+
+
+def accepts_image(accept: Optional[str]) -> bool:
+    """
+    Accept 头中 image/* 的优先级高于 JSON 时返回 True
+
+    缺省、*/* 或与 JSON 同等优先级时仍返回 JSON，保持原有客户端行为不变
+    """
+    if not accept:
+        return False
+    best_image = best_json = 0.0
+    for part in accept.split(','):
+        media, *params = [item.strip() for item in part.split(';')]
+        q = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        media = media.lower()
+        if media.startswith('image/'):
+            best_image = max(best_image, q)
+        elif media in ('application/json', 'application/*', '*/*'):
+            best_json = max(best_json, q)
+    return best_image > 0 and best_image > best_json
+
+
+def sniff_image_type(data: bytes) -> str:
+    """根据文件头判断图片 MIME 类型"""
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'application/octet-stream'
+
+
+def decode_base64_image(encoded: str) -> bytes:
+    """一次性解码 Base64 图片（兼容 data URI 前缀）"""
+    if encoded.startswith('data:'):
+        encoded = encoded.partition(',')[2]
+    return base64.b64decode(encoded)
+
+
+BASE64_PATTERN = re.compile(r'[A-Za-z0-9+/]*={0,2}')
+
+
+def _normalize_base64(encoded: str) -> Tuple[str, bytes]:
+    """
+    去掉 data URI 前缀和全部空白字符，校验整个字符串并解码第一块（用于判断图片类型）
+
+    校验通过后，按 4 的倍数切分的每一块都能独立解码，解码后的总长度也可以预先算出
+
+    异常:
+        ValueError: 不是合法的 Base64
+    """
+    if encoded.startswith('data:'):
+        encoded = encoded.partition(',')[2]
+    encoded = ''.join(encoded.split())
+    if len(encoded) % 4 or not BASE64_PATTERN.fullmatch(encoded):
+        raise ValueError('invalid base64 image data')
+    return encoded, base64.b64decode(encoded[:BASE64_DECODE_CHUNK_CHARS], validate=True)
+
+
+async def base64_image_response(encoded: str, headers: Dict[str, str]) -> StreamingResponse:
+    """
+    把 Base64 图片以二进制流返回
+
+    解码在线程中分块进行，不阻塞事件循环，也不会在内存中同时保留完整的解码副本；
+    数据在发送响应头之前整体校验，不合法时返回 502，不会发出被截断的响应
+    """
+    try:
+        encoded, first_chunk = await asyncio.to_thread(_normalize_base64, encoded)
+    except ValueError:
+        raise HTTPException(status_code=502, detail='API 返回的图片数据无法解码')
+
+    padding = len(encoded) - len(encoded.rstrip('='))
+    size = len(encoded) // 4 * 3 - padding
+
+    async def iter_decoded():
+        yield first_chunk
+        for offset in range(BASE64_DECODE_CHUNK_CHARS, len(encoded), BASE64_DECODE_CHUNK_CHARS):
+            yield await asyncio.to_thread(base64.b64decode, encoded[offset:offset + BASE64_DECODE_CHUNK_CHARS])
+
+    return StreamingResponse(
+        iter_decoded(),
+        media_type=sniff_image_type(first_chunk),
+        headers={**headers, 'Content-Length': str(size)}
+    )
+
+# ============================================================================
+# 14. 提供方注册与路由（滚动延迟评分 + 对冲请求）
+# ============================================================================
+# 每个操作可以注册多个提供方（不同上游、不同模型版本或本地引擎）:
+# - 每个提供方记录最近一段时间的延迟和错误，按 p50 * (1 + 错误惩罚) 排序，熔断中的排在最后
+# - 主请求超过其 p95 仍未返回时，向排名第二的提供方发送对冲请求，先成功者胜出，另一个被取消
+# - 主请求返回可重试的错误（429 / 5xx）时，切换到下一个提供方；
+#   计费提供方的请求已经发出（超时 / 504 / 响应异常）时可能已经计费，只再切换到不计费的提供方（本地引擎），
+#   上游未受理的错误（连接失败 / 429 / 带 Retry-After 的 503 / 熔断拒绝）才切换到下一个计费提供方
+
+
+class ProviderStats:
+    """提供方的滚动延迟 / 错误统计（按时间窗口和样本数双重限制）"""
+
+    ERROR_PENALTY = 10.0
+
+    def __init__(self):
+        self.samples: deque = deque(maxlen=PROVIDER_WINDOW_SIZE)
+
+    def record(self, latency: float, ok: bool):
+        self.samples.append((time.monotonic(), latency, ok))
+
+    def _recent(self) -> list:
+        cutoff = time.monotonic() - PROVIDER_WINDOW_SECONDS
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        return list(self.samples)
+
+    def summary(self) -> Dict[str, Any]:
+        samples = self._recent()
+        latencies = sorted(latency for _, latency, ok in samples if ok)
+        errors = sum(1 for _, _, ok in samples if not ok)
+
+        def quantile(q: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+        return {
+            'samples': len(samples),
+            'error_rate': errors / len(samples) if samples else 0.0,
+            'p50': quantile(0.5),
+            'p95': quantile(0.95),
+        }
+
+    def score(self) -> float:
+        """预期耗时评分，越小越优先；样本不足时返回 0，让新提供方先得到试用"""
+        summary = self.summary()
+        if summary['samples'] < PROVIDER_MIN_SAMPLES or summary['p50'] is None:
+            return 0.0
+        return summary['p50'] * (1 + self.ERROR_PENALTY * summary['error_rate'])
+
+    def hedge_delay(self) -> Optional[float]:
+        """对冲等待时间（该提供方的 p95），样本不足时返回 None"""
+        summary = self.summary()
+        if summary['samples'] < PROVIDER_MIN_SAMPLES or summary['p95'] is None:
+            return None
+        return max(HEDGE_MIN_DELAY, summary['p95'])
+
+
+class Provider:
+    """
+    一个可执行某个操作的后端
+
+    call 接收关键字参数 image_data / filename / content_type / params，返回结果字典；
+    billed 表示每次调用都可能产生费用（付费上游），本地引擎为 False；
+    missing_key 为缺少的 API 密钥环境变量名（未配置密钥的提供方不参与路由）
+    """
+
+    def __init__(self, name: str, operation: str, call: Callable[..., Awaitable[Dict[str, Any]]],
+                 guard: Optional[UpstreamGuard] = None, billed: bool = True, missing_key: Optional[str] = None):
+        self.name = name
+        self.operation = operation
+        self.call = call
+        self.guard = guard
+        self.billed = billed
+        self.missing_key = missing_key
+        self.stats = ProviderStats()
+
+    def available(self) -> bool:
+        return self.guard is None or self.guard.effective_state() != 'open'
+
+    def snapshot(self) -> Dict[str, Any]:
+        summary = self.stats.summary()
+        return {
+            'provider': self.name,
+            'upstream': self.guard.name if self.guard else None,
+            'billed': self.billed,
+            'configured': self.missing_key is None,
+            'available': self.available(),
+            'samples': summary['samples'],
+            'error_rate': round(summary['error_rate'], 4),
+            'p50_seconds': round(summary['p50'], 3) if summary['p50'] is not None else None,
+            'p95_seconds': round(summary['p95'], 3) if summary['p95'] is not None else None,
+            'score': round(self.stats.score(), 3),
+        }
+
+
+class ProviderDeclined(Exception):
+    """提供方判断自己不适合处理该请求（不计为错误，直接交给下一个提供方）"""
+
+
+def is_retryable_error(error: HTTPException) -> bool:
+    """429 / 5xx 视为提供方的问题（可切换提供方），其余 4xx 是请求本身的问题"""
+    return error.status_code == 429 or error.status_code >= 500
+
+
+class ProviderRouter:
+    """提供方注册表与路由"""
+
+    def __init__(self):
+        self.providers: Dict[str, List[Provider]] = {}
+
+    def register(self, provider: Provider):
+        self.providers.setdefault(provider.operation, []).append(provider)
+
+    def usable(self, operation: str) -> List[Provider]:
+        """已配置（不缺 API 密钥）的提供方"""
+        return [provider for provider in self.providers.get(operation, []) if provider.missing_key is None]
+
+    def require(self, operation: str):
+        """没有任何可用的提供方时返回 500（提示缺少的 API 密钥）"""
+        if self.usable(operation):
+            return
+        missing = sorted({provider.missing_key for provider in self.providers.get(operation, [])})
+        if not missing:
+            raise HTTPException(status_code=500, detail=f'No provider configured for {operation}')
+        logger.error('API 密钥未配置', extra={'operation': operation, 'missing': missing})
+        raise HTTPException(status_code=500, detail=f'{", ".join(missing)} not configured. Please add it to .env file')
+
+    def rank(self, operation: str) -> List[Provider]:
+        """已配置的提供方按可用性和评分排序（评分相同时保持注册顺序）"""
+        return sorted(self.usable(operation), key=lambda provider: (not provider.available(), provider.stats.score()))
+
+    async def _run(self, provider: Provider, request: Dict[str, Any]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            result = await provider.call(**request)
+        except asyncio.CancelledError:
+            PROVIDER_CALLS.labels(provider.operation, provider.name, 'cancelled').inc()
+            raise
+        except ProviderDeclined:
+            PROVIDER_CALLS.labels(provider.operation, provider.name, 'declined').inc()
+            raise
+        except HTTPException as e:
+            if is_retryable_error(e):
+                provider.stats.record(time.perf_counter() - start, ok=False)
+            PROVIDER_CALLS.labels(provider.operation, provider.name, 'error').inc()
+            raise
+        except Exception:
+            provider.stats.record(time.perf_counter() - start, ok=False)
+            PROVIDER_CALLS.labels(provider.operation, provider.name, 'error').inc()
+            raise
+        provider.stats.record(time.perf_counter() - start, ok=True)
+        PROVIDER_CALLS.labels(provider.operation, provider.name, 'success').inc()
+        return result
+
+    async def call(self, operation: str, **request) -> Dict[str, Any]:
+        """
+        按排名调用提供方，必要时对冲或切换
+
+        返回:
+            胜出提供方的结果（附带 provider 字段）
+        """
+        self.require(operation)
+        remaining = self.rank(operation)
+
+        pending: Dict[asyncio.Task, Provider] = {}
+        hedged = False
+        last_error: Optional[BaseException] = None
+
+        def launch():
+            provider = remaining.pop(0)
+            pending[asyncio.create_task(self._run(provider, request))] = provider
+            return provider
+
+        primary = launch()
+        try:
+            while pending:
+                timeout = None
+                if HEDGE_ENABLED and not hedged and remaining and len(pending) == 1:
+                    timeout = primary.stats.hedge_delay()
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # 主请求已超过其 p95，向下一个提供方发送对冲请求
+                    hedged = True
+                    hedge = launch()
+                    PROVIDER_HEDGES.labels(operation, 'sent').inc()
+                    report_progress('hedging', provider=hedge.name)
+                    logger.info('发送对冲请求', extra={
+                        'operation': operation, 'primary': primary.name, 'hedge': hedge.name,
+                        'delay': round(timeout, 2)
+                    })
+                    continue
+
+                for task in done:
+                    provider = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        if hedged:
+                            PROVIDER_HEDGES.labels(operation, 'won' if provider is not primary else 'lost').inc()
+                        return {**task.result(), 'provider': provider.name}
+
+                    last_error = error
+                    if isinstance(error, HTTPException) and not is_retryable_error(error):
+                        raise error
+                    if not isinstance(error, ProviderDeclined):
+                        logger.warning('提供方调用失败', extra={
+                            'operation': operation, 'provider': provider.name, 'error': str(error)
+                        })
+                    if provider.billed and not isinstance(error, (ProviderDeclined, UpstreamNotAccepted)):
+                        # 请求可能已被上游处理并计费，不再发给其他计费提供方，避免重复计费
+                        skipped = [item.name for item in remaining if item.billed]
+                        remaining = [item for item in remaining if not item.billed]
+                        if skipped:
+                            logger.warning('计费提供方请求已发出，不再切换到其他计费提供方', extra={
+                                'operation': operation, 'provider': provider.name, 'skipped': skipped
+                            })
+
+                # 没有在途请求时切换到下一个提供方
+                if not pending and remaining:
+                    launch()
+
+            if isinstance(last_error, ProviderDeclined):
+                raise HTTPException(status_code=500, detail=f'No provider could handle this {operation} request')
+            raise last_error
+        finally:
+            # 取消落败 / 未完成的请求（会释放上游并发槽位）
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            operation: [provider.snapshot() for provider in self.rank(operation)] + [
+                provider.snapshot() for provider in providers if provider.missing_key is not None
+            ]
+            for operation, providers in self.providers.items()
+        }
+
+
+class LocalEnginePool:
+    """
+    本地 CPU 去背景引擎的进程池与批处理调度
+
+    每个工作进程启动时加载一次模型；同时排队的请求合并为一批送入同一个进程，
+    摊薄进程间通信和推理的固定开销
+    """
+
+    def __init__(self, workers: int, max_batch: int):
+        self.workers = max(1, workers)
+        self.max_batch = max(1, max_batch)
+        self.counters = {'batches': 0, 'images': 0, 'accepted': 0, 'declined': 0}
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._dispatchers: List[asyncio.Task] = []
+
+    async def start(self):
+        settings = {
+            'model': LOCAL_ENGINE_MODEL,
+            'max_edge': LOCAL_ENGINE_MAX_EDGE,
+            'tolerance': LOCAL_ENGINE_TOLERANCE,
+            'softness': LOCAL_ENGINE_SOFTNESS,
+            'border_ratio': LOCAL_ENGINE_BORDER_RATIO,
+            'min_foreground': LOCAL_ENGINE_MIN_FOREGROUND,
+            'max_foreground': LOCAL_ENGINE_MAX_FOREGROUND,
+            'min_contrast': LOCAL_ENGINE_MIN_CONTRAST,
+            'compress_level': REMOVEBG_PNG_COMPRESS_LEVEL,
+        }
+        # spawn: 工作进程只导入 local_engine，不继承事件循环和线程状态
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=local_engine.init_worker,
+            initargs=(settings,),
+        )
+        # 预先启动所有工作进程并加载模型，避免第一批请求承担启动开销
+        loop = asyncio.get_running_loop()
+        engines = await asyncio.gather(*(
+            loop.run_in_executor(self._executor, local_engine.engine_name) for _ in range(self.workers)
+        ))
+        if LOCAL_ENGINE_MODEL and 'onnx' not in engines:
+            logger.warning('ONNX 模型加载失败（未安装 onnxruntime 或模型无效），使用经典算法',
+                           extra={'model': LOCAL_ENGINE_MODEL})
+        self._queue = asyncio.Queue()
+        self._dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+        logger.info('本地去背景引擎已启动', extra={
+            'workers': self.workers, 'model': LOCAL_ENGINE_MODEL or 'classical', 'max_batch': self.max_batch
+        })
+
+    async def stop(self):
+        for task in self._dispatchers:
+            task.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._dispatchers = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def segment(self, image_data: bytes) -> Optional[Tuple[bytes, str]]:
+        """排队等待分割，返回 (PNG 字节, 引擎名)；不适合本地处理时返回 None"""
+        if self._queue is None:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image_data, future))
+        return await future
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            batch = [(data, future) for data, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+
+            LOCAL_ENGINE_BATCH_SIZE.observe(len(batch))
+            self.counters['batches'] += 1
+            self.counters['images'] += len(batch)
+            try:
+                with observe_stage('remove-background', 'local_engine'):
+                    results = await loop.run_in_executor(
+                        self._executor, local_engine.segment_batch, [data for data, _ in batch]
+                    )
+            except Exception:
+                logger.exception('本地引擎执行失败')
+                results = [None] * len(batch)
+
+            for (_, future), result in zip(batch, results):
+                self.counters['accepted' if result is not None else 'declined'] += 1
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': LOCAL_ENGINE_ENABLED,
+            'workers': self.workers,
+            'queued': self._queue.qsize() if self._queue else 0,
+            **self.counters,
+        }
+
+
+local_engine_pool = LocalEnginePool(LOCAL_ENGINE_WORKERS, LOCAL_ENGINE_MAX_BATCH)
+
+
+async def call_local_engine(image_data: bytes, **_) -> Dict[str, Any]:
+    """本地引擎去背景；无法处理时抛出 ProviderDeclined，由路由回退到 302.AI"""
+    report_progress('local_engine')
+    outcome = await local_engine_pool.segment(image_data)
+    if outcome is None:
+        raise ProviderDeclined('local engine declined the image')
+    png_data, engine = outcome
+    name = await asyncio.to_thread(result_file_name, png_data, 'removebg-local')
+    url = await asyncio.to_thread(save_result_file, png_data, name)
+    logger.info('本地引擎去背景成功', extra={'engine': engine, 'bytes': len(png_data)})
+    return {
+        'processed_url': url,
+        'api': f'local-{engine}',
+        'cost': '0',
+        'direct_url': False
+    }
+
+
+def missing_api_key(env_name: str, value: str, placeholder: str = '') -> Optional[str]:
+    """密钥未配置（为空或仍是示例占位值）时返回环境变量名"""
+    return env_name if not value or value == placeholder else None
+
+
+provider_router = ProviderRouter()
+if LOCAL_ENGINE_ENABLED:
+    provider_router.register(Provider('local-cpu', 'remove-background', call_local_engine, billed=False))
+provider_router.register(Provider(
+    '302.ai-removebg-v2', 'remove-background',
+    lambda image_data, content_type, **_: call_removebg(image_data, content_type),
+    UPSTREAMS['302.ai'],
+    missing_key=missing_api_key('AI302_API_KEY', AI302_API_KEY, 'YOUR_302_AI_API_KEY_HERE')
+))
+if REMOVEBG_ALT_API_URL:
+    provider_router.register(Provider(
+        REMOVEBG_ALT_NAME, 'remove-background',
+        lambda image_data, content_type, **_: call_removebg(
+            image_data, content_type, api_url=REMOVEBG_ALT_API_URL, api_name=REMOVEBG_ALT_NAME
+        ),
+        UPSTREAMS['302.ai'],
+        missing_key=missing_api_key('AI302_API_KEY', AI302_API_KEY, 'YOUR_302_AI_API_KEY_HERE')
+    ))
+provider_router.register(Provider(
+    'dewatermark.ai', 'dewatermark', dewatermark_image,
+    UPSTREAMS['dewatermark.ai'],
+    missing_key=missing_api_key('DEWATERMARK_API_KEY', DEWATERMARK_API_KEY)
+))
+
+# ============================================================================
+# 15. 异步任务引擎（提交 / 轮询 / SSE 进度）
+# ============================================================================
+# 所有处理请求都以任务形式执行：
+# - 任务进入有界队列，由固定数量的 worker 协程处理
+# - 客户端可以立即拿到 job_id，通过轮询或 SSE 获取进度和结果
+# - 同步端点只是"提交任务并等待完成"的薄封装
+# - 已结束的任务在 JOB_TTL_SECONDS 后自动清理
+# - 每个任务带截止时间（排队时间也计算在内），超时或同步请求的客户端断开时取消任务和在途上游请求
+
+# 当前正在执行的任务 current_job 定义在日志部分（JobContextFilter 在模块加载阶段的日志中也会读取）
+
+
+def report_progress(stage: str, **data):
+    """向当前任务（或共享调用的所有等待任务）发布一条进度事件（都没有时忽略）"""
+    job = current_job.get()
+    if job is not None:
+        job.publish('progress', {'stage': stage, **data})
+        return
+    # 合并后的共享调用：发给所有仍在等待结果的任务
+    call = current_call.get()
+    if call is not None:
+        for waiter in list(call.jobs):
+            waiter.publish('progress', {'stage': stage, **data})
+
+
+class Job:
+    """一个处理任务及其状态、结果和事件历史"""
+
+    TERMINAL_STATES = ('succeeded', 'failed')
+    # 取消原因 -> (状态码, 错误信息)
+    CANCEL_ERRORS = {
+        'client_disconnected': (499, 'Client closed request'),
+        'deadline_exceeded': (504, 'Request deadline exceeded'),
+    }
+
+    def __init__(self, operation: str, payload: Dict[str, Any], budget: Optional[float] = None,
+                 priority: int = PRIORITY_JOB):
+        self.id = uuid.uuid4().hex
+        self.operation = operation
+        self.priority = priority
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[Dict[str, Any]] = None
+        self.cache_status: Optional[str] = None
+        # 图片数据只在执行前保留，执行后立即释放
+        self.payload: Optional[Dict[str, Any]] = payload
+        self.events: list = []
+        self._subscribers: set = set()
+        self._done = asyncio.Event()
+        # 截止时间（monotonic）与到期定时器；执行中的处理协程（用于取消）
+        self.deadline: Optional[float] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        if budget is not None:
+            self.deadline = time.monotonic() + budget
+            self._timer = asyncio.get_running_loop().call_later(budget, self.cancel, 'deadline_exceeded')
+        self.started_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.cancel_reason: Optional[str] = None
+        # 是否登记在 JobManager 中（可通过 /api/jobs/{job_id} 查询）
+        self.retained = True
+
+    @property
+    def finished(self) -> bool:
+        return self.status in self.TERMINAL_STATES
+
+    def publish(self, event: str, data: Dict[str, Any]):
+        """记录事件并推送给所有 SSE 订阅者"""
+        self.updated_at = time.time()
+        record = {'event': event, 'data': {'job_id': self.id, 'time': self.updated_at, **data}}
+        self.events.append(record)
+        for queue in self._subscribers:
+            queue.put_nowait(record)
+
+    def set_status(self, status: str, **data):
+        self.status = status
+        if self.finished:
+            self.finished_at = time.time()
+            if self._timer is not None:
+                self._timer.cancel()
+        self.publish('status', {'status': status, **data})
+        if self.finished:
+            self._done.set()
+
+    def cancel(self, reason: str):
+        """
+        放弃任务（reason: client_disconnected / deadline_exceeded）
+
+        排队中的任务直接标记为失败；执行中的任务取消处理协程，
+        在途上游请求和待执行的重试随之取消，由 JobManager 记录失败
+        """
+        if self.finished or self.cancel_reason is not None:
+            return
+        self.cancel_reason = reason
+        if self.task is not None:
+            self.task.cancel()
+        else:
+            self.abandon()
+
+    def abandon(self):
+        """按取消原因把任务标记为失败，并记录被放弃的工作量"""
+        stage = 'running' if self.started_at is not None else 'queued'
+        elapsed = time.time() - (self.started_at or self.created_at)
+        ABANDONED_WORK.labels(self.operation, self.cancel_reason, stage).inc()
+        ABANDONED_SECONDS.labels(self.operation, self.cancel_reason).observe(elapsed)
+        logger.warning('放弃任务', extra={
+            'job_id': self.id, 'operation': self.operation, 'reason': self.cancel_reason,
+            'stage': stage, 'elapsed': round(elapsed, 2)
+        })
+        status_code, detail = self.CANCEL_ERRORS[self.cancel_reason]
+        self.error = {'status_code': status_code, 'detail': detail}
+        self.payload = None
+        self.set_status('failed', error=self.error)
+        ERRORS.labels(self.operation, str(status_code)).inc()
+
+    def subscribe(self) -> 'asyncio.Queue':
+        queue: asyncio.Queue = asyncio.Queue()
+        for record in self.events:
+            queue.put_nowait(record)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: 'asyncio.Queue'):
+        self._subscribers.discard(queue)
+
+    async def wait(self):
+        await self._done.wait()
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            'job_id': self.id,
+            'operation': self.operation,
+            'status': self.status,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+            'finished_at': self.finished_at,
+        }
+        if self.status == 'succeeded':
+            data['result'] = self.result
+            data['cache'] = self.cache_status
+        elif self.status == 'failed':
+            data['error'] = self.error
+        return data
+
+
+# 后处理配置参与去背景的缓存键（配置变化后不会命中缺少对应文件的旧结果）
+REMOVE_BACKGROUND_CACHE_PARAMS: Dict[str, Any] = {
+    'postprocess': {
+        'renditions': POSTPROCESS_RENDITIONS, 'formats': POSTPROCESS_FORMATS,
+        'trim': POSTPROCESS_TRIM, 'padding': POSTPROCESS_TRIM_PADDING,
+    }
+} if POSTPROCESS_ENABLED else {}
+
+
+async def compute_remove_background(image_data: bytes, filename: str, content_type: str) -> Dict[str, Any]:
+    """调用去背景提供方，开启 POSTPROCESS_ENABLED 时再生成裁剪后的多尺寸结果"""
+    result = await provider_router.call(
+        'remove-background', image_data=image_data, filename=filename, content_type=content_type, params={}
+    )
+    if POSTPROCESS_ENABLED:
+        result = await postprocess_cutout(result)
+    return result
+
+
+async def _run_remove_background(payload: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+    result, cache_status = await cached_call(
+        'remove-background', payload['image_data'], REMOVE_BACKGROUND_CACHE_PARAMS,
+        lambda: compute_remove_background(payload['image_data'], payload.get('filename', ''), payload['content_type'])
+    )
+    # 尺寸 / 格式选择不参与缓存键，只决定 processed_url 指向哪个文件
+    return select_rendition(result, payload['params']), cache_status
+
+
+async def _run_dewatermark(payload: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+    remove_text = payload['params'].get('remove_text', True)
+    result, cache_status = await cached_call(
+        'dewatermark', payload['image_data'], {'remove_text': remove_text},
+        lambda: provider_router.call(
+            'dewatermark', image_data=payload['image_data'], filename=payload['filename'],
+            content_type=payload['content_type'], params={'remove_text': remove_text}
+        )
+    )
+    # 蒙版不参与缓存键，只决定是否随结果返回
+    return split_dewatermark_masks(result, payload['params'].get('include_masks', False)), cache_status
+
+
+def combine_cache_status(statuses: List[str]) -> str:
+    """多步处理的整体缓存状态：全部命中为 HIT，有任何一步调用了上游为 MISS"""
+    if all(status == 'HIT' for status in statuses):
+        return 'HIT'
+    if 'MISS' in statuses:
+        return 'MISS'
+    return 'COALESCED'
+
+
+async def _run_pipeline(payload: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+    """
+    服务端串联处理：先去水印，再去背景
+
+    中间结果只保留在内存中，不经过客户端；两步分别使用各自操作的缓存，
+    因此单独调用过 /api/dewatermark 或 /api/remove-background 的结果会被直接复用
+    """
+    image_data = payload['image_data']
+    remove_text = payload['params'].get('remove_text', True)
+
+    # 1. 去水印
+    report_progress('dewatermark')
+    watermark_result, watermark_cache = await cached_call(
+        'dewatermark', image_data, {'remove_text': remove_text},
+        lambda: provider_router.call(
+            'dewatermark', image_data=image_data, filename=payload['filename'],
+            content_type=payload['content_type'], params={'remove_text': remove_text}
+        )
+    )
+    session_id = watermark_result.get('session_id', '')
+    mask_store.put(session_id, {kind: watermark_result.get(kind, '') for kind in MASK_KINDS})
+
+    # 2. 在线程中解码中间图片
+    try:
+        intermediate = await asyncio.to_thread(decode_base64_image, watermark_result['imageBase64'])
+    except ValueError:
+        raise HTTPException(status_code=500, detail='API 返回的图片数据无法解码')
+    if len(intermediate) > REMOVEBG_MAX_SIZE:
+        raise HTTPException(status_code=500, detail='去水印结果超过去背景的大小限制')
+    intermediate_type = sniff_image_type(intermediate[:16])
+    if intermediate_type == 'application/octet-stream':
+        intermediate_type = 'image/png'
+
+    # 3. 去背景
+    report_progress('remove-background', bytes=len(intermediate))
+    cutout_result, cutout_cache = await cached_call(
+        'remove-background', intermediate, REMOVE_BACKGROUND_CACHE_PARAMS,
+        lambda: compute_remove_background(intermediate, payload['filename'], intermediate_type)
+    )
+    del intermediate
+
+    result = {
+        **select_rendition(cutout_result, payload['params']),
+        'session_id': session_id,
+        'steps': {'dewatermark': watermark_cache, 'remove-background': cutout_cache},
+    }
+    if session_id and mask_store.get(session_id) is not None:
+        result['masks_url'] = f'/api/dewatermark/{session_id}/masks'
+    return result, combine_cache_status([watermark_cache, cutout_cache])
+
+
+# 操作名 -> 执行函数（返回 (结果, 缓存状态)）
+OPERATIONS: Dict[str, Callable[[Dict[str, Any]], Awaitable[Tuple[Dict[str, Any], str]]]] = {
+    'remove-background': _run_remove_background,
+    'dewatermark': _run_dewatermark,
+    'pipeline': _run_pipeline,
+}
+
+
+async def wait_for_disconnect(request: Request):
+    """等待客户端断开连接（请求体读完之后，receive() 只会在连接断开时返回 http.disconnect）"""
+    while True:
+        message = await request.receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+class JobManager:
+    """
+    任务管理器
+
+    - submit: 入队（队列满时返回 503），budget 为任务的处理时限（秒），priority 为上游预算排队优先级；
+      retain=False 的任务（同步请求）不登记，结果只交给 wait 的调用方
+    - wait: 等待结果；传入 request 时客户端断开会取消任务
+    - worker: 固定数量的协程从队列取任务执行
+    - sweeper: 定期清理过期任务；已完成任务的结果总量超过 max_result_bytes 时提前清理最早完成的任务
+    """
+
+    def __init__(self, workers: int, queue_size: int, ttl: float, max_result_bytes: int):
+        self.worker_count = workers
+        self.queue_size = queue_size
+        self.ttl = ttl
+        self.max_result_bytes = max_result_bytes
+        self.jobs: Dict[str, Job] = {}
+        # 已完成任务 ID -> 结果字节数（按完成顺序）
+        self._results: 'OrderedDict[str, int]' = OrderedDict()
+        self._result_bytes = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: list = []
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        JOBS_QUEUED.set_function(self._queue.qsize)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+        self._tasks.append(asyncio.create_task(self._sweeper()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def running(self) -> bool:
+        """队列已创建且所有 worker / sweeper 协程都还在运行"""
+        return self._queue is not None and bool(self._tasks) and not any(task.done() for task in self._tasks)
+
+    def submit(self, operation: str, budget: Optional[float] = None, priority: int = PRIORITY_JOB,
+               retain: bool = True, **payload) -> Job:
+        if operation not in OPERATIONS:
+            raise HTTPException(status_code=400, detail=f'Unknown operation: {operation}')
+        if self._queue is None:
+            raise HTTPException(status_code=503, detail='Job engine is not running')
+
+        job = Job(operation, payload, budget, priority)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            job.error = {'status_code': 503, 'detail': 'Server is busy, please try again later'}
+            job.set_status('failed', error=job.error)
+            logger.warning('任务队列已满，拒绝请求', extra={'queue_size': self.queue_size})
+            raise HTTPException(status_code=503, detail=job.error['detail'])
+
+        job.retained = retain
+        if retain:
+            self.jobs[job.id] = job
+        job.set_status('queued', position=self._queue.qsize())
+        return job
+
+    def _retain_result(self, job: Job):
+        """记录已完成任务的结果大小，超过上限时清理最早完成的任务"""
+        size = payload_bytes(job.result)
+        self._results[job.id] = size
+        self._result_bytes += size
+        evicted = 0
+        while self._result_bytes > self.max_result_bytes and len(self._results) > 1:
+            job_id = next(iter(self._results))
+            self._forget(job_id)
+            evicted += 1
+        if evicted:
+            logger.info('任务结果超过保留上限，提前清理', extra={
+                'count': evicted, 'bytes': self._result_bytes, 'max_bytes': self.max_result_bytes
+            })
+
+    def _forget(self, job_id: str):
+        self.jobs.pop(job_id, None)
+        self._result_bytes -= self._results.pop(job_id, 0)
+
+    def get(self, job_id: str) -> Job:
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail='Job not found or expired')
+        return job
+
+    async def wait(self, job: Job, request: Optional[Request] = None) -> Dict[str, Any]:
+        """
+        等待任务结束，失败时按原状态码抛出 HTTPException
+
+        传入 request 时同时监听客户端连接，客户端断开后立即取消任务（结果已无人读取）
+        """
+        if request is None:
+            await job.wait()
+        else:
+            waiter = asyncio.create_task(job.wait())
+            watcher = asyncio.create_task(wait_for_disconnect(request))
+            try:
+                await asyncio.wait((waiter, watcher), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+                watcher.cancel()
+                if not job.finished:
+                    job.cancel('client_disconnected')
+        if job.status == 'failed':
+            raise HTTPException(
+                status_code=job.error['status_code'],
+                detail=job.error['detail'],
+                headers=job.error.get('headers')
+            )
+        return job.result
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                # 排队期间已被取消（客户端断开 / 超过截止时间）的任务直接跳过
+                if not job.finished:
+                    await self._execute(job)
+            finally:
+                self._queue.task_done()
+
+    async def _execute(self, job: Job):
+        job.started_at = time.time()
+        job.set_status('running')
+        token = current_job.set(job)
+        deadline_token = request_deadline.set(job.deadline)
+        priority_token = request_priority.set(job.priority)
+        JOBS_RUNNING.inc()
+        try:
+            # 在独立的协程中执行，取消任务时不会连带取消 worker
+            job.task = asyncio.create_task(OPERATIONS[job.operation](job.payload))
+            try:
+                job.result, job.cache_status = await job.task
+            except asyncio.CancelledError:
+                if job.cancel_reason is None:
+                    raise
+                job.abandon()
+                return
+            if job.retained:
+                self._retain_result(job)
+            job.set_status('succeeded', cache=job.cache_status)
+        except HTTPException as e:
+            job.error = {'status_code': e.status_code, 'detail': e.detail}
+            if e.headers:
+                job.error['headers'] = dict(e.headers)
+            job.set_status('failed', error=job.error)
+        except asyncio.CancelledError:
+            if job.task is not None:
+                job.task.cancel()
+            job.error = {'status_code': 503, 'detail': 'Job cancelled'}
+            job.set_status('failed', error=job.error)
+            raise
+        except Exception as e:
+            logger.exception('任务执行异常')
+            job.error = {'status_code': 500, 'detail': f'Job failed: {str(e)}'}
+            job.set_status('failed', error=job.error)
+        finally:
+            JOBS_RUNNING.dec()
+            request_deadline.reset(deadline_token)
+            request_priority.reset(priority_token)
+            current_job.reset(token)
+            job.task = None
+            job.payload = None
+            if job.status == 'failed' and job.cancel_reason is None:
+                ERRORS.labels(job.operation, str(job.error['status_code'])).inc()
+
+    async def _sweeper(self):
+        while True:
+            await asyncio.sleep(min(60.0, self.ttl))
+            now = time.time()
+            expired = [
+                job_id for job_id, job in self.jobs.items()
+                if job.finished and now - job.finished_at > self.ttl
+            ]
+            for job_id in expired:
+                self._forget(job_id)
+            if expired:
+                logger.info('清理过期任务', extra={'count': len(expired)})
+
+    def stats(self) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        for job in self.jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            'workers': self.worker_count,
+            'queue_size': self.queue_size,
+            'queued': self._queue.qsize() if self._queue else 0,
+            'jobs': counts,
+            'result_bytes': self._result_bytes,
+            'max_result_bytes': self.max_result_bytes,
+        }
+
+
+job_manager = JobManager(JOB_WORKERS, JOB_QUEUE_SIZE, JOB_TTL_SECONDS, JOB_RESULTS_MAX_BYTES)
+
+
+def job_response_headers(job: Job) -> Dict[str, str]:
+    return {'X-Cache': job.cache_status or 'MISS', 'X-Job-Id': job.id}
+
+
+def job_links(job: Job) -> Dict[str, Any]:
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': f'/api/jobs/{job.id}',
+        'events_url': f'/api/jobs/{job.id}/events',
+    }
+
+# ============================================================================
+# 16. 上传校验
+# ============================================================================
+
+def file_too_large(max_size: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f'File too large. Max size is {max_size // (1024 * 1024)}MB')
+
+
+async def read_upload_limited(upload: UploadFile, max_size: int) -> bytes:
+    """
+    读取上传文件，边读边检查大小
+
+    - 已知大小（multipart 已落盘到临时文件）时先检查，再一次性读入，只产生一份拷贝
+    - 未知大小时按 UPLOAD_CHUNK_SIZE 分块读取，一旦超限立即返回 413
+    """
+    try:
+        if upload.size is not None:
+            if upload.size > max_size:
+                raise file_too_large(max_size)
+            data = await upload.read(max_size + 1)
+            if len(data) > max_size:
+                raise file_too_large(max_size)
+            return data
+
+        chunks = []
+        total = 0
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > max_size:
+                raise file_too_large(max_size)
+            chunks.append(chunk)
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error('文件读取失败', extra={'error': str(e)})
+        raise HTTPException(status_code=500, detail=f'Failed to read file: {str(e)}')
+
+
+def request_budget(request: Request, default: float) -> Optional[float]:
+    """
+    读取请求的处理时限（秒）
+
+    客户端可通过 X-Request-Timeout 头指定（不超过 REQUEST_DEADLINE_MAX），
+    否则使用 default；default 为 0 时不限制
+    """
+    value = request.headers.get(DEADLINE_HEADER)
+    if value is None:
+        return default if default > 0 else None
+    try:
+        budget = float(value)
+    except ValueError:
+        budget = 0.0
+    if not budget > 0:
+        raise HTTPException(status_code=400, detail=f'Invalid {DEADLINE_HEADER} header, expected seconds > 0')
+    return min(budget, REQUEST_DEADLINE_MAX)
+
+
+def require_api_key(operation: str):
+    """
+    检查操作是否至少有一个可用的提供方（缺少 API 密钥的提供方会被跳过，
+    例如未配置 AI302_API_KEY 但开启了本地引擎时仍可去背景）
+    """
+    if operation == 'pipeline':
+        require_api_key('dewatermark')
+        require_api_key('remove-background')
+        return
+    provider_router.require(operation)
+
+
+async def read_remove_background_upload(image_file: UploadFile) -> Tuple[bytes, str]:
+    """
+    校验并读取去背景请求的上传文件
+
+    返回:
+        (图片字节, MIME 类型)
+    """
+    # ========================================
+    # 1. 验证请求中是否包含文件
+    # ========================================
+    if not image_file:
+        logger.warning("请求中没有 'image_file' 字段")
+        raise HTTPException(status_code=400, detail='No file provided')
+
+    if image_file.filename == '':
+        logger.warning('没有选择文件')
+        raise HTTPException(status_code=400, detail='No file selected')
+
+
+    # ========================================
+    # 2. 验证 API 密钥
+    # ========================================
+    require_api_key('remove-background')
+
+    # ========================================
+    # 3. 读取图片数据到内存
+    # ========================================
+    # 分块读取，超过 16MB 立即返回 413
+    with observe_stage('remove-background', 'upload_read'):
+        image_data = await read_upload_limited(image_file, REMOVEBG_MAX_SIZE)
+    content_type = image_file.content_type or 'image/png'
+    logger.info('文件读取成功', extra={
+        'operation': 'remove-background', 'upload_filename': image_file.filename,
+        'bytes': len(image_data), 'content_type': content_type
+    })
+
+    return image_data, content_type
+
+
+async def read_dewatermark_upload(image: UploadFile,
+                                  max_size: int = DEWATERMARK_UPLOAD_MAX_SIZE) -> Tuple[bytes, str, Optional[str]]:
+    """
+    校验并读取去水印请求的上传文件（分块模式下上限为 DEWATERMARK_TILED_MAX_SIZE）
+
+    返回:
+        (图片字节, 文件名, MIME 类型)
+    """
+    # ========================================
+    # 1. 验证请求
+    # ========================================
+    if not image:
+        logger.warning("请求中没有 'image' 字段")
+        raise HTTPException(status_code=400, detail='No file provided')
+
+    if image.filename == '':
+        logger.warning('没有选择文件')
+        raise HTTPException(status_code=400, detail='No file selected')
+
+
+    # ========================================
+    # 2. 验证 API 密钥
+    # ========================================
+    require_api_key('dewatermark')
+
+    # ========================================
+    # 3. 读取图片数据
+    # ========================================
+    # 分块读取，超过上限立即返回 413
+    with observe_stage('dewatermark', 'upload_read'):
+        image_data = await read_upload_limited(image, max_size)
+    logger.info('文件读取成功', extra={
+        'operation': 'dewatermark', 'upload_filename': image.filename,
+        'bytes': len(image_data), 'content_type': image.content_type
+    })
+
+    return image_data, image.filename, image.content_type
+
+# ============================================================================
+# 17. 批量处理（有界并发 + NDJSON 流式结果）
+# ============================================================================
+# 每个操作允许的最大单文件大小
+OPERATION_MAX_SIZE = {
+    'remove-background': REMOVEBG_MAX_SIZE,
+    'dewatermark': DEWATERMARK_UPLOAD_MAX_SIZE,
+    'pipeline': DEWATERMARK_MAX_SIZE,
+}
+
+BATCH_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+class BatchItem:
+    """批量请求中的单张图片（数据按需读取，避免一次性加载整个批次）"""
+
+    def __init__(self, index: int, filename: str, size: Optional[int],
+                 loader: Callable[[], Awaitable[bytes]]):
+        self.index = index
+        self.filename = filename
+        self.size = size
+        self.loader = loader
+
+
+def _spool_upload(source) -> 'tempfile.SpooledTemporaryFile':
+    """把上传文件复制到独立的临时文件（大文件落盘），使其在请求结束后仍可读取"""
+    spool = tempfile.SpooledTemporaryFile(max_size=BATCH_SPOOL_MEMORY_BYTES)
+    source.seek(0)
+    shutil.copyfileobj(source, spool, 1024 * 1024)
+    spool.seek(0)
+    return spool
+
+
+def _read_spool(spool) -> bytes:
+    spool.seek(0)
+    return spool.read()
+
+
+async def collect_batch_items(files: list, archive: Optional[UploadFile]) -> Tuple[list, list]:
+    """
+    把上传的多个文件和 zip 压缩包展开为 BatchItem 列表
+
+    FastAPI 会在流式响应开始前关闭上传文件，所以先把它们复制到临时文件。
+
+    返回:
+        (BatchItem 列表, 需要在批次结束后关闭的临时文件列表)
+    """
+    items = []
+    spools = []
+
+    for upload in files:
+        if not upload.filename:
+            continue
+        spool = await asyncio.to_thread(_spool_upload, upload.file)
+        spools.append(spool)
+        items.append(BatchItem(
+            len(items), upload.filename, upload.size,
+            lambda spool=spool: asyncio.to_thread(_read_spool, spool)
+        ))
+
+    if archive is not None and archive.filename:
+        spool = await asyncio.to_thread(_spool_upload, archive.file)
+        spools.append(spool)
+        try:
+            zf = zipfile.ZipFile(spool)
+        except zipfile.BadZipFile:
+            for opened in spools:
+                opened.close()
+            raise HTTPException(status_code=400, detail='Invalid zip archive')
+
+        for info in zf.infolist():
+            name = info.filename
+            if info.is_dir() or os.path.basename(name).startswith('.'):
+                continue
+            if not name.lower().endswith(BATCH_IMAGE_EXTENSIONS):
+                continue
+            # 只在处理该条目时才解压（在线程中执行）
+            items.append(BatchItem(
+                len(items), name, info.file_size,
+                lambda info=info: asyncio.to_thread(zf.read, info)
+            ))
+
+    return items, spools
+
+
+async def process_batch_item(operation: str, item: BatchItem, params: Dict[str, Any],
+                             semaphore: asyncio.Semaphore, budget: Optional[float] = None) -> Dict[str, Any]:
+    """
+    处理单个批量条目，错误被转换为该条目的 error 字段而不是中断整个批次
+
+    budget 为每个条目的处理时限（从开始处理该条目时计时），超时记为 504
+    """
+    record: Dict[str, Any] = {'type': 'item', 'index': item.index, 'filename': item.filename}
+    max_size = OPERATION_MAX_SIZE[operation]
+
+    async with semaphore:
+        start_time = time.time()
+        try:
+            if item.size is not None and item.size > max_size:
+                raise file_too_large(max_size)
+
+            image_data = await item.loader()
+            if len(image_data) > max_size:
+                raise file_too_large(max_size)
+
+            content_type = mimetypes.guess_type(item.filename)[0] or 'image/png'
+            payload = {
+                'image_data': image_data,
+                'filename': os.path.basename(item.filename),
+                'content_type': content_type,
+                'params': params,
+            }
+            request_priority.set(PRIORITY_BATCH)
+            if budget is not None:
+                request_deadline.set(time.monotonic() + budget)
+            try:
+                result, cache_status = await asyncio.wait_for(OPERATIONS[operation](payload), budget)
+            except asyncio.TimeoutError:
+                ABANDONED_WORK.labels(operation, 'deadline_exceeded', 'running').inc()
+                ABANDONED_SECONDS.labels(operation, 'deadline_exceeded').observe(time.time() - start_time)
+                raise deadline_exceeded()
+            record.update({'status': 'ok', 'result': result, 'cache': cache_status})
+        except HTTPException as e:
+            ERRORS.labels(operation, str(e.status_code)).inc()
+            record.update({'status': 'error', 'error': {'status_code': e.status_code, 'detail': e.detail}})
+        except Exception as e:
+            ERRORS.labels(operation, '500').inc()
+            logger.exception('批量条目处理异常', extra={'upload_filename': item.filename})
+            record.update({'status': 'error', 'error': {'status_code': 500, 'detail': f'处理失败: {str(e)}'}})
+        record['elapsed_ms'] = round((time.time() - start_time) * 1000)
+
+    return record
+
+
+async def stream_batch(operation: str, items: list, params: Dict[str, Any], concurrency: int,
+                       spools: list, budget: Optional[float] = None):
+    """
+    按完成顺序逐行输出 NDJSON 结果，最后输出一行汇总
+    客户端断开时取消所有未完成的条目，结束后关闭临时文件
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [
+        asyncio.create_task(process_batch_item(operation, item, params, semaphore, budget))
+        for item in items
+    ]
+    completed = 0
+    succeeded = 0
+    start_time = time.time()
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            record = await next_done
+            completed += 1
+            if record['status'] == 'ok':
+                succeeded += 1
+            yield json.dumps(record, ensure_ascii=False) + '\n'
 
-# 挂载静态文件目录
-app.mount("/static", StaticFiles(directory="static"), name="static")
+        yield json.dumps({
+            'type': 'summary',
+            'operation': operation,
+            'total': len(items),
+            'succeeded': succeeded,
+            'failed': len(items) - succeeded,
+            'elapsed_ms': round((time.time() - start_time) * 1000),
+        }, ensure_ascii=False) + '\n'
+    finally:
+        if completed < len(items):
+            # 客户端中途断开：剩余条目全部放弃
+            ABANDONED_WORK.labels(operation, 'client_disconnected', 'batch_item').inc(len(items) - completed)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for spool in spools:
+            spool.close()
 
 # ============================================================================
-# 5. API 路由
+# 18. API 路由
 # ============================================================================
 
 @app.get('/api/health')
@@ -89,400 +4461,554 @@ async def health_check():
     }
 
 
+@app.get('/api/ready')
+async def readiness_check():
+    """
+    就绪检查端点（供负载均衡器使用，/api/health 只表示进程存活）
+
+    只检查已配置的操作：任务引擎、上游连接和提供方（熔断状态按时钟推算）都正常时返回 200，否则返回 503 并列出原因；
+    未配置的操作（与端点使用同一判断，见 require_api_key）以及滚动延迟 / 错误率超标的提供方
+    只在 degraded 中列出，不影响就绪
+    """
+    reasons = []
+    degraded = []
+    keys = {
+        '302.ai': bool(AI302_API_KEY and AI302_API_KEY != 'YOUR_302_AI_API_KEY_HERE'),
+        'dewatermark.ai': bool(DEWATERMARK_API_KEY),
+    }
+    operations = {
+        operation: bool(provider_router.usable(operation)) for operation in ('remove-background', 'dewatermark')
+    }
+    operations['pipeline'] = operations['remove-background'] and operations['dewatermark']
+    degraded.extend(f'{operation} not configured' for operation, enabled in operations.items() if not enabled)
+    if not any(operations.values()):
+        reasons.append('no operation configured (missing API keys)')
+    if not job_manager.running():
+        reasons.append('job engine is not running')
+
+    upstreams = connection_warmer.snapshot()
+    for origin, status in upstreams.items():
+        if not status['ok']:
+            reasons.append(f'upstream {origin} unreachable: {status["error"]}')
+        elif status['stale']:
+            reasons.append(f'upstream {origin} not checked since {int(time.time() - status["checked_at"])}s')
+
+    providers = provider_router.snapshot()
+    for operation, ranked in providers.items():
+        if not operations.get(operation):
+            continue
+        ranked = [provider for provider in ranked if provider['configured']]
+        if not any(provider['available'] for provider in ranked):
+            reasons.append(f'no available provider for {operation}')
+        for provider in ranked:
+            if provider['samples'] < PROVIDER_MIN_SAMPLES:
+                continue
+            if READINESS_MAX_ERROR_RATE > 0 and provider['error_rate'] > READINESS_MAX_ERROR_RATE:
+                degraded.append(f'{provider["provider"]} error rate {provider["error_rate"]:.0%}')
+            if READINESS_MAX_P95 > 0 and (provider['p95_seconds'] or 0) > READINESS_MAX_P95:
+                degraded.append(f'{provider["provider"]} p95 {provider["p95_seconds"]}s')
+
+    content = {
+        'ready': not reasons,
+        'reasons': reasons,
+        'degraded': degraded,
+        'operations': operations,
+        'config': {
+            'api_keys': keys,
+            'job_workers': JOB_WORKERS,
+            'admission': ADMISSION_ENABLED,
+            'local_engine': LOCAL_ENGINE_ENABLED,
+            'hedge': HEDGE_ENABLED,
+            'prewarm': UPSTREAM_PREWARM_ENABLED,
+        },
+        'pool': connection_pool_stats(),
+        'upstreams': upstreams,
+        'breakers': {name: guard.effective_state() for name, guard in UPSTREAMS.items()},
+        'providers': providers,
+    }
+    return JSONResponse(status_code=200 if not reasons else 503, content=content)
+
+
+@app.get('/api/cache/stats')
+async def cache_stats():
+    """
+    结果缓存统计
+    返回命中/未命中计数和两级缓存的占用情况
+    """
+    return {
+        'enabled': CACHE_ENABLED,
+        'ttl_seconds': CACHE_TTL_SECONDS,
+        **result_cache.stats(),
+        'inflight': singleflight.inflight(),
+        'singleflight': dict(singleflight.counters),
+        'results': result_mirror.stats()
+    }
+
+
+@app.get('/api/upstreams')
+async def upstream_status():
+    """
+    上游服务商状态
+    返回每个服务商的熔断器状态、自适应并发上限、在途请求数和计数器
+    """
+    return {name: guard.snapshot() for name, guard in UPSTREAMS.items()}
+
+
+@app.get('/api/admission')
+async def admission_status():
+    """准入控制状态：各服务商的全局预算、剩余令牌和排队数（所有 worker 共享）"""
+    try:
+        return await asyncio.to_thread(admission.snapshot)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=503, detail=f'Admission store unavailable: {e}')
+
+
+@app.get('/api/providers')
+async def provider_status():
+    """
+    提供方路由状态
+    按当前排名返回每个操作的提供方，以及滚动窗口内的 p50 / p95、错误率和评分
+    """
+    return {
+        'hedge_enabled': HEDGE_ENABLED,
+        'operations': provider_router.snapshot(),
+        'local_engine': local_engine_pool.stats()
+    }
+
+
+@app.get('/metrics')
+async def metrics():
+    """Prometheus 指标端点"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post('/api/remove-background')
-async def remove_background(image_file: UploadFile = File(...)):
+async def remove_background(request: Request, image_file: UploadFile = File(...),
+                            rendition: Optional[str] = Query(None),
+                            output_format: Optional[str] = Query(None, alias='format')):
     """
     图片背景去除 API 端点
     使用 302.AI 的 Removebg-V2 背景消除服务
-    
+
     接收:
         - multipart/form-data 格式
         - 字段名: image_file
-    
+        - 可选查询参数: rendition（thumbnail / preview / full 等）、format（webp / avif / png），
+          需开启 POSTPROCESS_ENABLED；processed_url 指向裁剪后对应尺寸和格式的文件
+
     返回:
         - 成功: {"processed_url": "https://file.302.ai/...", "api": "302.ai-removebg-v2"}
+        - 开启后处理时额外返回 renditions（各尺寸 / 格式的 URL 和字节数）和 trim_box
         - 失败: {"error": "错误消息"}
-    
+
     特性:
         - 价格: 0.01 PTC/次
         - 平均耗时: 10-20秒（V2版本）
         - 使用 Base64 编码直接传输图片
-        - 直接返回302.AI的图片URL
+        - 直接返回302.AI的图片URL（RESULT_MIRROR_ENABLED 时返回本地镜像 URL）
+        - 相同图片重复上传时直接返回缓存结果（响应头 X-Cache: HIT）
+        - 同一图片的并发请求合并为一次上游调用（响应头 X-Cache: COALESCED）
+        - 内部以任务形式执行（响应头 X-Job-Id 用于日志关联，结果不保留），长耗时场景请使用 /api/jobs/remove-background
+        - 处理时限默认 REQUEST_DEADLINE_SECONDS，可通过 X-Request-Timeout 头指定；超时返回 504
+        - 客户端断开时立即取消上游请求
     """
-    print("\n" + "=" * 60)
-    print("📸 接收到背景去除请求")
-    print("=" * 60)
-    
-    # ========================================
-    # 1. 验证请求中是否包含文件
-    # ========================================
-    if not image_file:
-        print("❌ 错误: 请求中没有 'image_file' 字段")
-        raise HTTPException(status_code=400, detail='No file provided')
-    
-    if image_file.filename == '':
-        print("❌ 错误: 没有选择文件")
-        raise HTTPException(status_code=400, detail='No file selected')
-    
-    print(f"📁 文件名: {image_file.filename}")
-    
-    # ========================================
-    # 2. 验证 API 密钥
-    # ========================================
-    if not AI302_API_KEY or AI302_API_KEY == 'YOUR_302_AI_API_KEY_HERE':
-        print("❌ 错误: 302.AI API 密钥未配置")
-        raise HTTPException(
-            status_code=500, 
-            detail='AI302_API_KEY not configured. Please add it to .env file'
-        )
-    
-    # ========================================
-    # 3. 读取图片数据到内存
-    # ========================================
-    try:
-        image_data = await image_file.read()
-        image_filename = image_file.filename
-        content_type = image_file.content_type or 'image/png'
-        print(f"✓ 文件读取成功 ({len(image_data)} bytes, {content_type})")
-    except Exception as e:
-        print(f"❌ 文件读取失败: {e}")
-        raise HTTPException(status_code=500, detail=f'Failed to read file: {str(e)}')
-    
-    # 验证文件大小 (16MB)
-    MAX_SIZE = 16 * 1024 * 1024
-    if len(image_data) > MAX_SIZE:
-        raise HTTPException(status_code=400, detail=f'File too large. Max size is 16MB')
-    
-    # ========================================
-    # 4. 将图片转换为 Base64 编码
-    # ========================================
-    print("\n📦 将图片转换为 Base64 编码...")
-    try:
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
-        image_url = f'data:{content_type};base64,{image_base64}'
-        print(f"✅ Base64 编码完成 ({len(image_base64)} chars, ~{len(image_base64)/1024:.1f}KB)")
-    except Exception as e:
-        print(f"❌ Base64 编码失败: {e}")
-        raise HTTPException(status_code=500, detail=f'Failed to encode image: {str(e)}')
-    
-    # ========================================
-    # 5. 调用 302.AI Removebg-V2 API
-    # ========================================
-    print("\n🟢 调用 302.AI Removebg-V2 API...")
-    print("⏱️  预计耗时: 10-20秒")
-    
-    try:
-        # API 端点和配置
-        api_url = 'https://api.302.ai/302/submit/removebg-v2'
-        headers = {
-            'Authorization': f'Bearer {AI302_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        # 准备JSON请求体
-        payload = {
-            'image_url': image_url
-        }
-        
-        # 发送请求
-        print(f"📤 发送 Base64 编码图片 (data URI, ~{len(image_url)} chars, ~{len(image_url)/1024:.1f}KB)")
-        print(f"📡 发送请求到: {api_url}")
-        print(f"🔐 认证: Bearer {AI302_API_KEY[:10]}...")
-        print(f"⏰ 超时设置: 90秒（V2版本更快）")
-        
-        start_time = time.time()
-        
-        response = requests.post(
-            api_url,
-            headers=headers,
-            json=payload,
-            timeout=(10, 90)  # (连接超时10秒, 读取超时90秒)
-        )
-        
-        elapsed_time = time.time() - start_time
-        print(f"📡 API 响应状态: HTTP {response.status_code}")
-        print(f"⏱️  实际耗时: {elapsed_time:.1f}秒")
-        
-        if response.ok:
-            try:
-                result = response.json()
-                print(f"📦 API 响应数据: {result}")
-                
-                # 检查响应格式 - V2 API 可能返回不同格式
-                # 格式1: {"output": "https://..."}
-                # 格式2: {"image": {"url": "https://..."}}
-                image_url_response = None
-                file_size = 'unknown'
-                
-                if 'output' in result and result['output']:
-                    # V2 格式：直接在 output 字段
-                    image_url_response = result['output']
-                    print(f"✓ 找到图片URL (output 字段)")
-                elif 'image' in result and 'url' in result['image']:
-                    # V3 格式：在 image.url 字段
-                    image_url_response = result['image']['url']
-                    file_size = result['image'].get('file_size', 'unknown')
-                    print(f"✓ 找到图片URL (image.url 字段)")
-                
-                if image_url_response:
-                    print(f"🔗 处理后的图片URL: {image_url_response}")
-                    if file_size != 'unknown':
-                        print(f"📊 文件大小: {file_size} bytes")
-                    print(f"✅ 处理成功! 直接返回302.AI的URL")
-                    print("=" * 60 + "\n")
-                    
-                    # 直接返回302.AI的图片URL，不下载保存（避免超时）
-                    return {
-                        'processed_url': image_url_response,
-                        'api': '302.ai-removebg-v2',
-                        'cost': '0.01 PTC',
-                        'direct_url': True
-                    }
-                
-                elif 'error' in result:
-                    # 处理错误响应
-                    error_msg = result.get('error')
-                    print(f"❌ API 返回错误: {error_msg}")
-                    raise HTTPException(status_code=500, detail=error_msg)
-                
-                else:
-                    # 未知的响应格式
-                    print(f"❌ 未知的响应格式")
-                    raise HTTPException(status_code=500, detail='Unexpected response format')
-            
-            except ValueError as json_error:
-                print(f"❌ JSON解析失败: {json_error}")
-                print(f"响应内容: {response.text[:500]}")
-                raise HTTPException(status_code=500, detail='Invalid JSON response from API')
-        else:
-            print(f"❌ API 请求失败: HTTP {response.status_code}")
-            print(f"   响应内容: {response.text[:500]}")
-            raise HTTPException(
-                status_code=500,
-                detail=f'302.AI API failed with status {response.status_code}'
-            )
-    
-    except requests.exceptions.ConnectionError as conn_err:
-        print(f"❌ 连接错误: {conn_err}")
-        print(f"⚠️  无法连接到302.AI服务器")
-        print(f"💡 建议: 检查网络连接或302.AI服务状态")
-        raise HTTPException(
-            status_code=503,
-            detail='Cannot connect to 302.AI service. Please check your network or try again later.'
-        )
-    
-    except requests.exceptions.Timeout:
-        print("❌ API 请求超时 (90秒)")
-        print(f"💡 提示: 图片大小为 {len(image_data)} bytes ({len(image_data)/1024:.1f}KB)")
-        print(f"💡 Base64 传输大小: {len(image_url)} chars (~{len(image_url)/1024:.1f}KB)")
-        print(f"⚠️  302.AI 服务可能繁忙或图片处理复杂")
-        print(f"💡 建议: 1) 稍后重试 2) 尝试更小的图片 3) 检查 302.AI 服务状态")
-        raise HTTPException(
-            status_code=504,
-            detail='Request timed out after 90 seconds. The 302.AI service might be busy or the image is too complex.'
-        )
-    
-    except Exception as e:
-        print(f"❌ API 调用异常: {e}")
-        print(f"   异常类型: {type(e).__name__}")
-        raise HTTPException(status_code=500, detail=f'API error: {str(e)}')
+    budget = request_budget(request, REQUEST_DEADLINE_SECONDS)
+    selection = parse_rendition_query(rendition, output_format)
+    image_data, content_type = await read_remove_background_upload(image_file)
+
+    # 提交任务并等待结果（优先查缓存）
+    job = job_manager.submit(
+        'remove-background', budget=budget, priority=PRIORITY_INTERACTIVE, retain=False,
+        image_data=image_data, content_type=content_type, params=selection
+    )
+    result = await job_manager.wait(job, request)
+    return JSONResponse(result, headers=job_response_headers(job))
 
 
 @app.post('/api/dewatermark')
-async def remove_watermark(image: UploadFile = File(...)):
+async def remove_watermark(request: Request, image: UploadFile = File(...), remove_text: bool = Form(True),
+                           include_masks: bool = Form(False)):
     """
     图片去水印 API 端点
     使用 dewatermark.ai 的服务去除图片水印
-    
+
     接收:
         - multipart/form-data 格式
         - 字段名: image
-    
+        - 可选字段: remove_text（默认 true，是否同时去除文字水印）
+        - 可选字段: include_masks（默认 false，是否在 JSON 中返回 mask / watermark_mask）
+
     返回:
-        - 成功: {"success": true, "imageBase64": "...", "session_id": "..."}
+        - Accept: image/*: 去水印后的图片二进制流，session_id 在响应头 X-Session-Id 中
+        - 成功: {"success": true, "imageBase64": "...", "session_id": "...", "masks_url": "..."}
         - 失败: {"success": false, "error": "错误消息"}
-    
+
     特性:
         - 自动检测和移除水印
         - 返回 Base64 编码的图片
         - 支持重试机制
+        - 相同图片 + 相同参数直接返回缓存结果（响应头 X-Cache: HIT）
+        - 相同图片 + 相同参数的并发请求合并为一次上游调用
+        - 内部以任务形式执行（响应头 X-Job-Id 用于日志关联，结果不保留），长耗时场景请使用 /api/jobs/dewatermark
+        - 处理时限默认 REQUEST_DEADLINE_SECONDS，可通过 X-Request-Timeout 头指定；超时返回 504
+        - 客户端断开时立即取消上游请求和待执行的重试
+    """
+    budget = request_budget(request, REQUEST_DEADLINE_SECONDS)
+    image_data, filename, content_type = await read_dewatermark_upload(image)
+    binary = accepts_image(request.headers.get('accept'))
+
+    # 提交任务并等待结果（优先查缓存）
+    job = job_manager.submit(
+        'dewatermark', budget=budget, priority=PRIORITY_INTERACTIVE, retain=False,
+        image_data=image_data, filename=filename, content_type=content_type,
+        params={'remove_text': remove_text, 'include_masks': include_masks and not binary}
+    )
+    result = await job_manager.wait(job, request)
+    headers = job_response_headers(job)
+
+    if binary:
+        session_id = result.get('session_id', '')
+        headers['X-Session-Id'] = session_id
+        if result.get('masks_url'):
+            headers['X-Masks-Url'] = result['masks_url']
+        return await base64_image_response(result['imageBase64'], headers)
+    return JSONResponse(result, headers=headers)
+
+
+@app.get('/api/dewatermark/{session_id}/masks')
+async def get_dewatermark_masks(session_id: str):
+    """
+    按 session_id 获取去水印蒙版（Base64）
+
+    返回:
+        {"session_id": "...", "mask": "...", "watermark_mask": "..."}
+    """
+    masks = mask_store.get(session_id)
+    if masks is None:
+        raise HTTPException(status_code=404, detail='Masks not found or expired')
+    return {'session_id': session_id, **masks}
+
+
+@app.get('/api/dewatermark/{session_id}/masks/{kind}')
+async def get_dewatermark_mask_image(session_id: str, kind: str):
+    """按 session_id 获取单张蒙版的图片二进制（kind: mask / watermark_mask）"""
+    if kind not in MASK_KINDS:
+        raise HTTPException(status_code=404, detail=f'Unknown mask kind: {kind}')
+    masks = mask_store.get(session_id)
+    if masks is None or not masks.get(kind):
+        raise HTTPException(status_code=404, detail='Masks not found or expired')
+    return await base64_image_response(masks[kind], {'X-Session-Id': session_id})
+
+
+@app.post('/api/pipeline')
+async def dewatermark_then_remove_background(request: Request, image: UploadFile = File(...),
+                                             remove_text: bool = Form(True),
+                                             rendition: Optional[str] = Query(None),
+                                             output_format: Optional[str] = Query(None, alias='format')):
+    """
+    串联处理端点：先去水印，再去背景
+
+    接收:
+        - multipart/form-data 格式
+        - 字段名: image（大小限制同去水印）
+        - 可选字段: remove_text（默认 true）
+        - 可选查询参数: rendition / format（同 /api/remove-background）
+
+    返回:
+        - 成功: {"processed_url": "...", "session_id": "...", "steps": {"dewatermark": "HIT", "remove-background": "MISS"}}
+
+    特性:
+        - 中间图片只在服务端内存中流转，省去一次客户端下载 + 重新上传
+        - 两步分别复用各自的结果缓存（响应头 X-Cache 为整体状态）
+        - 两步共用一个处理时限（默认 REQUEST_DEADLINE_SECONDS，可通过 X-Request-Timeout 头指定）
+    """
+    require_api_key('remove-background')
+    budget = request_budget(request, REQUEST_DEADLINE_SECONDS)
+    selection = parse_rendition_query(rendition, output_format)
+    image_data, filename, content_type = await read_dewatermark_upload(image, DEWATERMARK_MAX_SIZE)
+
+    job = job_manager.submit(
+        'pipeline', budget=budget, priority=PRIORITY_INTERACTIVE, retain=False, image_data=image_data, filename=filename,
+        content_type=content_type, params={'remove_text': remove_text, **selection}
+    )
+    result = await job_manager.wait(job, request)
+    return JSONResponse(result, headers=job_response_headers(job))
+
+
+@app.post('/api/jobs/remove-background', status_code=202)
+async def submit_remove_background_job(request: Request, image_file: UploadFile = File(...),
+                                       rendition: Optional[str] = Query(None),
+                                       output_format: Optional[str] = Query(None, alias='format')):
+    """
+    提交去背景任务（异步模式）
+
+    立即返回 job_id，之后通过以下端点获取进度和结果:
+        - GET /api/jobs/{job_id}         轮询状态
+        - GET /api/jobs/{job_id}/events  SSE 进度流
+    处理时限默认 JOB_DEADLINE_SECONDS（含排队时间），可通过 X-Request-Timeout 头指定
+    查询参数 rendition / format 同 /api/remove-background
+    """
+    budget = request_budget(request, JOB_DEADLINE_SECONDS)
+    selection = parse_rendition_query(rendition, output_format)
+    image_data, content_type = await read_remove_background_upload(image_file)
+    job = job_manager.submit(
+        'remove-background', budget=budget, image_data=image_data, content_type=content_type, params=selection
+    )
+    return job_links(job)
+
+
+@app.post('/api/jobs/dewatermark', status_code=202)
+async def submit_dewatermark_job(request: Request, image: UploadFile = File(...), remove_text: bool = Form(True),
+                                 include_masks: bool = Form(False)):
+    """
+    提交去水印任务（异步模式）
+
+    立即返回 job_id，之后通过以下端点获取进度和结果:
+        - GET /api/jobs/{job_id}         轮询状态
+        - GET /api/jobs/{job_id}/events  SSE 进度流
+    处理时限默认 JOB_DEADLINE_SECONDS（含排队时间），可通过 X-Request-Timeout 头指定
+    """
+    budget = request_budget(request, JOB_DEADLINE_SECONDS)
+    image_data, filename, content_type = await read_dewatermark_upload(image)
+    job = job_manager.submit(
+        'dewatermark', budget=budget, image_data=image_data, filename=filename, content_type=content_type,
+        params={'remove_text': remove_text, 'include_masks': include_masks}
+    )
+    return job_links(job)
+
+
+@app.post('/api/jobs/pipeline', status_code=202)
+async def submit_pipeline_job(request: Request, image: UploadFile = File(...), remove_text: bool = Form(True),
+                              rendition: Optional[str] = Query(None),
+                              output_format: Optional[str] = Query(None, alias='format')):
+    """
+    提交串联处理任务（去水印 -> 去背景，异步模式）
+
+    进度事件中的 stage 依次为 dewatermark / remove-background
+    """
+    require_api_key('remove-background')
+    budget = request_budget(request, JOB_DEADLINE_SECONDS)
+    selection = parse_rendition_query(rendition, output_format)
+    image_data, filename, content_type = await read_dewatermark_upload(image, DEWATERMARK_MAX_SIZE)
+    job = job_manager.submit(
+        'pipeline', budget=budget, image_data=image_data, filename=filename,
+        content_type=content_type, params={'remove_text': remove_text, **selection}
+    )
+    return job_links(job)
+
+
+@app.post('/api/batch/{operation}')
+async def batch_process(
+    request: Request,
+    operation: str,
+    files: List[UploadFile] = File(default=[]),
+    archive: Optional[UploadFile] = File(None),
+    remove_text: bool = Form(True),
+    include_masks: bool = Form(False),
+    concurrency: Optional[int] = Form(None)
+):
+    """
+    批量处理端点
+
+    接收:
+        - operation: remove-background / dewatermark / pipeline（去水印后去背景）
+        - files: 多个图片文件（字段名可重复）
+        - archive: zip 压缩包（可选，只处理其中的 png/jpg/jpeg/webp）
+        - remove_text / include_masks: 去水印参数（仅 dewatermark）
+        - concurrency: 并发上限（可选，不超过 BATCH_MAX_CONCURRENCY）
+        - X-Request-Timeout 头: 每张图片的处理时限（秒，默认 REQUEST_DEADLINE_SECONDS）
+
+    返回:
+        application/x-ndjson 流，每处理完一张图片输出一行:
+            {"type": "item", "index": 0, "filename": "...", "status": "ok", "result": {...}}
+            {"type": "item", "index": 1, "filename": "...", "status": "error", "error": {...}}
+        最后一行为汇总:
+            {"type": "summary", "total": N, "succeeded": n, "failed": m}
+    """
+    if operation not in OPERATIONS:
+        raise HTTPException(status_code=404, detail=f'Unknown operation: {operation}')
+    require_api_key(operation)
+    budget = request_budget(request, REQUEST_DEADLINE_SECONDS)
+
+    if len(files) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f'Too many images. Max is {BATCH_MAX_ITEMS} per batch')
+
+    items, spools = await collect_batch_items(files, archive)
+    if not items or len(items) > BATCH_MAX_ITEMS:
+        for spool in spools:
+            spool.close()
+        if not items:
+            raise HTTPException(status_code=400, detail='No images provided')
+        raise HTTPException(status_code=400, detail=f'Too many images. Max is {BATCH_MAX_ITEMS} per batch')
+
+    limit = max(1, min(concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    if operation == 'dewatermark':
+        params = {'remove_text': remove_text, 'include_masks': include_masks}
+    elif operation == 'pipeline':
+        params = {'remove_text': remove_text}
+    else:
+        params = {}
+    logger.info('批量处理', extra={'operation': operation, 'items': len(items), 'concurrency': limit})
+
+    return StreamingResponse(
+        stream_batch(operation, items, params, limit, spools, budget),
+        media_type='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.get('/api/jobs/stats')
+async def job_stats():
+    """任务引擎统计：worker 数、队列长度、各状态任务数"""
+    return job_manager.stats()
+
+
+@app.get('/api/jobs/{job_id}')
+async def get_job(job_id: str):
+    """
+    查询任务状态
+
+    返回:
+        - status: queued / running / succeeded / failed
+        - succeeded 时包含 result，failed 时包含 error
+    """
+    return job_manager.get(job_id).to_dict()
+
+
+@app.get('/api/jobs/{job_id}/events')
+async def job_events(job_id: str):
+    """
+    任务进度 SSE 流
+
+    事件类型:
+        - status: 状态变化（queued / running / succeeded / failed）
+        - progress: 处理阶段进度（编码、上传、重试等）
+    任务结束后发送最终状态并关闭连接
+    """
+    job = job_manager.get(job_id)
+
+    async def event_stream():
+        queue = job.subscribe()
+        try:
+            while True:
+                try:
+                    record = await asyncio.wait_for(queue.get(), timeout=JOB_SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    # 心跳注释，防止代理断开空闲连接
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f"event: {record['event']}\ndata: {json.dumps(record['data'], ensure_ascii=False)}\n\n"
+                if record['event'] == 'status' and record['data']['status'] in Job.TERMINAL_STATES:
+                    yield f"event: result\ndata: {json.dumps(job.to_dict(), ensure_ascii=False)}\n\n"
+                    break
+        finally:
+            job.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+async def serve_result_file(name: str, request: Request) -> Optional[Response]:
+    """
+    返回 static/results 下按内容哈希命名的结果文件（文件不存在时返回 None）
+
+    特性:
+        - 文件名即内容哈希，ETag 直接由文件名生成，多实例 / 重新下载后仍保持一致
+        - 支持 If-None-Match（304）和单段 Range / If-Range（206 / 416）
     """
-    print("\n" + "=" * 60)
-    print("🎨 接收到去水印请求")
-    print("=" * 60)
-    
-    # ========================================
-    # 1. 验证请求
-    # ========================================
-    if not image:
-        print("❌ 错误: 请求中没有 'image' 字段")
-        raise HTTPException(status_code=400, detail='No file provided')
-    
-    if image.filename == '':
-        print("❌ 错误: 没有选择文件")
-        raise HTTPException(status_code=400, detail='No file selected')
-    
-    print(f"📁 文件名: {image.filename}")
-    
-    # ========================================
-    # 2. 验证 API 密钥
-    # ========================================
-    if not DEWATERMARK_API_KEY:
-        print("❌ 错误: dewatermark.ai API 密钥未配置")
-        raise HTTPException(
-            status_code=500,
-            detail='DEWATERMARK_API_KEY not configured. Please add it to .env file'
-        )
-    
-    # ========================================
-    # 3. 读取图片数据
-    # ========================================
     try:
-        image_data = await image.read()
-        print(f"✓ 文件读取成功 ({len(image_data)} bytes)")
-    except Exception as e:
-        print(f"❌ 文件读取失败: {e}")
-        raise HTTPException(status_code=500, detail=f'Failed to read file: {str(e)}')
-    
-    # 验证文件大小 (10MB)
-    MAX_SIZE = 10 * 1024 * 1024
-    if len(image_data) > MAX_SIZE:
-        raise HTTPException(status_code=400, detail='File too large. Max size is 10MB')
-    
-    # ========================================
-    # 4. 调用 dewatermark.ai API
-    # ========================================
-    print("\n🔧 调用 dewatermark.ai API...")
-    
-    # 准备 API 请求
-    api_url = "https://platform.dewatermark.ai/api/object_removal/v1/erase_watermark"
-    clean_api_key = DEWATERMARK_API_KEY.strip()
-    
+        f = await asyncio.to_thread(open, result_mirror.path_for(name), 'rb')
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+
+    stat = os.fstat(f.fileno())
+    size = stat.st_size
+    result_mirror.touch(name)
+    etag = f'"{os.path.splitext(name)[0]}"'
     headers = {
-        "X-API-KEY": clean_api_key
-    }
-    
-    print(f"📡 API URL: {api_url}")
-    print(f"🔐 API Key 前缀: {clean_api_key[:15]}...")
-    
-    # 准备 multipart/form-data
-    files = {
-        'original_preview_image': (
-            image.filename,
-            BytesIO(image_data),
-            image.content_type or 'image/jpeg'
-        ),
-        'remove_text': (None, 'true')
+        'ETag': etag,
+        'Cache-Control': 'public, max-age=31536000, immutable',
+        'Last-Modified': email.utils.formatdate(stat.st_mtime, usegmt=True),
+        'Accept-Ranges': 'bytes',
     }
-    
-    # 重试配置
-    max_retries = 3
-    retry_delay = 2
-    
-    for attempt in range(max_retries):
+    media_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]):
+        f.close()
+        return Response(status_code=304, headers=headers)
+
+    start, end = 0, size - 1
+    status_code = 200
+    range_header = request.headers.get('range')
+    if range_header and request.headers.get('if-range', etag) == etag:
         try:
-            print(f"📤 尝试 {attempt + 1}/{max_retries}...")
-            
-            response = requests.post(
-                api_url,
-                headers=headers,
-                files=files,
-                timeout=60
-            )
-            
-            print(f"📡 API 响应状态: HTTP {response.status_code}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                
-                # 解析响应
-                if 'edited_image' in data and data['edited_image'].get('image'):
-                    print("✅ 去水印处理成功!")
-                    print("=" * 60 + "\n")
-                    
-                    return {
-                        'success': True,
-                        'imageBase64': data['edited_image']['image'],
-                        'session_id': data.get('session_id', ''),
-                        'mask': data['edited_image'].get('mask', ''),
-                        'watermark_mask': data['edited_image'].get('watermark_mask', '')
-                    }
-                else:
-                    print("❌ API 返回数据格式错误")
-                    raise HTTPException(status_code=500, detail='API 返回数据格式错误')
-            
-            elif response.status_code == 401:
-                error_msg = "API 密钥认证失败"
-                try:
-                    error_detail = response.json()
-                    print(f"❌ 401 错误: {error_detail}")
-                    error_msg = f"API 密钥认证失败: {error_detail}"
-                except:
-                    print(f"❌ 401 错误响应: {response.text[:200]}")
-                
-                raise HTTPException(status_code=500, detail=error_msg)
-            
-            elif response.status_code == 403:
-                error_msg = "API 访问被拒绝，请检查您的 API 密钥"
-                print(f"❌ 403 错误")
-                raise HTTPException(status_code=500, detail=error_msg)
-            
-            elif response.status_code == 429:
-                # 速率限制，等待后重试
-                if attempt < max_retries - 1:
-                    print(f"⚠️  请求过于频繁，等待 {retry_delay * (attempt + 1)} 秒后重试...")
-                    time.sleep(retry_delay * (attempt + 1))
-                    continue
-                raise HTTPException(status_code=429, detail='API 请求过于频繁，请稍后重试')
-            
-            elif response.status_code >= 500:
-                # 服务器错误，重试
-                if attempt < max_retries - 1:
-                    print(f"⚠️  服务器错误，等待 {retry_delay} 秒后重试...")
-                    time.sleep(retry_delay)
-                    continue
-                raise HTTPException(
-                    status_code=500,
-                    detail=f'API 服务器错误 ({response.status_code})，请稍后重试'
-                )
-            
-            else:
-                # 其他错误
-                try:
-                    error_data = response.json()
-                    error_msg = error_data.get('error', f'API 错误: {response.status_code}')
-                except:
-                    error_msg = f'API 错误: {response.status_code}'
-                
-                print(f"❌ {error_msg}")
-                raise HTTPException(status_code=500, detail=error_msg)
-        
-        except requests.exceptions.Timeout:
-            if attempt < max_retries - 1:
-                print(f"⚠️  请求超时，等待 {retry_delay} 秒后重试...")
-                time.sleep(retry_delay)
-                continue
-            print("❌ API 请求超时")
-            raise HTTPException(status_code=504, detail='请求超时，请重试')
-        
-        except requests.exceptions.ConnectionError:
-            print("❌ 无法连接到 dewatermark.ai 服务")
-            raise HTTPException(status_code=503, detail='无法连接到 API 服务')
-        
-        except HTTPException:
-            raise
-        
-        except Exception as e:
-            print(f"❌ 处理异常: {e}")
-            raise HTTPException(status_code=500, detail=f'处理失败: {str(e)}')
-    
-    # 达到最大重试次数
-    print("❌ 已达到最大重试次数")
-    raise HTTPException(status_code=500, detail='处理失败，已达到最大重试次数')
+            byte_range = parse_byte_range(range_header, size)
+        except ValueError:
+            f.close()
+            return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{size}'})
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
 
+    length = end - start + 1
+    headers['Content-Length'] = str(length)
+    if request.method == 'HEAD':
+        f.close()
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+    return StreamingResponse(
+        iter_file_range(f, start, length), status_code=status_code, headers=headers, media_type=media_type
+    )
+
+
+@app.api_route('/static/results/mirror/{name}', methods=['GET', 'HEAD'])
+async def get_mirrored_result(name: str, request: Request):
+    """
+    返回镜像结果
+
+    镜像记录在所有 worker 间共享：下载已完成时直接返回按内容命名的文件，
+    否则（下载中 / 下载失败 / 文件已被清理）307 重定向到上游 URL
+    """
+    key = os.path.splitext(name)[0]
+    if not re.fullmatch(r'[0-9a-f]{32}', key):
+        raise HTTPException(status_code=404, detail='Result not found')
+
+    record = await asyncio.to_thread(result_mirror.read_record, key)
+    if record is None:
+        raise HTTPException(status_code=404, detail='Result not found')
+    if record.get('name'):
+        # 同一上游 URL 只对应一个结果，镜像 URL 的内容同样不会变化，可以沿用 immutable 缓存头
+        response = await serve_result_file(record['name'], request)
+        if response is not None:
+            return response
+    return RedirectResponse(record['source'], status_code=307, headers={'Cache-Control': 'no-store'})
+
+
+@app.api_route('/static/results/{name}', methods=['GET', 'HEAD'])
+async def get_result_file(name: str, request: Request):
+    """
+    返回处理结果文件
+
+    文件名按结果内容哈希生成，内容不变，返回强 ETag 和 immutable 长缓存头
+    """
+    if name.startswith('.') or name.endswith('.tmp') or name != os.path.basename(name):
+        raise HTTPException(status_code=404, detail='Result not found')
+
+    response = await serve_result_file(name, request)
+    if response is None:
+        raise HTTPException(status_code=404, detail='Result not found')
+    return response
+
+
+# 挂载静态文件目录（放在路由之后，避免覆盖 /static/results/{name}）
+app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # ============================================================================
-# 6. 应用启动
+# 19. 应用启动
 # ============================================================================
 if __name__ == '__main__':
     print("=" * 60)
@@ -501,12 +5027,29 @@ if __name__ == '__main__':
     print(f"      - 端点: POST /api/dewatermark")
     print(f"      - 自动检测水印")
     print(f"      - 耗时: ~10-60秒")
+    print(f"   3. 异步任务")
+    print(f"      - 提交: POST /api/jobs/remove-background, POST /api/jobs/dewatermark")
+    print(f"      - 查询: GET /api/jobs/{{job_id}}, SSE: GET /api/jobs/{{job_id}}/events")
+    print(f"      - Worker: {JOB_WORKERS}, 队列上限: {JOB_QUEUE_SIZE}")
+    print(f"   4. 批量处理")
+    print(f"      - 端点: POST /api/batch/{{operation}} (多文件或 zip，NDJSON 流式返回)")
+    print(f"      - 默认并发: {BATCH_CONCURRENCY}, 单批上限: {BATCH_MAX_ITEMS}")
+    print(f"   5. 串联处理 (去水印 -> 去背景)")
+    print(f"      - 端点: POST /api/pipeline, POST /api/jobs/pipeline")
+    print(f"   6. 结果文件")
+    print(f"      - 端点: GET /static/results/{{name}} (强 ETag / Range / immutable 缓存头)")
+    print(f"      - 镜像端点: GET /static/results/mirror/{{key}} (已下载时返回文件，否则 307 到上游)")
+    print(f"      - 本地镜像: {'开启' if RESULT_MIRROR_ENABLED else '关闭'}, 容量上限: {RESULTS_MAX_BYTES // (1024 * 1024)}MB")
+    print(f"\n🔌 上游连接池: max={HTTP_MAX_CONNECTIONS}, keep-alive={HTTP_MAX_KEEPALIVE_CONNECTIONS}")
+    print(f"🔥 上游预热: {'开启 (' + str(UPSTREAM_PREWARM_CONNECTIONS) + ' 连接/上游)' if UPSTREAM_PREWARM_ENABLED else '关闭'}")
+    print(f"🚦 准入控制: {'开启 (' + ADMISSION_DB_PATH + ')' if ADMISSION_ENABLED else '关闭'}")
     print("=" * 60)
     print("🌐 Server running at: http://127.0.0.1:18181")
     print("📋 Health Check: http://127.0.0.1:18181/api/health")
+    print("📋 Readiness: http://127.0.0.1:18181/api/ready")
     print("🔧 API Documentation: http://127.0.0.1:18181/docs")
     print("🔧 API Alternate Docs: http://127.0.0.1:18181/redoc")
     print("=" * 60)
-    
+
     import uvicorn
     uvicorn.run(app, host='0.0.0.0', port=18181)
@@ -21,6 +21,14 @@ export default function WatermarkRemover({ t }) {
     };
   }, [previewURL]);
   
+  useEffect(() => {
+    return () => {
+      if (resultImageURL && resultImageURL.startsWith('blob:')) {
+        URL.revokeObjectURL(resultImageURL);
+      }
+    };
+  }, [resultImageURL]);
+  
   // 处理文件选择
   const handleFileSelect = (file) => {
     // 验证文件
@@ -33,8 +33,10 @@ export const watermarkAPI = {
       console.log('📤 发送去水印请求:', file.name);
       
       // 发送请求到后端服务器（通过 Vercel 代理）
+      // Accept: image/* 让后端直接返回图片二进制，避免 Base64 膨胀和大 JSON 解析
       const response = await fetch(`${API_BASE_URL}/api/dewatermark`, {
         method: 'POST',
+        headers: { Accept: 'image/*' },
         body: formData,
       });
       
@@ -45,17 +47,17 @@ export const watermarkAPI = {
         throw new Error(errorData.error || '处理失败');
       }
       
-      const data = await response.json();
-      console.log('✓ 去水印响应数据:', data);
+      const blob = await response.blob();
+      const sessionId = response.headers.get('X-Session-Id');
+      console.log('✓ 去水印完成:', { size: blob.size, type: blob.type, session_id: sessionId });
       
-      // 将 base64 编码的图片转换为 data URL
-      const imageBase64 = data.imageBase64;
-      const imageURL = `data:image/png;base64,${imageBase64}`;
+      // 图片二进制转换为 blob URL（不再需要 data URL）
+      const imageURL = URL.createObjectURL(blob);
       
       return {
         success: true,
         imageURL: imageURL,
-        session_id: data.session_id
+        session_id: sessionId
       };
     } catch (error) {
       console.error('❌ 去水印错误:', error);